@@ -0,0 +1,95 @@
+import json
+import sys
+from pathlib import Path
+
+import click
+
+from benchmarks.data import create_database, parse_size
+from benchmarks.run import ENDPOINTS, VARIANTS, compare, run_benchmarks
+
+
+def _split(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+@click.command()
+@click.option("--sizes", default="10k", show_default=True, help="Comma separated table sizes, eg 10k,1m,10m")
+@click.option("--variants", default=",".join(VARIANTS), show_default=True, help="Comma separated search variants")
+@click.option("--endpoints", default=",".join(ENDPOINTS), show_default=True, help="Comma separated endpoints")
+@click.option("--requests", default=50, show_default=True, help="Requests to time for each endpoint")
+@click.option("--batch-size", default=10, show_default=True, help="Queries (or extend ids) in each request")
+@click.option("--warmup", default=5, show_default=True, help="Untimed requests to send first")
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--data-dir",
+    type=click.Path(file_okay=False),
+    default=".benchmarks",
+    show_default=True,
+    help="Where to keep the generated databases",
+)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Save the results to this JSON file")
+@click.option(
+    "--baseline", type=click.Path(exists=True, dir_okay=False), help="Compare against results from an earlier run"
+)
+@click.option(
+    "--max-regression",
+    type=float,
+    default=0.2,
+    show_default=True,
+    help="Fail if the p95 latency is this much slower than the baseline",
+)
+def main(  # noqa: PLR0917
+    sizes, variants, endpoints, requests, batch_size, warmup, seed, data_dir, output, baseline, max_regression
+):
+    """
+    Benchmark the reconciliation endpoints against generated tables of each size.
+    """
+    variants = _split(variants)
+    endpoints = _split(endpoints)
+    for value, allowed in [(variants, VARIANTS), (endpoints, ENDPOINTS)]:
+        unknown = [v for v in value if v not in allowed]
+        if unknown:
+            msg = f"Unknown value {', '.join(unknown)}, choose from {', '.join(allowed)}"
+            raise click.BadParameter(msg)
+
+    db_paths = {}
+    for size_value in _split(sizes):
+        size = parse_size(size_value)
+        click.echo(f"Preparing table with {size:,} rows", err=True)
+        db_paths[size] = create_database(Path(data_dir) / f"bench-{size}-{seed}.db", size, seed)
+
+    results = run_benchmarks(
+        db_paths, variants, endpoints, requests=requests, batch_size=batch_size, warmup=warmup, seed=seed
+    )
+    for result in results["results"]:
+        click.echo(
+            "{size:>10,} {variant:<10} {endpoint:<17} p50 {p50_ms:>9.2f}ms  p95 {p95_ms:>9.2f}ms  "
+            "p99 {p99_ms:>9.2f}ms  {queries_per_s:>9.1f} q/s  sql {sql_ms_mean:>8.2f}ms  "
+            "python {python_ms_mean:>8.2f}ms  errors {errors}".format(**result)
+        )
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2))
+        click.echo(f"Results saved to {output}", err=True)
+
+    if baseline:
+        regressions = []
+        for row in compare(results, json.loads(Path(baseline).read_text())):
+            click.echo(
+                "{size:>10,} {variant:<10} {endpoint:<17} p50 x{p50:.2f}  p95 x{p95:.2f}  q/s x{qps:.2f}".format(
+                    size=row["size"],
+                    variant=row["variant"],
+                    endpoint=row["endpoint"],
+                    p50=row["p50_ms"] or 0,
+                    p95=row["p95_ms"] or 0,
+                    qps=row["queries_per_s"] or 0,
+                )
+            )
+            if row["p95_ms"] and row["p95_ms"] > 1 + max_regression:
+                regressions.append(row)
+        if regressions:
+            click.echo(f"{len(regressions)} results are more than {max_regression:.0%} slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
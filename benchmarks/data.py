@@ -0,0 +1,178 @@
+import itertools
+import random
+import sqlite3
+from pathlib import Path
+
+TABLE = "orgs"
+FTS_TABLE = "orgs_fts"
+INSERT_CHUNK_SIZE = 10_000
+
+FIRST_NAMES = [
+    "James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+    "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen",
+    "Ahmed", "Fatima", "Mohammed", "Aisha", "Wei", "Li", "Hiroshi", "Yuki", "Olga", "Dmitri",
+    "Siobhan", "Niamh", "Oluwaseun", "Chidi", "Priya", "Arjun", "Sofia", "Mateo", "Ingrid", "Lars",
+]  # fmt: skip
+SURNAMES = [
+    "Smith", "Jones", "Williams", "Taylor", "Brown", "Davies", "Evans", "Wilson", "Thomas", "Johnson",
+    "Roberts", "Robinson", "Thompson", "Wright", "Walker", "White", "Edwards", "Hughes", "Green", "Hall",
+    "Lewis", "Harris", "Clarke", "Patel", "Jackson", "Wood", "Turner", "Martin", "Cooper", "Hill",
+    "Ward", "Morris", "Moore", "Clark", "Lee", "King", "Baker", "Harrison", "Morgan", "Allen",
+    "O'Brien", "Nguyen", "Kowalski", "Müller", "García", "Okafor", "Khan", "Singh", "Rossi", "Schmidt",
+]  # fmt: skip
+WORDS = [
+    "Community", "Trust", "Foundation", "Youth", "Arts", "Sports", "Heritage", "Education", "Health",
+    "Housing", "Environmental", "Music", "Family", "Village", "Church", "Scout", "Rural", "Women's",
+    "Science", "Animal", "Garden", "Theatre", "Library", "Rescue", "Support", "Action", "Friends",
+]  # fmt: skip
+SUFFIXES = ["Ltd", "Limited", "Association", "Society", "Club", "Group", "Centre", "Partnership", "CIC", "Fund"]
+TYPES = ["charity", "company", "school", "university", "hospital", "club", "council", "trust"]
+CITIES = [
+    "London", "Birmingham", "Manchester", "Leeds", "Glasgow", "Sheffield", "Bristol", "Liverpool",
+    "Edinburgh", "Cardiff", "Belfast", "Leicester", "Nottingham", "Newcastle", "Brighton", "Oxford",
+]  # fmt: skip
+
+
+def parse_size(value):
+    """
+    Parse a number of rows like `10k`, `1m` or `10000`.
+    """
+    value = str(value).strip().lower()
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def _zipf_weights(values, exponent=1.1):
+    # a few values are very common and most are rare, as with real names
+    return list(itertools.accumulate(1 / (rank**exponent) for rank in range(1, len(values) + 1)))
+
+
+def generate_rows(size, seed=0):
+    """
+    Yield `size` rows of synthetic organisations and people.
+
+    Names are built from word lists with a Zipf distribution, so some names
+    appear many times in the table and others only once or twice, and each
+    row has a type and some property columns to filter on.
+    """
+    rng = random.Random(seed)  # noqa: S311
+    first_weights = _zipf_weights(FIRST_NAMES)
+    surname_weights = _zipf_weights(SURNAMES)
+    word_weights = _zipf_weights(WORDS)
+    type_weights = _zipf_weights(TYPES, 0.8)
+    city_weights = _zipf_weights(CITIES, 0.8)
+    for row_id in range(1, size + 1):
+        surname = rng.choices(SURNAMES, cum_weights=surname_weights)[0]
+        if rng.random() < 0.4:  # noqa: PLR2004
+            name = f"{rng.choices(FIRST_NAMES, cum_weights=first_weights)[0]} {surname}"
+        else:
+            words = rng.choices(WORDS, cum_weights=word_weights, k=rng.randint(1, 2))
+            name = " ".join([surname, *words, rng.choice(SUFFIXES)])
+        yield (
+            row_id,
+            name,
+            rng.choices(TYPES, cum_weights=type_weights)[0],
+            rng.choices(CITIES, cum_weights=city_weights)[0],
+            rng.randint(1850, 2024),
+        )
+
+
+def create_database(path, size, seed=0):
+    """
+    Create a SQLite database with a table of `size` synthetic rows and a full text search index.
+
+    The database is only created if it doesn't already exist, as the larger
+    sizes take a while to generate. Whether the full text search index is
+    used is set in the plugin configuration.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_suffix(".partial")
+    if partial_path.exists():
+        partial_path.unlink()
+
+    conn = sqlite3.connect(str(partial_path))
+    conn.executescript(
+        f"""
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE {TABLE} (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            type TEXT,
+            city TEXT,
+            founded INTEGER
+        );
+        """
+    )
+    rows = generate_rows(size, seed)
+    while True:
+        chunk = list(itertools.islice(rows, INSERT_CHUNK_SIZE))
+        if not chunk:
+            break
+        conn.executemany(f"INSERT INTO {TABLE} VALUES (?, ?, ?, ?, ?)", chunk)  # noqa: S608
+    conn.executescript(
+        f"""
+        CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(name, content={TABLE}, content_rowid=id);
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild');
+        ANALYZE;
+        """  # noqa: S608
+    )
+    conn.commit()
+    conn.close()
+    partial_path.rename(path)
+    return path
+
+
+def _perturb(rng, name):
+    choice = rng.random()
+    if choice < 0.4:  # noqa: PLR2004
+        return name
+    if choice < 0.6:  # noqa: PLR2004
+        return name.lower()
+    if choice < 0.8 and len(name) > 3:  # noqa: PLR2004
+        # swap two neighbouring characters, as in a typo
+        i = rng.randrange(1, len(name) - 2)
+        return name[:i] + name[i + 1] + name[i] + name[i + 2 :]
+    words = name.split()
+    if choice < 0.9 and len(words) > 1:  # noqa: PLR2004
+        words.pop(rng.randrange(len(words)))
+        return " ".join(words)
+    return f"{rng.choice(WORDS)} {rng.choice(SURNAMES)} {rng.choice(WORDS)} Unknown"
+
+
+def sample_queries(path, count, seed=0):
+    """
+    Return `count` reconciliation queries based on random rows of the table.
+
+    Most queries are the name of a row, some with a change in case, a typo
+    or a missing word, and some are names that are not in the table. A
+    quarter filter on the type of the row and a tenth on its city.
+    """
+    rng = random.Random(seed)  # noqa: S311
+    conn = sqlite3.connect(str(path))
+    max_id = conn.execute(f"SELECT max(id) FROM {TABLE}").fetchone()[0]  # noqa: S608
+    ids = [rng.randint(1, max_id) for _ in range(count)]
+    rows = {
+        row[0]: row[1:]
+        for row in conn.execute(
+            f"SELECT id, name, type, city FROM {TABLE} WHERE id IN ({','.join('?' * len(ids))})",  # noqa: S608
+            ids,
+        )
+    }
+    conn.close()
+
+    queries = []
+    for row_id in ids:
+        name, type_, city = rows[row_id]
+        query = {"query": _perturb(rng, name)}
+        if rng.random() < 0.25:  # noqa: PLR2004
+            query["type"] = type_
+        if rng.random() < 0.1:  # noqa: PLR2004
+            query["properties"] = [{"pid": "city", "v": city}]
+        queries.append((row_id, query))
+    return queries
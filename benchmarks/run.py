@@ -0,0 +1,212 @@
+import asyncio
+import json
+import math
+import platform
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import datasette
+import httpx
+from datasette.app import Datasette
+
+from benchmarks.data import FTS_TABLE, TABLE, TYPES, sample_queries
+from datasette_reconcile.__about__ import __version__
+
+try:
+    import resource
+except ImportError:  # no cov
+    resource = None
+
+VARIANTS = {
+    "like": {"fts_table": None},
+    "fts": {"fts_table": FTS_TABLE},
+    "like-batch": {"fts_table": None, "execution_mode": "batch"},
+    "fts-batch": {"fts_table": FTS_TABLE, "execution_mode": "batch"},
+}
+ENDPOINTS = ["reconcile", "extend_propose", "extend", "suggest_entity", "suggest_type", "suggest_property"]
+PERCENTILES = [50, 95, 99]
+
+
+def percentile(values, pct):
+    """
+    Return the nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in megabytes.
+    """
+    if resource is None:  # no cov
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(peak / divisor, 1)
+
+
+def parse_server_timing(header):
+    """
+    Return the durations (in milliseconds) in a `Server-Timing` header, by name.
+    """
+    timings = {}
+    for metric in (header or "").split(","):
+        parts = metric.strip().split(";")
+        for part in parts[1:]:
+            if part.startswith("dur="):
+                timings[parts[0]] = float(part[4:])
+    return timings
+
+
+def get_metadata(database, variant):
+    config = {
+        "id_field": "id",
+        "name_field": "name",
+        "type_field": "type",
+        **VARIANTS[variant],
+    }
+    return {"databases": {database: {"tables": {TABLE: {"plugins": {"datasette-reconcile": config}}}}}}
+
+
+def get_requests(database, queries, endpoint, count, batch_size):
+    """
+    Return `count` requests (a method, path and parameters) for an endpoint, based on the sample queries.
+    """
+    base = f"/{database}/{TABLE}/-/reconcile"
+    requests = []
+    for i in range(count):
+        sample = [queries[(i * batch_size + j) % len(queries)] for j in range(batch_size)]
+        query = sample[0][1]
+        if endpoint == "reconcile":
+            batch = {f"q{j}": q for j, (_, q) in enumerate(sample)}
+            requests.append(("POST", base, {"data": {"queries": json.dumps(batch)}}))
+        elif endpoint == "extend_propose":
+            requests.append(("GET", f"{base}/extend/propose", {"params": {"type": TYPES[i % len(TYPES)]}}))
+        elif endpoint == "extend":
+            extend = {"ids": [str(r) for r, _ in sample], "properties": [{"id": "city"}, {"id": "founded"}]}
+            requests.append(("POST", base, {"data": {"extend": json.dumps(extend)}}))
+        elif endpoint == "suggest_entity":
+            prefix = query["query"][: 3 + i % 3]
+            requests.append(("GET", f"{base}/suggest/entity", {"params": {"prefix": prefix}}))
+        elif endpoint == "suggest_type":
+            prefix = TYPES[i % len(TYPES)][: 1 + i % 3]
+            requests.append(("GET", f"{base}/suggest/type", {"params": {"prefix": prefix}}))
+        elif endpoint == "suggest_property":
+            requests.append(("GET", f"{base}/suggest/property", {"params": {"prefix": "c"}}))
+        else:
+            msg = f"Unknown endpoint: {endpoint}"
+            raise ValueError(msg)
+    return requests
+
+
+async def run_endpoint(client, requests, queries_per_request, warmup):
+    """
+    Send the requests one at a time, and summarise the latency and time spent running SQL.
+    """
+    for method, path, kwargs in requests[:warmup]:
+        await client.request(method, path, **kwargs)
+
+    latencies = []
+    sql_times = []
+    errors = 0
+    start = time.perf_counter()
+    for method, path, kwargs in requests:
+        request_start = time.perf_counter()
+        response = await client.request(method, path, **kwargs)
+        await response.aread()
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        if response.status_code != 200:  # noqa: PLR2004
+            errors += 1
+        sql_times.append(parse_server_timing(response.headers.get("server-timing")).get("sql", 0))
+    elapsed = time.perf_counter() - start
+
+    mean_latency = sum(latencies) / len(latencies)
+    mean_sql = sum(sql_times) / len(sql_times)
+    result = {
+        "requests": len(requests),
+        "errors": errors,
+        "mean_ms": round(mean_latency, 3),
+        **{f"p{pct}_ms": round(percentile(latencies, pct), 3) for pct in PERCENTILES},
+        "requests_per_s": round(len(requests) / elapsed, 2),
+        "queries_per_s": round(len(requests) * queries_per_request / elapsed, 2),
+        "sql_ms_mean": round(mean_sql, 3),
+        "python_ms_mean": round(mean_latency - mean_sql, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    return result
+
+
+async def run_suite(db_path, size, variants, endpoints, *, requests=50, batch_size=10, warmup=5, seed=0):
+    """
+    Run each endpoint against a benchmark database with each variant of the plugin configuration.
+
+    Requests are sent through an in-process ASGI client, so the results
+    measure Datasette and the plugin rather than the network.
+    """
+    database = Path(db_path).stem
+    queries = sample_queries(db_path, max(requests * batch_size, 1), seed)
+    results = []
+    for variant in variants:
+        ds = Datasette(
+            [str(db_path)],
+            metadata=get_metadata(database, variant),
+            settings={"sql_time_limit_ms": 60_000},
+        )
+        transport = httpx.ASGITransport(app=ds.app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://localhost") as client:
+            for endpoint in endpoints:
+                endpoint_requests = get_requests(database, queries, endpoint, requests, batch_size)
+                queries_per_request = batch_size if endpoint in ("reconcile", "extend") else 1
+                result = await run_endpoint(client, endpoint_requests, queries_per_request, warmup)
+                results.append({"size": size, "variant": variant, "endpoint": endpoint, **result})
+    return results
+
+
+def run_benchmarks(db_paths, variants, endpoints, **kwargs):
+    """
+    Run the suite against databases of each size, returning the results with details of the environment.
+
+    `db_paths` is a dict of number of rows to the path of the database.
+    """
+    results = []
+    for size, db_path in db_paths.items():
+        results.extend(asyncio.run(run_suite(db_path, size, variants, endpoints, **kwargs)))
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "datasette_reconcile": __version__,
+            "datasette": datasette.__version__,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "options": kwargs,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline):
+    """
+    Compare two sets of benchmark results.
+
+    Returns a row for each size, variant and endpoint found in both, with
+    the ratio of the new p50 and p95 latency and throughput to the baseline.
+    """
+    baseline_results = {(r["size"], r["variant"], r["endpoint"]): r for r in baseline["results"]}
+    rows = []
+    for result in results["results"]:
+        base = baseline_results.get((result["size"], result["variant"], result["endpoint"]))
+        if base is None:
+            continue
+        row = {"size": result["size"], "variant": result["variant"], "endpoint": result["endpoint"]}
+        for key in ("p50_ms", "p95_ms", "queries_per_s"):
+            row[key] = result[key] / base[key] if base[key] else None
+        rows.append(row)
+    return rows
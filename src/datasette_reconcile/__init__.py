@@ -1,56 +1,112 @@
 from datasette import hookimpl
+from datasette.utils.asgi import Forbidden, Response
 
+from datasette_reconcile.admission import AdmissionError
+from datasette_reconcile.cli import reconcile_advise, reconcile_bulk, reconcile_index, reconcile_replay
+from datasette_reconcile.metrics import PROMETHEUS_CONTENT_TYPE, render_prometheus
 from datasette_reconcile.reconcile import ReconcileAPI
-from datasette_reconcile.utils import check_config, check_permissions
+from datasette_reconcile.state import get_state
+from datasette_reconcile.timing import Timings
+from datasette_reconcile.utils import check_permissions, get_cached_config, get_slow_query_log
 
 
 async def get_api(request, datasette):
     database = request.url_vars["db_name"]
     table = request.url_vars["db_table"]
-    db = datasette.get_database(database)
+    timings = Timings(metrics=get_state(datasette).metrics)
 
     # get plugin configuration
-    config = datasette.plugin_config("datasette-reconcile", database=database, table=table)
-    config = await check_config(config, db, table)
+    with timings.stage("config"):
+        config = await get_cached_config(datasette, database, table)
 
     # check user can at least view this table
-    await check_permissions(
-        request,
-        [
-            ("view-table", (database, table)),
-            ("view-database", database),
-            "view-instance",
-        ],
-        datasette,
-    )
+    with timings.stage("permissions"):
+        await check_permissions(
+            request,
+            [
+                ("view-table", (database, table)),
+                ("view-database", database),
+                "view-instance",
+            ],
+            datasette,
+        )
+
+    # the SQL and timings are only shown to actors who can see the debug menu
+    if request.args.get("_debug") == "1":
+        timings.debug = await datasette.permission_allowed(request.actor, "debug-menu", default=False)
 
     # get the reconciliation API and call it
-    return ReconcileAPI(config, database, table, datasette)
+    return ReconcileAPI(config, database, table, datasette, timings)
 
 
-async def reconcile(request, datasette):
+async def call_api(request, datasette, endpoint):
     reconcile_api = await get_api(request, datasette)
-    return await reconcile_api.reconcile(request)
+    metrics = get_state(datasette).metrics
+    try:
+        response = await getattr(reconcile_api, endpoint)(request)
+    except AdmissionError as e:
+        metrics.increment("reconcile_rejected_requests_total", endpoint=endpoint, reason=e.reason)
+        return reconcile_api._admission_error_response(e)
+
+    metrics.increment(
+        "reconcile_requests_total", endpoint=endpoint, database=reconcile_api.database, table=reconcile_api.table
+    )
+    metrics.observe("reconcile_request_duration_seconds", reconcile_api.timings.total(), endpoint=endpoint)
+    return response
+
+
+async def reconcile(request, datasette):
+    return await call_api(request, datasette, "reconcile")
 
 
 async def properties(request, datasette):
-    reconcile_api = await get_api(request, datasette)
-    return await reconcile_api.properties(request)
+    return await call_api(request, datasette, "properties")
 
 
 async def suggest_entity(request, datasette):
-    reconcile_api = await get_api(request, datasette)
-    return await reconcile_api.suggest_entity(request)
+    return await call_api(request, datasette, "suggest_entity")
 
 
 async def suggest_property(request, datasette):
-    reconcile_api = await get_api(request, datasette)
-    return await reconcile_api.suggest_property(request)
+    return await call_api(request, datasette, "suggest_property")
 
 
 async def suggest_type(request, datasette):
-    reconcile_api = await get_api(request, datasette)
-    return await reconcile_api.suggest_type(request)
+    return await call_api(request, datasette, "suggest_type")
+
+
+async def index_advice(request, datasette):
+    return await call_api(request, datasette, "index_advice")
+
+
+async def submit_job(request, datasette):
+    return await call_api(request, datasette, "submit_job")
+
+
+async def job_status(request, datasette):
+    return await call_api(request, datasette, "job_status")
+
+
+async def job_results(request, datasette):
+    return await call_api(request, datasette, "job_results")
+
+
+async def metrics(request, datasette):
+    # the metrics are only read from memory, so this never queries a database
+    await check_permissions(request, ["view-instance"], datasette)
+    state = get_state(datasette)
+    return Response(
+        render_prometheus(state.metrics, state.cache_stats()),
+        content_type=PROMETHEUS_CONTENT_TYPE,
+    )
+
+
+async def slow_queries(request, datasette):
+    # the log includes SQL and query plans, so is only shown to actors who can see the debug menu
+    if not await datasette.permission_allowed(request.actor, "debug-menu", default=False):
+        msg = "debug-menu"
+        raise Forbidden(msg)
+    return Response.json({"slow_queries": get_slow_query_log(datasette).recent()})
 
 
 @hookimpl
@@ -61,4 +117,18 @@ def register_routes():
         (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/suggest/entity$", suggest_entity),
         (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/suggest/property$", suggest_property),
         (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/suggest/type$", suggest_type),
+        (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/advisor$", index_advice),
+        (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/jobs$", submit_job),
+        (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/jobs/(?P<job_id>[^/]+)$", job_status),
+        (r"/(?P<db_name>[^/]+)/(?P<db_table>[^/]+?)/-/reconcile/jobs/(?P<job_id>[^/]+)/results$", job_results),
+        (r"/-/reconcile/metrics$", metrics),
+        (r"/-/reconcile/slow-queries$", slow_queries),
     ]
+
+
+@hookimpl
+def register_commands(cli):
+    cli.add_command(reconcile_index)
+    cli.add_command(reconcile_advise)
+    cli.add_command(reconcile_replay)
+    cli.add_command(reconcile_bulk)
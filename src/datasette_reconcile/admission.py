@@ -0,0 +1,102 @@
+import asyncio
+from collections import Counter
+
+from datasette_reconcile.settings import DEFAULT_REQUEST_QUEUE_TIMEOUT, DEFAULT_RETRY_AFTER
+
+
+class AdmissionError(Exception):
+    """
+    Raised when a request is turned away by the admission limits.
+
+    `status` is the HTTP status to respond with, `reason` labels the
+    rejection in the metrics and `retry_after` is the number of seconds a
+    client should wait before trying again, if any.
+    """
+
+    def __init__(self, message, status, reason, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def get_client_id(request):
+    """
+    Identify the client making a request, by the id of the actor or else by IP address.
+    """
+    actor = request.actor
+    if actor and actor.get("id") is not None:
+        return ("actor", str(actor["id"]))
+    client = request.scope.get("client")
+    return ("ip", client[0] if client else None)
+
+
+class AdmissionController:
+    """
+    Limits the number of reconcile requests running at once, overall and for each client.
+
+    A client already at its own limit is turned away straight away. Other
+    requests over the overall limit wait in a queue for up to
+    `queue_timeout` seconds before they are turned away. Queued requests
+    count towards their client's limit, so one client can't fill the queue.
+    """
+
+    def __init__(
+        self,
+        max_requests=None,
+        max_requests_per_client=None,
+        queue_timeout=DEFAULT_REQUEST_QUEUE_TIMEOUT,
+        retry_after=DEFAULT_RETRY_AFTER,
+    ):
+        self.max_requests = max_requests
+        self.max_requests_per_client = max_requests_per_client
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.clients = Counter()
+        self._semaphore = asyncio.Semaphore(max_requests) if max_requests else None
+
+    async def acquire(self, client_id):
+        """
+        Wait for a slot for a request from `client_id`, returning a function to release it.
+
+        Raises `AdmissionError` if the client is at its limit or no slot is
+        free before the queue timeout.
+        """
+        if self.max_requests_per_client and self.clients[client_id] >= self.max_requests_per_client:
+            msg = f"Too many concurrent requests from this client (limit {self.max_requests_per_client})"
+            raise AdmissionError(msg, 429, "client_limit", self.retry_after)
+
+        self.clients[client_id] += 1
+        if self._semaphore is not None:
+            try:
+                if self._semaphore.locked():
+                    await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+                else:
+                    # a free slot is taken straight away, even with no queue timeout
+                    await self._semaphore.acquire()
+            except asyncio.TimeoutError as e:
+                self._release_client(client_id)
+                msg = f"Too many concurrent requests (limit {self.max_requests})"
+                raise AdmissionError(msg, 429, "global_limit", self.retry_after) from e
+            except BaseException:
+                # a cancelled request no longer counts towards its client's limit
+                self._release_client(client_id)
+                raise
+
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            if self._semaphore is not None:
+                self._semaphore.release()
+            self._release_client(client_id)
+
+        return release
+
+    def _release_client(self, client_id):
+        self.clients[client_id] -= 1
+        if self.clients[client_id] <= 0:
+            del self.clients[client_id]
@@ -0,0 +1,215 @@
+import asyncio
+import csv
+import itertools
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from datasette_reconcile.reconcile import ReconcileAPI
+from datasette_reconcile.serialisation import dumps, loads
+from datasette_reconcile.settings import DEFAULT_BULK_SQL_TIME_LIMIT_MS
+from datasette_reconcile.utils import ReconcileError, check_config
+
+CSV_OUTPUT_FIELDS = ["row", "id", "query", "match_id", "match_name", "match_score", "match"]
+
+# the reconciliation API for the worker process, set up by `_init_worker`
+_WORKER = {}
+
+
+def get_datasette(database_path, metadata=None, sql_time_limit_ms=DEFAULT_BULK_SQL_TIME_LIMIT_MS):
+    # imported here as plugins are loaded while datasette.app is being imported
+    from datasette.app import Datasette  # noqa: PLC0415
+
+    # the database is opened as immutable, so each SQL thread has a read-only connection.
+    # Nobody is waiting on a response, so queries get longer than the server's default time limit.
+    return Datasette(
+        immutables=[str(database_path)],
+        metadata=metadata,
+        settings={"num_sql_threads": 1, "sql_time_limit_ms": sql_time_limit_ms},
+    )
+
+
+def get_bulk_config(database_path, table, metadata=None, overrides=None):
+    """
+    Return the checked plugin configuration for a table, as used by the reconcile endpoint.
+
+    The configuration comes from the table's plugin configuration in
+    `metadata` if given, updated with any `overrides`.
+    """
+    datasette = get_datasette(database_path, metadata)
+    database = Path(database_path).stem
+    config = dict(datasette.plugin_config("datasette-reconcile", database=database, table=table) or {})
+    config.update({key: value for key, value in (overrides or {}).items() if value is not None})
+    if not config:
+        msg = "Reconciliation config must include at least a name field"
+        raise ReconcileError(msg)
+    return asyncio.run(check_config(config, datasette.get_database(database), table))
+
+
+def read_rows(path, input_format=None):
+    """
+    Yield each row of a CSV or JSON lines file as a dict.
+
+    The format is taken from the file extension unless `input_format` is given.
+    """
+    input_format = input_format or ("jsonl" if Path(path).suffix.lower() in (".jsonl", ".ndjson") else "csv")
+    with open(path, encoding="utf-8", newline="") as f:
+        if input_format == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+
+
+def get_query(row, column, *, type_column=None, type_=None, properties=None, limit=None):
+    """
+    Build a reconciliation query from a row of the input, in the same form as those sent to the reconcile endpoint.
+    """
+    query = {"query": str(row.get(column) or "").strip()}
+    if type_column and row.get(type_column):
+        query["type"] = row[type_column]
+    elif type_:
+        query["type"] = type_
+    if properties:
+        query["properties"] = [
+            {"pid": pid, "v": row[input_column]} for pid, input_column in properties if row.get(input_column)
+        ]
+    if limit:
+        query["limit"] = limit
+    return query
+
+
+def _init_worker(database_path, table, config, metadata, sql_time_limit_ms):
+    datasette = get_datasette(database_path, metadata, sql_time_limit_ms)
+    _WORKER["loop"] = asyncio.new_event_loop()
+    _WORKER["api"] = ReconcileAPI(config, Path(database_path).stem, table, datasette)
+
+
+async def _reconcile(api, queries):
+    return {query_id: results async for query_id, results in api._reconcile_queries(queries)}
+
+
+def reconcile_batch(batch):
+    """
+    Reconcile a batch of `(row number, query)` pairs in a worker process.
+
+    The queries are run together with the same code as the reconcile
+    endpoint, so identical queries are only run once. Blank queries get no
+    results.
+    """
+    queries = {str(row_number): query for row_number, query in batch if query["query"]}
+    results = _WORKER["loop"].run_until_complete(_reconcile(_WORKER["api"], queries)) if queries else {}
+    return [(row_number, results.get(str(row_number), [])) for row_number, _ in batch]
+
+
+class BulkWriter:
+    """
+    Writes results to a CSV or JSON lines file, with a checkpoint so an interrupted job can be resumed.
+
+    The checkpoint holds the number of input rows written and the size of
+    the output file after writing them. It is replaced after each batch,
+    and removed once the job is finished.
+    """
+
+    def __init__(self, path, checkpoint_path, output_format=None, *, resume=False):
+        self.path = Path(path)
+        self.checkpoint_path = Path(checkpoint_path)
+        self.output_format = output_format or ("csv" if self.path.suffix.lower() == ".csv" else "jsonl")
+        self.rows = 0
+        offset = 0
+        if resume and self.checkpoint_path.exists():
+            checkpoint = json.loads(self.checkpoint_path.read_text())
+            self.rows = checkpoint["rows"]
+            offset = checkpoint["offset"]
+
+        # anything written after the last checkpoint is thrown away
+        mode = "r+" if offset else "w"
+        self._file = open(self.path, mode, encoding="utf-8", newline="")
+        self._file.seek(offset)
+        self._file.truncate()
+        if self.output_format == "csv":
+            self._csv = csv.writer(self._file)
+            if not offset:
+                self._csv.writerow(CSV_OUTPUT_FIELDS)
+
+    def write(self, rows):
+        for row_number, row_id, query, results in rows:
+            if self.output_format == "csv":
+                top = results[0] if results else {}
+                self._csv.writerow(
+                    [row_number, row_id, query, top.get("id"), top.get("name"), top.get("score"), top.get("match")]
+                )
+            else:
+                self._file.write(dumps({"row": row_number, "id": row_id, "query": query, "result": results}) + "\n")
+        self.rows += len(rows)
+        self._file.flush()
+        self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        tmp_path = self.checkpoint_path.with_name(self.checkpoint_path.name + ".tmp")
+        tmp_path.write_text(json.dumps({"rows": self.rows, "offset": self._file.tell()}))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def close(self, *, finished=False):
+        self._file.close()
+        if finished and self.checkpoint_path.exists():
+            self.checkpoint_path.unlink()
+
+
+def run_bulk(
+    rows,
+    database_path,
+    table,
+    config,
+    writer,
+    *,
+    metadata=None,
+    workers=None,
+    batch_size=100,
+    sql_time_limit_ms=DEFAULT_BULK_SQL_TIME_LIMIT_MS,
+    query_options,
+):
+    """
+    Reconcile every row from `rows`, writing the results in order with `writer`.
+
+    Batches of rows are spread across a pool of worker processes, each with
+    its own read-only connection to the database. Only a few batches per
+    worker are read ahead of the output, so memory use stays flat however
+    large the input is. Rows already written (when resuming) are skipped.
+    Each query may run for up to `sql_time_limit_ms` milliseconds.
+    """
+    workers = workers or os.cpu_count() or 1
+    rows = itertools.islice(enumerate(rows, start=1), writer.rows, None)
+    query_options = dict(query_options)
+    id_column = query_options.pop("id_column", None)
+
+    def batches():
+        while True:
+            chunk = list(itertools.islice(rows, batch_size))
+            if not chunk:
+                return
+            yield [
+                (row_number, row.get(id_column) if id_column else None, get_query(row, **query_options))
+                for row_number, row in chunk
+            ]
+
+    def write(batch, future):
+        results = dict(future.result())
+        writer.write([(row_number, row_id, query["query"], results[row_number]) for row_number, row_id, query in batch])
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(str(database_path), table, config, metadata, sql_time_limit_ms)
+    ) as pool:
+        in_flight = deque()
+        for batch in batches():
+            in_flight.append(
+                (batch, pool.submit(reconcile_batch, [(row_number, query) for row_number, _, query in batch]))
+            )
+            if len(in_flight) >= workers * 2:
+                write(*in_flight.popleft())
+        while in_flight:
+            write(*in_flight.popleft())
+    return writer.rows
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from datasette_reconcile.serialisation import dumps, loads
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+
+class LRUCache:
+    """
+    A small least-recently-used cache with hit/miss counters.
+
+    The cache can be bounded by number of entries (`maxsize`) and/or by the
+    total of the sizes given when values are set (`maxbytes`).
+
+    `cache_info()` mirrors `functools.lru_cache` so the counters can be
+    checked in the same way.
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.currbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, nbytes=0):
+        self.pop(key)
+        self._data[key] = (value, nbytes)
+        self.currbytes += nbytes
+        while self._data and (
+            (self.maxsize is not None and len(self._data) > self.maxsize)
+            or (self.maxbytes is not None and self.currbytes > self.maxbytes)
+        ):
+            _, (_, evicted_bytes) = self._data.popitem(last=False)
+            self.currbytes -= evicted_bytes
+            self.evictions += 1
+
+    def pop(self, key):
+        if key in self._data:
+            _, nbytes = self._data.pop(key)
+            self.currbytes -= nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.currbytes = 0
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._data))
+
+
+class ResultCache:
+    """
+    Cache of reconciliation results, tagged with the data version they were created at.
+
+    Results are held in a memory-bounded LRU cache, and optionally in a
+    SQLite database on disk which can be shared between Datasette processes.
+    Entries for an older data version are treated as a miss and removed.
+
+    The oldest entries on disk are removed once the results held there add
+    up to more than `disk_maxbytes`, and entries older than `max_age`
+    seconds are removed whenever results are added.
+    """
+
+    def __init__(self, maxbytes, path=None, *, disk_maxbytes=None, max_age=None):
+        self.memory = LRUCache(maxsize=None, maxbytes=maxbytes)
+        self.path = path
+        self.disk_maxbytes = disk_maxbytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.invalidations = 0
+        self.disk_evictions = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _disk(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=wal")
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(reconcile_results)")]
+            if columns and "created" not in columns:
+                # a cache from an older version, without the columns used to prune it
+                self._conn.execute("DROP TABLE reconcile_results")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS reconcile_results (
+                    key TEXT PRIMARY KEY, version TEXT, value TEXT, size INTEGER, created REAL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS reconcile_results_created ON reconcile_results (created)")
+        return self._conn
+
+    def _disk_get_many(self, keys, version):
+        found = {}
+        with self._lock:
+            conn = self._disk()
+            for key in keys:
+                row = conn.execute("SELECT version, value FROM reconcile_results WHERE key = ?", [key]).fetchone()
+                if row is None:
+                    continue
+                if row[0] != version:
+                    conn.execute("DELETE FROM reconcile_results WHERE key = ?", [key])
+                    self.invalidations += 1
+                    continue
+                found[key] = row[1]
+        return found
+
+    def _disk_set_many(self, items, version):
+        now = time.time()
+        with self._lock:
+            conn = self._disk()
+            conn.executemany(
+                "INSERT OR REPLACE INTO reconcile_results (key, version, value, size, created) VALUES (?, ?, ?, ?, ?)",
+                [(key, version, value, len(value), now) for key, value in items.items()],
+            )
+            self._disk_prune(conn, now)
+
+    def _disk_prune(self, conn, now):
+        if self.max_age is not None:
+            cursor = conn.execute("DELETE FROM reconcile_results WHERE created < ?", [now - self.max_age])
+            self.disk_evictions += cursor.rowcount
+        if self.disk_maxbytes is None:
+            return
+        excess = conn.execute("SELECT total(size) FROM reconcile_results").fetchone()[0] - self.disk_maxbytes
+        if excess <= 0:
+            return
+        # remove the oldest entries until the rest fit
+        freed = 0
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM reconcile_results ORDER BY created, rowid"):
+            freed += size
+            keys.append((key,))
+            if freed >= excess:
+                break
+        cursor = conn.executemany("DELETE FROM reconcile_results WHERE key = ?", keys)
+        self.disk_evictions += cursor.rowcount
+
+    async def get_many(self, keys, data_version):
+        version = json.dumps(data_version)
+        found = {}
+        for key in keys:
+            entry = self.memory.get(key)
+            if entry is None:
+                continue
+            if entry[0] != version:
+                self.memory.pop(key)
+                self.invalidations += 1
+                continue
+            found[key] = entry[1]
+
+        missing = [key for key in keys if key not in found]
+        if self.path and missing:
+            loop = asyncio.get_event_loop()
+            from_disk = await loop.run_in_executor(None, self._disk_get_many, missing, version)
+            for key, value in from_disk.items():
+                found[key] = loads(value)
+                self.memory.set(key, (version, found[key]), len(value))
+            self.disk_hits += len(from_disk)
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def set_many(self, items, data_version):
+        version = json.dumps(data_version)
+        serialised = {key: dumps(value) for key, value in items.items()}
+        for key, value in items.items():
+            self.memory.set(key, (version, value), len(serialised[key]))
+        if self.path and items:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._disk_set_many, serialised, version)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "disk_hits": self.disk_hits,
+            "evictions": self.memory.evictions,
+            "disk_evictions": self.disk_evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self.memory),
+            "bytes": self.memory.currbytes,
+        }
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import sqlite3
+
+import click
+import httpx
+from datasette.utils import parse_metadata
+from datasette.utils.asgi import NotFound
+
+from datasette_reconcile.bulk import BulkWriter, get_bulk_config, read_rows, run_bulk
+from datasette_reconcile.indexes import (
+    advise_filter_indexes,
+    build_names_index,
+    build_trigram_index,
+    create_filter_indexes,
+    names_index_status,
+    trigram_index_status,
+)
+from datasette_reconcile.replay import diff_results, load_recording, replay, summarise
+from datasette_reconcile.serialisation import dumps
+from datasette_reconcile.settings import DEFAULT_BULK_SQL_TIME_LIMIT_MS, EXECUTION_MODES
+from datasette_reconcile.utils import ReconcileError
+
+
+@click.command(name="reconcile-index")
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("table")
+@click.option("--name-field", required=True, help="Field containing the names to index")
+@click.option("--trigram", is_flag=True, help="Build a trigram index for tables without full text search")
+@click.option("--normalised", is_flag=True, help="Build an index of normalised names for exact matching")
+@click.option("--check", is_flag=True, help="Report whether the indexes are stale instead of building them")
+def reconcile_index(database, table, name_field, trigram, normalised, check):  # noqa: PLR0917
+    """
+    Build the indexes used by datasette-reconcile for TABLE in DATABASE.
+
+    With --check the status of each index is printed as JSON, and the
+    command exits with an error if any of them are missing or stale.
+    """
+    if not trigram and not normalised:
+        msg = "Select at least one index to build, eg --trigram or --normalised"
+        raise click.UsageError(msg)
+
+    conn = sqlite3.connect(database)
+    try:
+        statuses = {}
+        if trigram:
+            if check:
+                statuses["trigram"] = trigram_index_status(conn, table, name_field)
+            else:
+                statuses["trigram"] = build_trigram_index(conn, table, name_field)
+        if normalised:
+            if check:
+                statuses["normalised"] = names_index_status(conn, table, name_field)
+            else:
+                statuses["normalised"] = build_names_index(conn, table, name_field)
+    except ReconcileError as e:
+        raise click.ClickException(str(e)) from e
+    finally:
+        conn.close()
+
+    click.echo(json.dumps(statuses, indent=2))
+    if any(status["stale"] for status in statuses.values()):
+        raise click.exceptions.Exit(1)
+
+
+@click.command(name="reconcile-advise")
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("table")
+@click.option("--id-field", help="Field containing the identifier, used by the extend endpoint")
+@click.option("--type-field", help="Field containing the type of each entity")
+@click.option("properties", "--property", multiple=True, help="Field used as a property filter (can be repeated)")
+@click.option("--create", is_flag=True, help="Create any missing indexes")
+def reconcile_advise(database, table, id_field, type_field, properties, create):  # noqa: PLR0917
+    """
+    Check whether the fields used to filter reconciliation queries on TABLE in DATABASE are indexed.
+
+    The advice is printed as JSON, and the command exits with an error if
+    any indexes are missing, unless --create is used to create them.
+    """
+    columns = {}
+    for column, used_as in [(id_field, "id_field"), (type_field, "type_field")] + [(p, "property") for p in properties]:
+        if column:
+            columns.setdefault(column, []).append(used_as)
+    if not columns:
+        msg = "Select at least one field to check, eg --type-field or --property"
+        raise click.UsageError(msg)
+
+    conn = sqlite3.connect(database)
+    try:
+        advice = advise_filter_indexes(conn, table, columns)
+        if create:
+            create_filter_indexes(conn, advice)
+            advice = advise_filter_indexes(conn, table, columns)
+    except (ReconcileError, sqlite3.Error) as e:
+        raise click.ClickException(str(e)) from e
+    finally:
+        conn.close()
+
+    click.echo(json.dumps(advice, indent=2))
+    if not all(item["indexed"] for item in advice):
+        raise click.exceptions.Exit(1)
+
+
+@click.command(name="reconcile-replay")
+@click.argument("recording", type=click.Path(exists=True, dir_okay=False))
+@click.option("--url", default="http://127.0.0.1:8001", show_default=True, help="URL of the Datasette instance")
+@click.option(
+    "--concurrency", default=1, show_default=True, type=click.IntRange(min=1), help="Requests to send at the same time"
+)
+@click.option("--rate", type=click.FloatRange(min=0, min_open=True), help="Requests to start each second")
+@click.option("--timeout", default=60.0, show_default=True, help="Seconds to wait for each response")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Save each response to this JSON lines file")
+@click.option(
+    "--compare",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Compare the responses with those saved by an earlier replay",
+)
+def reconcile_replay(recording, url, concurrency, rate, timeout, output, compare):  # noqa: PLR0917
+    """
+    Replay requests recorded by datasette-reconcile against a Datasette instance.
+
+    A summary of the throughput and latency is printed as JSON. Replaying
+    the same recording against two versions of the plugin with --output and
+    then --compare shows which queries get different results.
+    """
+    entries = list(load_recording(recording))
+
+    async def run():
+        async with httpx.AsyncClient(base_url=url, timeout=timeout) as client:
+            return await replay(client, entries, concurrency, rate)
+
+    try:
+        results, elapsed = asyncio.run(run())
+    except httpx.HTTPError as e:
+        raise click.ClickException(str(e)) from e
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(dumps(result) + "\n")
+
+    report = {"summary": summarise(results, elapsed)}
+    if compare:
+        report["diff"] = diff_results(list(load_recording(compare)), results)
+    click.echo(json.dumps(report, indent=2))
+
+
+def _parse_property(value):
+    property_id, _, column = value.partition("=")
+    return property_id, column or property_id
+
+
+@click.command(name="reconcile")
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("table")
+@click.argument("input_path", metavar="INPUT", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False))
+@click.option("--column", required=True, help="Column of the input with the names to reconcile")
+@click.option("--id-column", help="Column of the input identifying each row, copied to the output")
+@click.option("--type-column", help="Column of the input with the type to filter each row on")
+@click.option("--type", "type_", help="Type to filter every row on")
+@click.option("properties", "--property", multiple=True, help="Property filter as PROPERTY=COLUMN (can be repeated)")
+@click.option("--limit", type=click.IntRange(min=1), help="Number of results for each row")
+@click.option(
+    "-m",
+    "--metadata",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Datasette metadata file with the plugin configuration for the table",
+)
+@click.option("--name-field", help="Field containing the names to match against")
+@click.option("--id-field", help="Field containing the identifier for each record")
+@click.option("--type-field", help="Field containing the type of each record")
+@click.option("--execution-mode", type=click.Choice(EXECUTION_MODES), help="How each batch of queries is run")
+@click.option("--workers", type=click.IntRange(min=1), help="Number of worker processes [default: number of CPUs]")
+@click.option("--batch-size", default=100, show_default=True, type=click.IntRange(min=1), help="Rows in each batch")
+@click.option(
+    "--sql-time-limit-ms",
+    default=DEFAULT_BULK_SQL_TIME_LIMIT_MS,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Time limit for each SQL query",
+)
+@click.option("--resume", is_flag=True, help="Carry on from the checkpoint left by an interrupted run")
+@click.option("--checkpoint", type=click.Path(dir_okay=False), help="Checkpoint file [default: OUTPUT.checkpoint]")
+def reconcile_bulk(  # noqa: PLR0917
+    database,
+    table,
+    input_path,
+    output,
+    column,
+    id_column,
+    type_column,
+    type_,
+    properties,
+    limit,
+    metadata,
+    name_field,
+    id_field,
+    type_field,
+    execution_mode,
+    workers,
+    batch_size,
+    sql_time_limit_ms,
+    resume,
+    checkpoint,
+):
+    """
+    Reconcile each row of a CSV or JSON lines INPUT file against TABLE in DATABASE.
+
+    The plugin configuration is taken from the --metadata file, and/or the
+    field options. The results for each row are written to OUTPUT in the
+    same order as the input. A JSON lines OUTPUT gets all the results for
+    each row, while a CSV gets the best match.
+
+    A checkpoint is saved after each batch, so if the command is
+    interrupted it can be run again with --resume to carry on where it
+    stopped.
+    """
+    metadata_dict = None
+    if metadata:
+        with open(metadata, encoding="utf-8") as f:
+            metadata_dict = parse_metadata(f.read())
+    overrides = {
+        "name_field": name_field,
+        "id_field": id_field,
+        "type_field": type_field,
+        "execution_mode": execution_mode,
+    }
+    try:
+        config = get_bulk_config(database, table, metadata_dict, overrides)
+    except (ReconcileError, TypeError, NotFound) as e:
+        raise click.ClickException(str(e)) from e
+
+    writer = BulkWriter(output, checkpoint or f"{output}.checkpoint", resume=resume)
+    if writer.rows:
+        click.echo(f"Resuming after row {writer.rows:,}", err=True)
+    query_options = {
+        "column": column,
+        "id_column": id_column,
+        "type_column": type_column,
+        "type_": type_,
+        "properties": [_parse_property(p) for p in properties],
+        "limit": limit,
+    }
+    finished = False
+    try:
+        rows = run_bulk(
+            read_rows(input_path),
+            database,
+            table,
+            config,
+            writer,
+            metadata=metadata_dict,
+            workers=workers,
+            batch_size=batch_size,
+            sql_time_limit_ms=sql_time_limit_ms,
+            query_options=query_options,
+        )
+        finished = True
+    finally:
+        writer.close(finished=finished)
+    click.echo(f"Reconciled {rows:,} rows", err=True)
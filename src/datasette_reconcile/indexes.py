@@ -0,0 +1,241 @@
+import sqlite3
+
+from datasette.utils import escape_sqlite
+
+from datasette_reconcile.settings import TRIGRAM_SQLITE_VERSION
+from datasette_reconcile.utils import ReconcileError, get_names_table, get_trigram_table
+
+TRIGGER_SUFFIXES = ("_ai", "_ad", "_au")
+
+
+def _quote_string(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def _table_exists(conn, name):
+    return bool(conn.execute("select 1 from sqlite_master where name = ?", [name]).fetchall())
+
+
+def _check_table(conn, table):
+    if not _table_exists(conn, table):
+        msg = f"Table not found: {table}"
+        raise ReconcileError(msg)
+
+
+def _drop_index_sql(index_table):
+    statements = [f"DROP TRIGGER IF EXISTS {escape_sqlite(index_table + suffix)};" for suffix in TRIGGER_SUFFIXES]
+    statements.append(f"DROP TABLE IF EXISTS {escape_sqlite(index_table)};")
+    return "\n".join(statements)
+
+
+def _index_status(conn, table, index_table, rows_table):
+    """
+    Basic status of an index table kept up to date by triggers.
+
+    The index is stale if any of its triggers are missing, or if it holds a
+    different number of rows to the source table.
+    """
+    status = {
+        "table": table,
+        "index": index_table,
+        "exists": _table_exists(conn, index_table),
+        "stale": True,
+    }
+    if not status["exists"]:
+        return status
+
+    triggers = all(_table_exists(conn, f"{index_table}{suffix}") for suffix in TRIGGER_SUFFIXES)
+    status["rows"] = conn.execute(f"SELECT count(*) FROM {escape_sqlite(rows_table)}").fetchone()[0]  # noqa: S608
+    status["source_rows"] = conn.execute(f"SELECT count(*) FROM {escape_sqlite(table)}").fetchone()[0]  # noqa: S608
+    status["stale"] = not triggers or status["rows"] != status["source_rows"]
+    return status
+
+
+def build_trigram_index(conn, table, name_field):
+    """
+    Create (or recreate) a trigram index on the name field of a table.
+
+    The index is an FTS5 table using the trigram tokenizer, with the source
+    table as its external content. Triggers keep it up to date when rows are
+    inserted, updated or deleted.
+
+    The content table is given as a single quoted string so that Datasette
+    does not pick up the index as the table's full text search table.
+    """
+    if sqlite3.sqlite_version_info < TRIGRAM_SQLITE_VERSION:
+        msg = "Trigram indexes need SQLite version 3.34.0 or later"
+        raise ReconcileError(msg)
+    _check_table(conn, table)
+
+    index_table = get_trigram_table(table)
+    conn.executescript(
+        """
+        BEGIN;
+        {drop_sql}
+        CREATE VIRTUAL TABLE {index} USING fts5(
+            {name_field}, content={content}, content_rowid='rowid', tokenize='trigram'
+        );
+        CREATE TRIGGER {trigger_ai} AFTER INSERT ON {table} BEGIN
+            INSERT INTO {index}(rowid, {name_field}) VALUES (new.rowid, new.{name_field});
+        END;
+        CREATE TRIGGER {trigger_ad} AFTER DELETE ON {table} BEGIN
+            INSERT INTO {index}({index}, rowid, {name_field}) VALUES ('delete', old.rowid, old.{name_field});
+        END;
+        CREATE TRIGGER {trigger_au} AFTER UPDATE ON {table} BEGIN
+            INSERT INTO {index}({index}, rowid, {name_field}) VALUES ('delete', old.rowid, old.{name_field});
+            INSERT INTO {index}(rowid, {name_field}) VALUES (new.rowid, new.{name_field});
+        END;
+        INSERT INTO {index}({index}) VALUES ('rebuild');
+        COMMIT;
+        """.format(  # noqa: S608
+            drop_sql=_drop_index_sql(index_table),
+            index=escape_sqlite(index_table),
+            table=escape_sqlite(table),
+            name_field=escape_sqlite(name_field),
+            content=_quote_string(table),
+            trigger_ai=escape_sqlite(f"{index_table}_ai"),
+            trigger_ad=escape_sqlite(f"{index_table}_ad"),
+            trigger_au=escape_sqlite(f"{index_table}_au"),
+        )
+    )
+    return trigram_index_status(conn, table, name_field)
+
+
+def drop_trigram_index(conn, table):
+    conn.executescript(_drop_index_sql(get_trigram_table(table)))
+
+
+def trigram_index_status(conn, table, name_field):
+    """
+    Report whether the trigram index for a table exists and is up to date.
+
+    As well as the checks in `_index_status`, the index is stale if it
+    indexes a different column.
+    """
+    index_table = get_trigram_table(table)
+    status = _index_status(conn, table, index_table, f"{index_table}_docsize")
+    if status["exists"]:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({escape_sqlite(index_table)})")]
+        status["stale"] = status["stale"] or columns != [name_field]
+    return status
+
+
+def build_names_index(conn, table, name_field):
+    """
+    Create (or recreate) an index of normalised names for exact matching.
+
+    The names are stored in a shadow table with the same rowid as the source
+    row, normalised with `lower(trim(name))`, and with a B-tree index on
+    them. Triggers keep it up to date when rows are inserted, updated or
+    deleted.
+    """
+    _check_table(conn, table)
+
+    index_table = get_names_table(table)
+    conn.executescript(
+        """
+        BEGIN;
+        {drop_sql}
+        CREATE TABLE {index} (rowid INTEGER PRIMARY KEY, name TEXT);
+        CREATE INDEX {name_index} ON {index} (name);
+        CREATE TRIGGER {trigger_ai} AFTER INSERT ON {table} BEGIN
+            INSERT INTO {index} (rowid, name) VALUES (new.rowid, lower(trim(new.{name_field})));
+        END;
+        CREATE TRIGGER {trigger_ad} AFTER DELETE ON {table} BEGIN
+            DELETE FROM {index} WHERE rowid = old.rowid;
+        END;
+        CREATE TRIGGER {trigger_au} AFTER UPDATE ON {table} BEGIN
+            DELETE FROM {index} WHERE rowid = old.rowid;
+            INSERT INTO {index} (rowid, name) VALUES (new.rowid, lower(trim(new.{name_field})));
+        END;
+        INSERT INTO {index} (rowid, name) SELECT rowid, lower(trim({name_field})) FROM {table};
+        COMMIT;
+        """.format(  # noqa: S608
+            drop_sql=_drop_index_sql(index_table),
+            index=escape_sqlite(index_table),
+            name_index=escape_sqlite(f"{index_table}_name"),
+            table=escape_sqlite(table),
+            name_field=escape_sqlite(name_field),
+            trigger_ai=escape_sqlite(f"{index_table}_ai"),
+            trigger_ad=escape_sqlite(f"{index_table}_ad"),
+            trigger_au=escape_sqlite(f"{index_table}_au"),
+        )
+    )
+    return names_index_status(conn, table, name_field)
+
+
+def drop_names_index(conn, table):
+    conn.executescript(_drop_index_sql(get_names_table(table)))
+
+
+def names_index_status(conn, table, name_field):
+    """
+    Report whether the normalised names index for a table exists and is up to date.
+
+    As well as the checks in `_index_status`, the index is stale if its
+    triggers read a different column.
+    """
+    index_table = get_names_table(table)
+    status = _index_status(conn, table, index_table, index_table)
+    if status["exists"]:
+        trigger = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", [f"{index_table}_ai"]
+        ).fetchone()
+        uses_name_field = bool(trigger) and f"new.{escape_sqlite(name_field)}" in trigger[0]
+        status["stale"] = status["stale"] or not uses_name_field
+    return status
+
+
+def get_filter_index_name(table, column):
+    return f"idx_{table}_{column}"
+
+
+def get_filter_sql(table, column):
+    """
+    A representative statement filtering on a column, like those used for type and property filters.
+    """
+    return f"SELECT * FROM {escape_sqlite(table)} WHERE {escape_sqlite(column)} IN (?, ?)"  # noqa: S608
+
+
+def get_query_plan(conn, sql, params):
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def advise_filter_indexes(conn, table, columns):
+    """
+    Check whether filtering on each column can use an index.
+
+    `columns` is a dict of column name to a list of how the column is used
+    (eg `type_field` or `property`). Each column is checked by running
+    `EXPLAIN QUERY PLAN` on a representative filter, and it is counted as
+    indexed if SQLite searches the table rather than scanning it.
+    """
+    _check_table(conn, table)
+    advice = []
+    for column, used_as in columns.items():
+        plan = get_query_plan(conn, get_filter_sql(table, column), [None, None])
+        indexed = any(detail.startswith("SEARCH") for detail in plan)
+        create_sql = None
+        if not indexed:
+            index = escape_sqlite(get_filter_index_name(table, column))
+            create_sql = f"CREATE INDEX IF NOT EXISTS {index} ON {escape_sqlite(table)} ({escape_sqlite(column)});"
+        advice.append(
+            {
+                "column": column,
+                "used_as": sorted(set(used_as)),
+                "indexed": indexed,
+                "query_plan": plan,
+                "create_sql": create_sql,
+            }
+        )
+    return advice
+
+
+def create_filter_indexes(conn, advice):
+    """
+    Create the missing indexes reported by `advise_filter_indexes`.
+    """
+    statements = [item["create_sql"] for item in advice if item["create_sql"]]
+    if statements:
+        conn.executescript("BEGIN;\n" + "\n".join(statements) + "\nCOMMIT;")
+    return statements
@@ -0,0 +1,139 @@
+import asyncio
+import secrets
+import time
+
+from datasette_reconcile.admission import AdmissionError
+from datasette_reconcile.settings import (
+    DEFAULT_JOB_CONCURRENCY,
+    DEFAULT_JOB_RETENTION,
+    DEFAULT_MAX_ACTIVE_JOBS,
+    DEFAULT_MAX_KEPT_JOBS,
+    DEFAULT_RETRY_AFTER,
+    STREAM_CHUNK_SIZE,
+)
+
+
+class ReconcileJob:
+    """
+    A batch of reconcile queries run in the background.
+
+    Results are added to `results` as each chunk of queries is finished,
+    in the order they were completed, so clients can page through them
+    while the job is still running.
+    """
+
+    def __init__(self, database, table, queries):
+        self.id = secrets.token_urlsafe(16)
+        self.database = database
+        self.table = table
+        self.queries = queries
+        self.total = len(queries)
+        self.results = []
+        self.status = "queued"
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self, retention):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "queries": self.total,
+            "completed": len(self.results),
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "expires": self.finished + retention if self.finished is not None else None,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    Runs reconcile jobs in the background, keeping finished jobs until they expire.
+
+    At most `concurrency` jobs run at once, and the rest wait in the order
+    they were submitted. No more than `max_active` jobs can be queued or
+    running at once; further jobs are turned away until one finishes.
+    Finished jobs are removed `retention` seconds after they finish, or
+    sooner (oldest first) if more than `max_kept` are being kept, the next
+    time a job is submitted or looked up.
+    """
+
+    def __init__(
+        self,
+        concurrency=DEFAULT_JOB_CONCURRENCY,
+        retention=DEFAULT_JOB_RETENTION,
+        metrics=None,
+        *,
+        max_active=DEFAULT_MAX_ACTIVE_JOBS,
+        max_kept=DEFAULT_MAX_KEPT_JOBS,
+        retry_after=DEFAULT_RETRY_AFTER,
+    ):
+        self.concurrency = concurrency
+        self.retention = retention
+        self.metrics = metrics
+        self.max_active = max_active
+        self.max_kept = max_kept
+        self.retry_after = retry_after
+        self.jobs = {}
+        self._semaphore = None
+        # references to the running tasks, so they aren't garbage collected
+        self._tasks = set()
+
+    def submit(self, api, queries):
+        """
+        Start a job running `queries` with the given `ReconcileAPI`, and return it straight away.
+
+        Raises `AdmissionError` if `max_active` jobs are already queued or running.
+        """
+        self.expire()
+        active = sum(1 for job in self.jobs.values() if job.finished is None)
+        if active >= self.max_active:
+            msg = f"Too many background jobs queued or running (limit {self.max_active})"
+            raise AdmissionError(msg, 429, "max_active_jobs", self.retry_after)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        job = ReconcileJob(api.database, api.table, queries)
+        self.jobs[job.id] = job
+        task = asyncio.create_task(self._run(job, api))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._increment("submitted")
+        return job
+
+    def get(self, job_id, database, table):
+        self.expire()
+        job = self.jobs.get(job_id)
+        if job is None or (job.database, job.table) != (database, table):
+            return None
+        return job
+
+    def expire(self):
+        now = time.time()
+        finished = sorted((job for job in self.jobs.values() if job.finished is not None), key=lambda job: job.finished)
+        for i, job in enumerate(finished):
+            if job.finished + self.retention <= now or len(finished) - i > self.max_kept:
+                del self.jobs[job.id]
+
+    async def _run(self, job, api):
+        async with self._semaphore:
+            job.status = "running"
+            job.started = time.time()
+            try:
+                async for query_id, result in api._reconcile_queries(job.queries, chunk_size=STREAM_CHUNK_SIZE):
+                    job.results.append((query_id, result))
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+            else:
+                job.status = "finished"
+            job.finished = time.time()
+            # the queries aren't needed once the results are in
+            job.queries = None
+            self._increment(job.status)
+
+    def _increment(self, status):
+        if self.metrics is not None:
+            self.metrics.increment("reconcile_jobs_total", status=status)
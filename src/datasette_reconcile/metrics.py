@@ -0,0 +1,156 @@
+import bisect
+from collections import Counter
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRIC_HELP = {
+    "reconcile_requests_total": "Requests to the reconciliation endpoints.",
+    "reconcile_request_duration_seconds": "Time taken to respond to a request.",
+    "reconcile_stage_duration_seconds": "Time spent in each stage of a request, such as SQL queries and scoring.",
+    "reconcile_batch_size": "Number of queries in each reconcile request.",
+    "reconcile_query_duration_seconds": "Time taken to find the results for each reconcile query.",
+    "reconcile_candidates": "Number of candidates scored for each reconcile query.",
+    "reconcile_extend_ids": "Number of ids in each extend request.",
+    "reconcile_queries_total": "Reconcile queries received.",
+    "reconcile_queries_unique_total": "Reconcile queries run after removing duplicates.",
+    "reconcile_property_filters_total": "Reconcile queries filtering on each property.",
+    "reconcile_jobs_total": "Background reconcile jobs submitted, and finished with each status.",
+    "reconcile_rejected_requests_total": "Requests turned away by the admission limits, by reason.",
+    "reconcile_cache_hits_total": "Lookups found in each in-process cache.",
+    "reconcile_cache_misses_total": "Lookups not found in each in-process cache.",
+    "reconcile_cache_evictions_total": "Entries removed from each in-process cache to make space.",
+    "reconcile_cache_entries": "Entries held in each in-process cache.",
+    "reconcile_cache_hit_ratio": "Proportion of lookups found in each in-process cache.",
+}
+
+
+class Histogram:
+    """
+    Counts of observed values in a fixed set of buckets, with their total.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        # the last count is for values greater than every bucket
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def cumulative(self):
+        """
+        Yield the upper bound of each bucket and the number of values less than or equal to it.
+        """
+        total = 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """
+    Low overhead in-process counters and histograms, optionally split by labels.
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def get(self, name, **labels):
+        return self.counters[(name, tuple(sorted(labels.items())))]
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, count=1, **labels):
+        """
+        Add `count` observations of a value to a histogram, creating it with the given buckets if needed.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value, count)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def labels(self, name, **labels):
+        """
+        Yield the labels and value of each counter with this name that has all of the given labels.
+        """
+        for (counter_name, label_items), value in self.counters.items():
+            counter_labels = dict(label_items)
+            if counter_name == name and all(counter_labels.get(k) == v for k, v in labels.items()):
+                yield counter_labels, value
+
+    def dedup_ratio(self):
+        """
+        Proportion of reconcile queries that were duplicates of another query in the same batch.
+        """
+        total = self.get("reconcile_queries_total")
+        if not total:
+            return 0
+        return 1 - self.get("reconcile_queries_unique_total") / total
+
+
+def _format_labels(label_items):
+    if not label_items:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in label_items
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(metrics, cache_stats=None):
+    """
+    Render the counters and histograms in the Prometheus text exposition format.
+
+    `cache_stats` is a dict of cache name to a dict of `hits`, `misses`,
+    `evictions` and `entries`, which are added as metrics with a `cache`
+    label.
+    """
+    families = {}
+    for (name, label_items), value in metrics.counters.items():
+        families.setdefault((name, "counter"), []).append((label_items, value))
+    for (name, label_items), histogram in metrics.histograms.items():
+        families.setdefault((name, "histogram"), []).append((label_items, histogram))
+    for cache, stats in sorted((cache_stats or {}).items()):
+        lookups = stats["hits"] + stats["misses"]
+        for name, type_, value in [
+            ("reconcile_cache_hits_total", "counter", stats["hits"]),
+            ("reconcile_cache_misses_total", "counter", stats["misses"]),
+            ("reconcile_cache_evictions_total", "counter", stats["evictions"]),
+            ("reconcile_cache_entries", "gauge", stats["entries"]),
+            ("reconcile_cache_hit_ratio", "gauge", stats["hits"] / lookups if lookups else 0),
+        ]:
+            families.setdefault((name, type_), []).append(((("cache", cache),), value))
+
+    lines = []
+    for (name, type_), samples in sorted(families.items()):
+        if name in METRIC_HELP:
+            lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+        lines.append(f"# TYPE {name} {type_}")
+        for label_items, value in sorted(samples, key=lambda sample: sample[0]):
+            if type_ != "histogram":
+                lines.append(f"{name}{_format_labels(label_items)} {_format_value(value)}")
+                continue
+            for bound, count in value.cumulative():
+                bucket_labels = _format_labels((*label_items, ("le", _format_value(bound))))
+                lines.append(f"{name}_bucket{bucket_labels} {count}")
+            lines.append(f"{name}_sum{_format_labels(label_items)} {_format_value(value.sum)}")
+            lines.append(f"{name}_count{_format_labels(label_items)} {value.count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import json
+
+from datasette.utils import escape_sqlite
+
+from datasette_reconcile.queries import MAX_UNICODE_CHARACTER, get_sql_normalised_name
+from datasette_reconcile.settings import DEFAULT_PREFIX_INDEX_MAX_ROWS, DEFAULT_TYPE, PREFIX_INDEX_CACHE_ROWS
+from datasette_reconcile.state import get_state
+from datasette_reconcile.utils import get_data_version
+
+KEYSET_LENGTH = 2
+
+
+class PrefixIndex:
+    """
+    An in-memory index of the names in a table, for looking up names by prefix.
+
+    Names are normalised in the same way as the normalised names index, and
+    kept in a sorted list of `(name, rowid)` keys so a prefix can be found
+    with a binary search. The keys double as the keyset used for paging
+    through the results, so cursors are the same as when using the
+    normalised names index.
+    """
+
+    def __init__(self, rows):
+        entries = sorted((get_sql_normalised_name(name), rowid, id_value, name) for rowid, id_value, name in rows)
+        self.keys = [(entry[0], entry[1]) for entry in entries]
+        self.values = [(entry[2], entry[3]) for entry in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, prefix, limit, after=None, offset=0):
+        """
+        Return up to `limit` (keyset, id, name) tuples for names starting with the normalised prefix.
+
+        Results start after the keyset `after` if given, and then skip `offset` names.
+        """
+        start = bisect.bisect_left(self.keys, (prefix,))
+        if after:
+            if len(after) != KEYSET_LENGTH or not isinstance(after[0], str) or not isinstance(after[1], int):
+                msg = "Cursor does not match this table's indexes"
+                raise ValueError(msg)
+            start = max(start, bisect.bisect_right(self.keys, tuple(after)))
+        start += offset
+        end = bisect.bisect_left(self.keys, (prefix + MAX_UNICODE_CHARACTER,), lo=min(start, len(self.keys)))
+        return [(list(self.keys[i]), *self.values[i]) for i in range(start, min(end, start + limit))]
+
+
+async def get_prefix_index(datasette, database, table, config):
+    """
+    Return the in-memory prefix index for a table, building it if needed.
+
+    The index is built the first time it is used, and again whenever the
+    database changes. If the table has more than `prefix_index_max_rows`
+    rows (or is a view) `None` is returned, and the caller should fall back
+    to using SQL. Each table's index is built by one request at a time,
+    while requests for other tables carry on. The indexes kept in memory
+    hold no more than `PREFIX_INDEX_CACHE_ROWS` rows between them, with the
+    least recently used dropped first.
+    """
+    db = datasette.get_database(database)
+    state = get_state(datasette)
+    table_key = (database, table, config["id_field"], config["name_field"])
+    key = (*table_key, json.dumps(await get_data_version(db)))
+    lock = state.prefix_index_locks.get(table_key)
+    if lock is None:
+        lock = asyncio.Lock()
+        state.prefix_index_locks[table_key] = lock
+
+    async with lock:
+        if key in state.prefix_indexes:
+            return state.prefix_indexes.get(key)
+
+        prefix_index = None
+        if await db.table_exists(table):
+            # an index too big for the cache would be dropped straight after being built
+            max_rows = min(config.get("prefix_index_max_rows", DEFAULT_PREFIX_INDEX_MAX_ROWS), PREFIX_INDEX_CACHE_ROWS)
+            query_sql = """
+                SELECT rowid, {id_field}, {name_field} FROM {table}
+                WHERE {name_field} IS NOT NULL
+                LIMIT {limit}""".format(  # noqa: S608
+                id_field=escape_sqlite(config["id_field"]),
+                name_field=escape_sqlite(config["name_field"]),
+                table=escape_sqlite(table),
+                limit=max_rows + 1,
+            )
+
+            def build(conn):
+                rows = conn.execute(query_sql).fetchall()
+                if len(rows) > max_rows:
+                    return None
+                return PrefixIndex(rows)
+
+            # reading and sorting the names is done in a database thread
+            # to avoid blocking the event loop
+            prefix_index = await db.execute_fn(build)
+
+        # drop any index for an older version of the table
+        for old_key in [k for k in state.prefix_indexes.keys() if k[:4] == table_key]:
+            state.prefix_indexes.pop(old_key)
+        state.prefix_indexes.set(key, prefix_index, len(prefix_index) if prefix_index is not None else 0)
+        return prefix_index
+
+
+class TypeIndex:
+    """
+    The distinct values of the type field in a table, with the number of rows of each.
+
+    Types are kept sorted by their lower case value, so types starting with
+    some text can be found with a binary search before looking for types
+    that contain it.
+    """
+
+    def __init__(self, counts):
+        entries = sorted((str(type_).lower(), type_, count) for type_, count in counts)
+        self.keys = [entry[0] for entry in entries]
+        self.types = [entry[1] for entry in entries]
+        self.counts = [entry[2] for entry in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, text, limit):
+        """
+        Return up to `limit` types starting with the text, followed by types containing it, ignoring case.
+        """
+        text = str(text).lower()
+        start = bisect.bisect_left(self.keys, text)
+        end = bisect.bisect_left(self.keys, text + MAX_UNICODE_CHARACTER, lo=start)
+        results = self.types[start:end][:limit]
+        if len(results) < limit:
+            results.extend(
+                type_ for key, type_ in zip(self.keys, self.types) if text in key and not key.startswith(text)
+            )
+        return results[:limit]
+
+    def most_common(self, limit):
+        """
+        Return the `limit` types found in the most rows.
+        """
+        ranked = sorted(range(len(self.types)), key=lambda i: (-self.counts[i], self.keys[i]))
+        return [self.types[i] for i in ranked[:limit]]
+
+
+async def get_type_index(datasette, database, table, config, execute=None):
+    """
+    Return the index of the types in a table, building it if needed.
+
+    The distinct types are found with a `GROUP BY` query the first time they
+    are needed, and again whenever the database changes. Rows without a type
+    are counted as the first `type_default`. The query is run with `execute`
+    if given, otherwise with the database's `execute` method.
+    """
+    db = datasette.get_database(database)
+    default_type = config.get("type_default", [DEFAULT_TYPE])[0]["id"]
+    key = (
+        database,
+        table,
+        config["type_field"],
+        default_type,
+        json.dumps(await get_data_version(db)),
+    )
+    cache = get_state(datasette).type_indexes
+    type_index = cache.get(key)
+    if type_index is None:
+        query_sql = """
+            SELECT coalesce({type_field}, :default_type) AS type, count(*) AS count
+            FROM {table}
+            GROUP BY type""".format(  # noqa: S608
+            type_field=escape_sqlite(config["type_field"]),
+            table=escape_sqlite(table),
+        )
+        results = await (execute or db.execute)(query_sql, {"default_type": default_type})
+        type_index = TypeIndex((r["type"], r["count"]) for r in results)
+        for old_key in [k for k in cache.keys() if k[:4] == key[:4]]:
+            cache.pop(old_key)
+        cache.set(key, type_index)
+    return type_index
@@ -0,0 +1,525 @@
+import hashlib
+import json
+import sqlite3
+import string
+
+from datasette.utils import escape_fts, escape_sqlite
+
+from datasette_reconcile.settings import (
+    DEFAULT_LIMIT,
+    MATERIALIZED_SQLITE_VERSION,
+    TRIGRAM_FALLBACK_MAX_ROWS,
+    TRIGRAM_LENGTH,
+)
+from datasette_reconcile.utils import get_select_fields
+
+BATCH_QUERY_ID = "__reconcile_query_id"
+BATCH_QUERY_RANK = "__reconcile_query_rank"
+BATCH_QUERY_LIMIT = "__reconcile_query_limit"
+EXACT_MATCH_NAME = "__reconcile_exact_name"
+SUGGEST_KEY = "__reconcile_suggest_key"
+MAX_UNICODE_CHARACTER = chr(0x10FFFF)
+ASCII_LOWERCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def get_query_limit(config, query):
+    return min(
+        query.get("limit", config.get("max_limit", DEFAULT_LIMIT)),
+        config.get("max_limit", DEFAULT_LIMIT),
+    )
+
+
+def get_candidate_limit(config, query):
+    """
+    Number of candidates to fetch from the database for a query.
+
+    If `candidate_pool` is set, more candidates than the query limit are
+    fetched so that good fuzzy matches are not missed, and only the best
+    scoring results are kept.
+    """
+    return max(get_query_limit(config, query), config.get("candidate_pool", 0))
+
+
+def get_match_table(config, query):
+    """
+    Return the full text search table used to find candidates for a query.
+
+    If the table has no full text search index, a trigram index can be used
+    instead for queries long enough to contain a trigram. Otherwise `None` is
+    returned and the name field is searched with LIKE.
+    """
+    if config["fts_table"]:
+        return config["fts_table"]
+    if config.get("trigram_table") and len(str(query["query"]).strip()) >= TRIGRAM_LENGTH:
+        return config["trigram_table"]
+    return None
+
+
+def get_trigrams(text):
+    """
+    Return the distinct trigrams in a piece of text, in lower case as they are held in the trigram index.
+    """
+    text = str(text).strip().lower()
+    return list(dict.fromkeys(text[i : i + TRIGRAM_LENGTH] for i in range(len(text) - TRIGRAM_LENGTH + 1)))
+
+
+def get_trigram_query(trigrams):
+    """
+    Turn a list of trigrams into an FTS5 query matching any of them.
+
+    Ordering the results by rank puts rows sharing the most trigrams with the
+    query first, so near misses (eg typos) are found.
+    """
+    return " OR ".join('"{}"'.format(trigram.replace('"', '""')) for trigram in trigrams)
+
+
+def get_trigram_vocab_sql(config, trigrams):
+    """
+    Build the SQL to count the rows containing each trigram, using an `fts5vocab` table over the trigram index.
+
+    The vocab table is created in the temp schema, so this works with
+    read-only databases. Returns the SQL to create it and the SQL and
+    parameters to look up the counts.
+    """
+    vocab_table = escape_sqlite(f"{config['trigram_table']}_vocab")
+    create_sql = "CREATE VIRTUAL TABLE IF NOT EXISTS temp.{vocab_table} USING fts5vocab(main, {trigram_table}, row)"
+    create_sql = create_sql.format(vocab_table=vocab_table, trigram_table=escape_sqlite(config["trigram_table"]))
+    params = {f"trigram{index}": trigram for index, trigram in enumerate(trigrams)}
+    query_sql = "SELECT term, doc FROM temp.{vocab_table} WHERE term IN ({terms})".format(  # noqa: S608
+        vocab_table=vocab_table,
+        terms=", ".join(f":{key}" for key in params),
+    )
+    return create_sql, query_sql, params
+
+
+def get_selective_trigrams(counts, max_rows=TRIGRAM_FALLBACK_MAX_ROWS):
+    """
+    Pick the rarest trigrams from a list of (trigram, rows) tuples.
+
+    Trigrams are picked while the rows containing them add up to at most
+    `max_rows`.
+    Ranking a search for these only has to look at a bounded number of
+    rows, however common the other trigrams in the query are.
+    """
+    selected = []
+    total = 0
+    for trigram, rows in sorted(counts, key=lambda count: count[1]):
+        if total + rows > max_rows:
+            break
+        selected.append(trigram)
+        total += rows
+    return selected
+
+
+def get_search_query(config, query):
+    match_table = get_match_table(config, query)
+    if match_table is None or match_table != config["fts_table"]:
+        # a LIKE query against the trigram index uses the index
+        return f"%{query['query']}%"
+    return escape_fts(query["query"])
+
+
+def get_query_types(config, query):
+    types = query.get("type", [])
+    if not isinstance(types, list) and types:
+        types = [types]
+    if not config.get("type_field"):
+        return []
+    return types
+
+
+def get_query_properties(query):
+    """
+    Return the property filters for a query as a list of (property_id, values) tuples.
+
+    Properties without a value are ignored.
+    """
+    properties = []
+    for prop in query.get("properties") or []:
+        if prop["v"]:
+            property_values = prop["v"]
+            if not isinstance(property_values, list):
+                property_values = [property_values]
+            properties.append((prop["pid"], property_values))
+    return properties
+
+
+def get_fts_from_clause(match_table, table):
+    # NB this will fail if the table name has non-alphanumeric
+    # characters in and sqlite3 version < 3.30.0
+    # see: https://www.sqlite.org/src/info/00e9a8f2730eb723
+    return """
+    {table}
+    inner join (
+            SELECT "rowid", "rank"
+            FROM {fts_table}
+            WHERE {fts_table} MATCH :search_query
+    ) as "a" on {table}."rowid" = a."rowid"
+    """.format(  # noqa: S608
+        table=escape_sqlite(table),
+        fts_table=escape_sqlite(match_table),
+    )
+
+
+def get_query_sql(config, table, query, trigrams=None):
+    """
+    Build the SQL and parameters used to find candidates for a single query.
+
+    If `trigrams` is given the trigram index is searched for rows containing
+    any of them, ordered by rank, rather than for the query as a substring.
+    """
+    select_fields = get_select_fields(config)
+    limit = get_candidate_limit(config, query)
+
+    where_clauses = ["1"]
+    from_clause = escape_sqlite(table)
+    order_by = ""
+    params = {"search_query": get_search_query(config, query)}
+    match_table = get_match_table(config, query)
+    if trigrams:
+        from_clause = get_fts_from_clause(config["trigram_table"], table)
+        order_by = "order by a.rank"
+        params["search_query"] = get_trigram_query(trigrams)
+    elif match_table and match_table == config["fts_table"]:
+        from_clause = get_fts_from_clause(match_table, table)
+        order_by = "order by a.rank"
+    elif match_table:
+        where_clauses.append(
+            "{table}.rowid IN (SELECT rowid FROM {trigram_table} WHERE {name_field} LIKE :search_query)".format(  # noqa: S608
+                table=escape_sqlite(table),
+                trigram_table=escape_sqlite(match_table),
+                name_field=escape_sqlite(config["name_field"]),
+            )
+        )
+    else:
+        where_clauses.append(
+            "{search_col} like :search_query".format(
+                search_col=escape_sqlite(config["name_field"]),
+            )
+        )
+
+    types = get_query_types(config, query)
+    if types:
+        type_values = {f"type_value{index}": t for index, t in enumerate(types)}
+        where_clauses.append(
+            "{type_field} in ({type_values})".format(
+                type_field=escape_sqlite(config["type_field"]),
+                type_values=", ".join([f":{value}" for value in type_values.keys()]),
+            )
+        )
+        params = {**params, **type_values}
+
+    for index, (property_id, values) in enumerate(get_query_properties(query)):
+        property_values = {f"property_value{index}_{i}": v for i, v in enumerate(values)}
+        where_clauses.append(
+            "{property_id} in ({property_values})".format(
+                property_id=escape_sqlite(property_id),
+                property_values=", ".join([f":{value}" for value in property_values.keys()]),
+            )
+        )
+        params = {**params, **property_values}
+
+    query_sql = """
+        SELECT {select_fields}
+        FROM {from_clause}
+        WHERE {where_clause} {order_by}
+        LIMIT {limit}""".format(  # noqa: S608
+        select_fields=",".join([escape_sqlite(f) for f in select_fields]),
+        from_clause=from_clause,
+        where_clause=" and ".join(where_clauses),
+        order_by=order_by,
+        limit=limit,
+    )
+    return query_sql, params
+
+
+def get_batch_shape(config, query):
+    """
+    Queries can only share a batch statement if they search the same way and filter on the same properties.
+    """
+    return (
+        get_match_table(config, query),
+        bool(get_query_types(config, query)),
+        tuple(p[0] for p in get_query_properties(query)),
+    )
+
+
+def get_batch_sql(config, table, queries):
+    """
+    Build a single statement that finds candidates for a list of (query_id, query) tuples.
+
+    The queries are passed to SQLite as one JSON parameter. For each query a
+    correlated subquery finds the rowids of its top candidates, in rank
+    order, so the `LIMIT` stops each search early just as it does for a
+    single query. The candidate rows are then looked up by rowid. Every
+    query in the list must have the same shape (see `get_batch_shape`).
+    """
+    select_fields = get_select_fields(config)
+    match_table, has_types, property_ids = get_batch_shape(config, queries[0][1])
+
+    batch = [
+        {
+            "query_id": query_id,
+            "search_query": get_search_query(config, query),
+            "query_limit": get_candidate_limit(config, query),
+            "types": get_query_types(config, query),
+            "properties": [values for _, values in get_query_properties(query)],
+        }
+        for query_id, query in queries
+    ]
+    # SQLite only allows a constant LIMIT in the subquery, so it uses the
+    # largest limit in the batch and the outer query trims each query's results
+    limit = max(b["query_limit"] for b in batch)
+
+    table_sql = escape_sqlite(table)
+    if match_table and match_table == config["fts_table"]:
+        fts_table = escape_sqlite(match_table)
+        from_clause = f'{fts_table} inner join {table_sql} on {table_sql}."rowid" = {fts_table}."rowid"'
+        order_by = f"order by {fts_table}.rank"
+        where_clauses = [f"{fts_table} MATCH batch.search_query"]
+    elif match_table:
+        from_clause = table_sql
+        order_by = ""
+        where_clauses = [
+            "{table}.rowid IN (SELECT rowid FROM {trigram_table} WHERE {name_field} LIKE batch.search_query)".format(  # noqa: S608
+                table=table_sql,
+                trigram_table=escape_sqlite(match_table),
+                name_field=escape_sqlite(config["name_field"]),
+            )
+        ]
+    else:
+        from_clause = table_sql
+        order_by = ""
+        where_clauses = [f"{table_sql}.{escape_sqlite(config['name_field'])} like batch.search_query"]
+
+    if has_types:
+        where_clauses.append(
+            "{table}.{type_field} in (select value from json_each(batch.types))".format(  # noqa: S608
+                table=table_sql,
+                type_field=escape_sqlite(config["type_field"]),
+            )
+        )
+    for index, property_id in enumerate(property_ids):
+        property_sql = escape_sqlite(property_id)
+        where_clauses.append(
+            f"{table_sql}.{property_sql} in (select value from json_each(batch.properties, '$[{index}]'))"  # noqa: S608
+        )
+
+    query_sql = """
+        WITH batch AS {materialized} (
+            SELECT
+                json_extract(value, '$.query_id') AS query_id,
+                json_extract(value, '$.search_query') AS search_query,
+                json_extract(value, '$.query_limit') AS query_limit,
+                json_extract(value, '$.types') AS types,
+                json_extract(value, '$.properties') AS properties
+            FROM json_each(:batch)
+        ),
+        candidates AS (
+            SELECT
+                batch.query_id AS query_id,
+                batch.query_limit AS query_limit,
+                ranked.key + 1 AS query_rank,
+                ranked.value AS candidate_rowid
+            FROM batch, json_each((
+                SELECT json_group_array(candidate_rowid) FROM (
+                    SELECT {table}."rowid" AS candidate_rowid
+                    FROM {from_clause}
+                    WHERE {where_clause} {order_by}
+                    LIMIT {limit}
+                )
+            )) AS ranked
+        )
+        SELECT
+            candidates.query_id AS {query_id},
+            candidates.query_limit AS {query_limit},
+            {select_fields},
+            candidates.query_rank AS {query_rank}
+        FROM candidates
+            INNER JOIN {table} ON {table}."rowid" = candidates.candidate_rowid
+        WHERE candidates.query_rank <= candidates.query_limit
+        ORDER BY {query_id}, {query_rank}""".format(  # noqa: S608
+        table=table_sql,
+        query_id=BATCH_QUERY_ID,
+        query_rank=BATCH_QUERY_RANK,
+        query_limit=BATCH_QUERY_LIMIT,
+        select_fields=",".join([f"{table_sql}.{escape_sqlite(f)}" for f in select_fields]),
+        from_clause=from_clause,
+        where_clause=" and ".join(where_clauses),
+        order_by=order_by,
+        limit=limit,
+        # otherwise the JSON is parsed again for every row of the table scanned
+        materialized="MATERIALIZED" if sqlite3.sqlite_version_info >= MATERIALIZED_SQLITE_VERSION else "",
+    )
+    return query_sql, {"batch": json.dumps(batch)}
+
+
+def get_sql_normalised_name(value):
+    """
+    Normalise a name in the same way as `lower(trim(name))` in SQLite.
+
+    SQLite's `trim` only removes spaces, and `lower` only changes the case of
+    ASCII characters.
+    """
+    return str(value).strip(" ").translate(ASCII_LOWERCASE)
+
+
+def get_sql_normalised_prefix(value):
+    """
+    Normalise a prefix to match names normalised with `get_sql_normalised_name`.
+
+    Only leading spaces are removed, as a trailing space is part of the prefix.
+    """
+    return str(value).lstrip(" ").translate(ASCII_LOWERCASE)
+
+
+def get_exact_match_sql(config, table, names, limit):
+    """
+    Build the SQL and parameters used to look up names in the normalised names index.
+
+    Up to `limit` rows are returned for each name.
+    """
+    select_fields = get_select_fields(config)
+    table_sql = escape_sqlite(table)
+    query_sql = """
+        SELECT exact.name AS {exact_name}, {select_fields}
+        FROM (
+            SELECT rowid, name, row_number() OVER (PARTITION BY name ORDER BY rowid) AS name_rank
+            FROM {names_table}
+            WHERE name IN (SELECT value FROM json_each(:names))
+        ) AS exact
+        INNER JOIN {table} ON {table}."rowid" = exact.rowid
+        WHERE exact.name_rank <= :limit""".format(  # noqa: S608
+        exact_name=EXACT_MATCH_NAME,
+        select_fields=",".join([f"{table_sql}.{escape_sqlite(f)}" for f in select_fields]),
+        names_table=escape_sqlite(config["names_table"]),
+        table=table_sql,
+    )
+    return query_sql, {"names": json.dumps(sorted(names)), "limit": limit}
+
+
+def get_fts_prefix_query(config, prefix):
+    """
+    Turn a prefix into a full text search query for words starting with it.
+
+    FTS5 puts the `*` after the quoted term, while FTS3 and FTS4 need it
+    inside the quotes.
+    """
+    query = escape_fts(prefix)
+    if not query:
+        return None
+    if config.get("fts_version") == "fts5":
+        return f"{query}*"
+    return f'{query[:-1]}*"'
+
+
+def get_suggest_entity_sql(config, table, prefix, after=None, offset=0):
+    """
+    Build the SQL and parameters used to find entities starting with a prefix.
+
+    Rows are returned in a fixed order, along with the values of the columns
+    they are ordered by (the keyset). The next page of results starts after
+    the keyset of the last row on this page (given as `after`), so skipped
+    rows don't need to be read again. `offset` is kept for clients that send
+    a numeric cursor.
+
+    Depending on the indexes available the prefix is looked up with a range
+    of the normalised names index, a prefix query on the full text search
+    index, the trigram index or `LIKE`.
+    """
+    table_sql = escape_sqlite(table)
+    name_field = escape_sqlite(config["name_field"])
+    normalised_prefix = get_sql_normalised_prefix(prefix)
+    fts_query = get_fts_prefix_query(config, prefix) if config["fts_table"] else None
+
+    if config.get("names_table") and normalised_prefix:
+        names_table = escape_sqlite(config["names_table"])
+        from_clause = f"{table_sql} INNER JOIN {names_table} ON {table_sql}.rowid = {names_table}.rowid"
+        where_clauses = [f"{names_table}.name >= :prefix", f"{names_table}.name < :prefix_end"]
+        params = {"prefix": normalised_prefix, "prefix_end": normalised_prefix + MAX_UNICODE_CHARACTER}
+        keyset = [f"{names_table}.name", f"{names_table}.rowid"]
+    elif fts_query:
+        from_clause = table_sql
+        where_clauses = [
+            "{table}.rowid IN (SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH :search_query)".format(  # noqa: S608
+                table=table_sql,
+                fts_table=escape_sqlite(config["fts_table"]),
+            )
+        ]
+        params = {"search_query": fts_query}
+        keyset = [f"{table_sql}.rowid"]
+    elif config.get("trigram_table") and len(prefix) >= TRIGRAM_LENGTH:
+        # LIKE queries against a trigram index can use the index
+        from_clause = table_sql
+        where_clauses = [
+            "{table}.rowid IN (SELECT rowid FROM {trigram_table} WHERE {name_field} LIKE :search_query)".format(  # noqa: S608
+                table=table_sql,
+                trigram_table=escape_sqlite(config["trigram_table"]),
+                name_field=name_field,
+            )
+        ]
+        params = {"search_query": f"{prefix}%"}
+        keyset = [f"{table_sql}.rowid"]
+    else:
+        from_clause = table_sql
+        where_clauses = [f"{table_sql}.{name_field} LIKE :search_query"]
+        params = {"search_query": f"{prefix}%"}
+        keyset = [f"{table_sql}.{escape_sqlite(config.get('id_field', 'id'))}"]
+
+    if after:
+        if len(after) != len(keyset):
+            msg = "Cursor does not match this table's indexes"
+            raise ValueError(msg)
+        after_params = {f"after{index}": value for index, value in enumerate(after)}
+        where_clauses.append(
+            "({keyset}) > ({after})".format(keyset=", ".join(keyset), after=", ".join(f":{p}" for p in after_params))
+        )
+        params = {**params, **after_params}
+
+    query_sql = """
+        SELECT {keyset_fields}, {table}.{id_field} AS id, {table}.{name_field} AS name
+        FROM {from_clause}
+        WHERE {where_clause}
+        ORDER BY {keyset}
+        LIMIT {limit} OFFSET {offset}""".format(  # noqa: S608
+        keyset_fields=", ".join(f"{field} AS {SUGGEST_KEY}{index}" for index, field in enumerate(keyset)),
+        table=table_sql,
+        id_field=escape_sqlite(config.get("id_field", "id")),
+        name_field=name_field,
+        from_clause=from_clause,
+        where_clause=" and ".join(where_clauses),
+        keyset=", ".join(keyset),
+        limit=DEFAULT_LIMIT,
+        offset=int(offset),
+    )
+    return query_sql, params
+
+
+def get_query_key(config, query):
+    """
+    Return a key shared by queries that will give the same results.
+
+    The query text is used exactly as sent, as it is searched for as given
+    (so eg "Cleo " finds different rows to "Cleo"). Only the order of the
+    property filters is ignored.
+    """
+    return json.dumps(
+        [
+            str(query["query"]),
+            get_query_types(config, query),
+            sorted(get_query_properties(query), key=lambda p: p[0]),
+            get_query_limit(config, query),
+        ],
+        default=repr,
+    )
+
+
+def get_result_cache_key(config, database, table, query):
+    """
+    Return the key for the cached results of a query.
+
+    This includes the exact query text, as sent to SQL, so results are
+    only shared between queries that run the same search.
+    """
+    key = json.dumps([database, table, config, get_query_key(config, query)], sort_keys=True, default=repr)
+    return hashlib.sha256(key.encode("utf8")).hexdigest()
@@ -1,27 +1,87 @@
+import asyncio
+import heapq
 import json
-
-from datasette.utils import escape_fts, escape_sqlite
-from datasette.utils.asgi import Response
-from fuzzywuzzy import fuzz
-
+import sqlite3
+import time
+
+from datasette.tracer import trace
+from datasette.utils import escape_sqlite, sqlite_timelimit
+from datasette.utils.asgi import AsgiStream, BadRequest, NotFound, Response
+
+from datasette_reconcile.admission import AdmissionError, get_client_id
+from datasette_reconcile.indexes import advise_filter_indexes, get_query_plan
+from datasette_reconcile.metrics import SIZE_BUCKETS
+from datasette_reconcile.prefix_index import get_prefix_index, get_type_index
+from datasette_reconcile.queries import (
+    BATCH_QUERY_ID,
+    EXACT_MATCH_NAME,
+    SUGGEST_KEY,
+    get_batch_shape,
+    get_batch_sql,
+    get_candidate_limit,
+    get_exact_match_sql,
+    get_match_table,
+    get_query_key,
+    get_query_limit,
+    get_query_properties,
+    get_query_sql,
+    get_query_types,
+    get_result_cache_key,
+    get_selective_trigrams,
+    get_sql_normalised_name,
+    get_sql_normalised_prefix,
+    get_suggest_entity_sql,
+    get_trigram_vocab_sql,
+    get_trigrams,
+)
+from datasette_reconcile.scoring import normalise_name, score_pairs
+from datasette_reconcile.serialisation import JSON_CONTENT_TYPE, NDJSON_CONTENT_TYPE, dumps, loads
 from datasette_reconcile.settings import (
+    DEFAULT_EXTEND_CHUNK_SIZE,
     DEFAULT_IDENTIFER_SPACE,
+    DEFAULT_JOB_PAGE_SIZE,
     DEFAULT_LIMIT,
+    DEFAULT_MAX_JOB_SIZE,
     DEFAULT_SCHEMA_SPACE,
     DEFAULT_TYPE,
+    MANIFEST_CACHE_CONTROL,
+    MAX_DEFAULT_TYPES,
+    MAX_JOB_PAGE_SIZE,
+    PRIVATE_MANIFEST_CACHE_CONTROL,
+    RESPONSE_FORMATS,
+    STREAM_CHUNK_SIZE,
+)
+from datasette_reconcile.slow_queries import get_params_shape
+from datasette_reconcile.state import get_state
+from datasette_reconcile.timing import Timings
+from datasette_reconcile.utils import (
+    decode_cursor,
+    encode_cursor,
+    etag_matches,
+    get_admission_controller,
+    get_data_version,
+    get_default_concurrency,
+    get_etag,
+    get_job_manager,
+    get_query_semaphore,
+    get_request_recorder,
+    get_result_cache,
+    get_schema_version,
+    get_slow_query_log,
+    get_view_url,
 )
-from datasette_reconcile.utils import get_select_fields, get_view_url
 
 
 class ReconcileAPI:
     api_version = "0.2"
 
-    def __init__(self, config, database, table, datasette):
+    def __init__(self, config, database, table, datasette, timings=None):
         self.config = config
         self.database = database
         self.db = datasette.get_database(database)
         self.table = table
         self.datasette = datasette
+        self.timings = timings or Timings()
 
     async def reconcile(self, request):
         """
@@ -31,45 +91,208 @@ class ReconcileAPI:
         post_vars = await request.post_vars()
         queries = post_vars.get("queries", request.args.get("queries"))
         extend = post_vars.get("extend", request.args.get("extend"))
+        response_format = post_vars.get("format", request.args.get("format", "json"))
+        if response_format not in RESPONSE_FORMATS:
+            msg = f"format must be one of: {', '.join(RESPONSE_FORMATS)}"
+            raise BadRequest(msg)
 
         if queries:
-            return self._response({q[0]: {"result": q[1]} async for q in self._reconcile_queries(json.loads(queries))})
+            queries = loads(queries)
+            self._check_size("max_batch_size", len(queries), "queries")
+            response = await self._admit(request, lambda: self._queries_response(queries, response_format))
+            await self._record({"queries": queries})
+            return response
         elif extend:
-            response = await self._extend(json.loads(extend))
-            return self._response(response)
+            extend = loads(extend)
+            self._check_size("max_extend_ids", len(extend.get("ids", [])), "ids")
+            response = await self._admit(request, lambda: self._extend_response(extend))
+            await self._record({"extend": extend})
+            return response
         else:
             # if we're not then just return the service specification
-            return self._response(await self._service_manifest(request))
+            return await self._manifest_response(request)
+
+    async def _queries_response(self, queries, response_format):
+        if response_format == "ndjson":
+            return self._stream_ndjson_queries(queries)
+        if self.config.get("streaming"):
+            return self._stream_queries(queries)
+        return self._response({q[0]: {"result": q[1]} async for q in self._reconcile_queries(queries)})
+
+    async def _extend_response(self, extend):
+        if self.config.get("streaming"):
+            return await self._stream_extend(extend)
+        return self._response(await self._extend(extend))
+
+    def _check_size(self, setting, size, name, default=None):
+        limit = self.config.get(setting, default)
+        if limit and size > limit:
+            msg = f"Too many {name} in one request ({size}, limit {limit})"
+            raise AdmissionError(msg, 413, setting)
+
+    async def _admit(self, request, respond):
+        """
+        Get the response from `respond` once the request has been admitted.
+
+        The request holds its slot until the response has been built, or
+        for streamed responses until the last of it has been written.
+        """
+        release = await get_admission_controller(self.datasette).acquire(get_client_id(request))
+        try:
+            response = await respond()
+        except BaseException:
+            release()
+            raise
+        if not isinstance(response, AsgiStream):
+            release()
+            return response
+
+        stream_fn = response.stream_fn
+
+        async def released_stream_fn(writer):
+            try:
+                await stream_fn(writer)
+            finally:
+                release()
+
+        response.stream_fn = released_stream_fn
+        return response
+
+    async def _record(self, payload):
+        # for streamed responses this is the time until the response starts
+        await get_request_recorder(self.datasette).record(self.database, self.table, payload, self.timings.total())
+
+    async def submit_job(self, request):
+        """
+        Start a background job for a batch of queries, returning its status straight away.
+        """
+        post_vars = await request.post_vars()
+        queries = post_vars.get("queries", request.args.get("queries"))
+        if not queries:
+            msg = "queries must be given to start a reconcile job"
+            raise BadRequest(msg)
+        queries = loads(queries)
+        self._check_size("max_job_size", len(queries), "queries", DEFAULT_MAX_JOB_SIZE)
+
+        # each job runs one query at a time, so jobs never use more than
+        # `job_concurrency` SQL threads and the rest are left for other requests
+        job_api = ReconcileAPI(
+            {**self.config, "max_concurrency": 1},
+            self.database,
+            self.table,
+            self.datasette,
+            Timings(metrics=self.timings.metrics),
+        )
+        job = await self._admit(request, lambda: self._submit_job(job_api, queries))
+        return Response(
+            dumps(self._job_status(job)),
+            status=202,
+            headers=self._headers({"Location": self._job_url(job)}),
+            content_type=JSON_CONTENT_TYPE,
+        )
+
+    async def _submit_job(self, job_api, queries):
+        return get_job_manager(self.datasette).submit(job_api, queries)
+
+    async def job_status(self, request):
+        return self._response(self._job_status(self._get_job(request)))
+
+    async def job_results(self, request):
+        """
+        Return a page of the results a job has completed so far.
+
+        Results are returned in the order they were completed. The `cursor`
+        is included until the job has finished and every result has been
+        returned, so clients can keep asking for the next page while the job
+        is running.
+        """
+        job = self._get_job(request)
+        try:
+            cursor = decode_cursor(request.args.get("cursor", "0"))
+            limit = int(request.args.get("limit", DEFAULT_JOB_PAGE_SIZE))
+        except ValueError as e:
+            raise BadRequest(str(e)) from e
+        # the cursor is the number of results already returned
+        offset = cursor if isinstance(cursor, int) else cursor[0] if cursor else None
+        if not isinstance(offset, int) or offset < 0 or limit < 1:
+            msg = "cursor and limit must be positive"
+            raise BadRequest(msg)
+        limit = min(limit, MAX_JOB_PAGE_SIZE)
+
+        page = job.results[offset : offset + limit]
+        response = {
+            "id": job.id,
+            "status": job.status,
+            "results": {query_id: {"result": result} for query_id, result in page},
+        }
+        next_offset = offset + len(page)
+        if job.finished is None or next_offset < len(job.results):
+            response["cursor"] = encode_cursor([next_offset])
+        return self._response(response)
+
+    def _get_job(self, request):
+        job = get_job_manager(self.datasette).get(request.url_vars["job_id"], self.database, self.table)
+        if job is None:
+            msg = "Job not found, or its results have expired"
+            raise NotFound(msg)
+        return job
+
+    def _job_url(self, job):
+        return self.datasette.urls.path(f"{self.database}/{self.table}/-/reconcile/jobs/{job.id}")
+
+    def _job_status(self, job):
+        job_url = self._job_url(job)
+        return {
+            **job.to_dict(get_job_manager(self.datasette).retention),
+            "url": job_url,
+            "results_url": f"{job_url}/results",
+        }
 
     async def properties(self, request):
         limit = request.args.get("limit", DEFAULT_LIMIT)
         type_ = request.args.get("type", DEFAULT_TYPE)
 
-        return self._response(
+        body = dumps(
             {
                 "limit": limit,
                 "type": type_,
                 "properties": [{"id": p["id"], "name": p["name"]} async for p in self._get_properties()],
             }
         )
+        return self._cacheable_response(request, body, get_etag(body))
 
     async def suggest_entity(self, request):
-        prefix = request.args.get("prefix")
-        cursor = int(request.args.get("cursor", 0))
-
-        name_field = self.config["name_field"]
-        id_field = self.config.get("id_field", "id")
-        query_sql = f"""
-            select {escape_sqlite(id_field)} as id, {escape_sqlite(name_field)} as name
-            from {escape_sqlite(self.table)}
-            where {escape_sqlite(name_field)} like :search_query
-            limit {DEFAULT_LIMIT} offset {cursor}
-        """  # noqa: S608
-        params = {"search_query": f"{prefix}%"}
-
-        return self._response(
-            {"result": [{"id": r["id"], "name": r["name"]} for r in await self.db.execute(query_sql, params)]}
-        )
+        prefix = request.args.get("prefix", "")
+        offset = 0
+        after = None
+        try:
+            cursor = decode_cursor(request.args.get("cursor", "0"))
+            if isinstance(cursor, int):
+                offset = cursor
+            else:
+                after = cursor
+            prefix_index = None
+            if self.config.get("prefix_index"):
+                prefix_index = await get_prefix_index(self.datasette, self.database, self.table, self.config)
+            if prefix_index is not None:
+                rows = prefix_index.search(get_sql_normalised_prefix(prefix), DEFAULT_LIMIT, after, offset)
+            else:
+                rows = await self._suggest_entity_rows(prefix, after, offset)
+        except ValueError as e:
+            raise BadRequest(str(e)) from e
+
+        response = {"result": [{"id": id_value, "name": name} for _, id_value, name in rows]}
+        if len(rows) == DEFAULT_LIMIT:
+            # the cursor for the next page is the keyset of the last row
+            response["cursor"] = encode_cursor(rows[-1][0])
+        return self._response(response)
+
+    async def _suggest_entity_rows(self, prefix, after, offset):
+        query_sql, params = get_suggest_entity_sql(self.config, self.table, prefix, after, offset)
+        return [
+            ([r[key] for key in r.keys() if key.startswith(SUGGEST_KEY)], r["id"], r["name"])
+            for r in await self._execute(query_sql, params)
+        ]
 
     async def suggest_property(self, request):
         prefix = request.args.get("prefix")
@@ -84,183 +307,517 @@ class ReconcileAPI:
         return self._response({"result": properties})
 
     async def suggest_type(self, request):
-        prefix = request.args.get("prefix")
+        prefix = request.args.get("prefix", "")
 
-        default_type = self.config.get("type_default", [DEFAULT_TYPE])
-        type_field = self.config.get("type_field")
-        if type_field:
-            query_sql = """
-                SELECT CASE WHEN {type_field} IS NULL THEN '{default_type}' ELSE {type_field} END as type
-                FROM {from_clause}
-                GROUP BY type
-                """.format(  # noqa: S608
-                type_field=escape_sqlite(type_field),
-                default_type=default_type[0]["id"],
-                from_clause=escape_sqlite(self.table),
-            )
-            types = [
+        if self.config.get("type_field"):
+            type_index = await get_type_index(self.datasette, self.database, self.table, self.config, self._execute)
+            result = self._named_types(type_index.search(prefix, DEFAULT_LIMIT))
+        else:
+            result = [
+                type_
+                for type_ in self.config.get("type_default", [DEFAULT_TYPE])
+                if prefix.lower() in type_["id"] or prefix.lower() in type_["name"]
+            ][:DEFAULT_LIMIT]
+
+        return self._response({"result": result})
+
+    async def index_advice(self, request):  # noqa: ARG002
+        """
+        Report whether the columns used to filter queries have indexes.
+
+        The columns checked are the id field (used by the extend endpoint), the
+        type field and any columns that have been used as property filters.
+        """
+        columns = {self.config["id_field"]: ["id_field"]}
+        if self.config.get("type_field"):
+            columns.setdefault(self.config["type_field"], []).append("type_field")
+        table_columns = {p["id"] async for p in self._get_properties()}
+        metrics = get_state(self.datasette).metrics
+        for labels, _ in metrics.labels("reconcile_property_filters_total", database=self.database, table=self.table):
+            if labels["property"] in table_columns:
+                columns.setdefault(labels["property"], []).append("property")
+
+        advice = await self.db.execute_fn(lambda conn: advise_filter_indexes(conn, self.table, columns))
+        return self._response({"database": self.database, "table": self.table, "indexes": advice})
+
+    async def _schema_key(self):
+        # the columns of the table and their descriptions in the metadata
+        column_descriptions = self.datasette.table_metadata(self.database, self.table).get("columns") or {}
+        return (
+            self.database,
+            self.table,
+            await get_schema_version(self.db),
+            json.dumps(column_descriptions, sort_keys=True, default=repr),
+        )
+
+    async def _get_properties(self):
+        # the list of columns is cached until the table's schema changes
+        cache = get_state(self.datasette).properties_cache
+        cache_key = await self._schema_key()
+        properties = cache.get(cache_key)
+        if properties is None:
+            column_descriptions = self.datasette.table_metadata(self.database, self.table).get("columns") or {}
+            properties = [
                 {
-                    "id": r["type"],
-                    "name": r["type"],
+                    "id": column.name,
+                    "name": column_descriptions.get(column.name, column.name),
+                    "type": column.type,
                 }
-                for r in await self.db.execute(query_sql)
+                for column in await self.db.table_column_details(self.table)
             ]
-        else:
-            types = default_type
-
-        return self._response(
+            cache.set(cache_key, properties)
+        for property_ in properties:
+            yield property_
+
+    async def _execute(self, query_sql, params=None):
+        return await self._timed_sql(query_sql, params, self.db.execute(query_sql, params))
+
+    async def _timed_sql(self, query_sql, params, coroutine):
+        start = time.perf_counter()
+        rows = await coroutine
+        duration = time.perf_counter() - start
+        self.timings.add_query(query_sql, params, len(rows), duration)
+        slow_query_ms = self.config.get("slow_query_ms")
+        if slow_query_ms is not None and duration * 1000 >= slow_query_ms:
+            await self._log_slow_query(query_sql, params, len(rows), duration)
+        return rows
+
+    async def _log_slow_query(self, query_sql, params, rows, duration):
+        try:
+            query_plan = await self.db.execute_fn(lambda conn: get_query_plan(conn, query_sql, params or []))
+        except sqlite3.Error:
+            query_plan = None
+        await get_slow_query_log(self.datasette).add(
             {
-                "result": [
-                    type_ for type_ in types if prefix.lower() in type_["id"] or prefix.lower() in type_["name"]
-                ][:DEFAULT_LIMIT]
+                "database": self.database,
+                "table": self.table,
+                "sql": query_sql.strip(),
+                "params": get_params_shape(params),
+                "rows": rows,
+                "duration_ms": round(duration * 1000, 3),
+                "query_plan": query_plan,
             }
         )
+        get_state(self.datasette).metrics.increment(
+            "reconcile_slow_queries_total", database=self.database, table=self.table
+        )
 
-    async def _get_properties(self):
-        column_descriptions = self.datasette.table_metadata(self.database, self.table).get("columns") or {}
-        for column in await self.db.table_column_details(self.table):
-            yield {
-                "id": column.name,
-                "name": column_descriptions.get(column.name, column.name),
-                "type": column.type,
-            }
+    def _headers(self, headers=None):
+        return {
+            "Access-Control-Allow-Origin": "*",
+            **(headers or {}),
+            "Server-Timing": self.timings.header(),
+        }
 
     def _response(self, response):
-        return Response.json(
-            response,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-            },
+        if self.timings.debug:
+            response = {**response, "_debug": self.timings.to_dict()}
+        with self.timings.stage("serialise"):
+            body = dumps(response)
+        return Response(
+            body,
+            headers=self._headers(),
+            content_type=JSON_CONTENT_TYPE,
         )
 
+    def _admission_error_response(self, error):
+        headers = {"Retry-After": str(error.retry_after)} if error.retry_after else {}
+        return Response(
+            dumps({"ok": False, "error": str(error), "status": error.status, "title": None}),
+            status=error.status,
+            headers=self._headers(headers),
+            content_type=JSON_CONTENT_TYPE,
+        )
+
+    def _stream_response(self, stream_fn, content_type=JSON_CONTENT_TYPE):
+        # only the stages before the response starts are included in the
+        # Server-Timing header of a streamed response
+        return AsgiStream(
+            stream_fn,
+            headers=self._headers(),
+            content_type=content_type,
+        )
+
+    def _stream_queries(self, queries):
+        # the results for each chunk of queries are written as soon as they
+        # are ready, rather than building the whole response in memory
+        async def stream_fn(writer):
+            separator = ""
+            await writer.write("{")
+            async for query_id, results in self._reconcile_queries(queries, STREAM_CHUNK_SIZE):
+                await writer.write(f"{separator}{dumps(query_id)}:{dumps({'result': results})}")
+                separator = ","
+            await writer.write("}")
+
+        return self._stream_response(stream_fn)
+
+    def _stream_ndjson_queries(self, queries):
+        async def stream_fn(writer):
+            async for query_id, results in self._reconcile_queries(queries, STREAM_CHUNK_SIZE):
+                await writer.write(dumps({"id": query_id, "result": results}) + "\n")
+
+        return self._stream_response(stream_fn, NDJSON_CONTENT_TYPE)
+
+    async def _stream_extend(self, data):
+        properties = {p["name"]: p async for p in self._get_properties()}
+        meta = self._extend_meta(data["properties"], properties)
+
+        async def stream_fn(writer):
+            separator = ""
+            await writer.write(f'{{"meta":{dumps(meta)},"rows":{{')
+            async for rows in self._extend_rows(data["ids"], data["properties"], properties):
+                for row_id, values in rows:
+                    await writer.write(f"{separator}{dumps(str(row_id))}:{dumps(values)}")
+                    separator = ","
+            await writer.write("}}")
+
+        return self._stream_response(stream_fn)
+
+    def _cacheable_response(self, request, body, etag):
+        # the permission checks have already passed, so a table requested without
+        # an actor is public. Anything seen by a signed-in actor may not be, and
+        # must not be kept by shared caches.
+        cache_control = PRIVATE_MANIFEST_CACHE_CONTROL if request.actor else MANIFEST_CACHE_CONTROL
+        headers = self._headers({"ETag": etag, "Cache-Control": cache_control})
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response("", status=304, headers=headers)
+        return Response(body, headers=headers, content_type=JSON_CONTENT_TYPE)
+
     async def _extend(self, data):
-        ids = data["ids"]
         data_properties = data["properties"]
         properties = {p["name"]: p async for p in self._get_properties()}
-        id_field = self.config.get("id_field", "id")
 
+        rows = {}
+        async for chunk_rows in self._extend_rows(data["ids"], data_properties, properties):
+            rows.update(chunk_rows)
+
+        response = {
+            "meta": self._extend_meta(data_properties, properties),
+            "rows": rows,
+        }
+
+        return response
+
+    def _extend_meta(self, data_properties, properties):
+        return [{"id": p["id"], "name": properties[p["id"]]["name"]} for p in data_properties]
+
+    async def _extend_rows(self, ids, data_properties, properties):
+        id_field = self.config.get("id_field", "id")
         select_fields = [id_field] + [p["id"] for p in data_properties]
 
+        # large sets of ids are split into chunks, to keep each statement
+        # below SQLite's limit on the number of variables. The chunks are
+        # run concurrently and the rows for each one are yielded as soon as
+        # it finishes.
+        get_state(self.datasette).metrics.observe("reconcile_extend_ids", len(ids), buckets=SIZE_BUCKETS)
+        chunk_size = self.config.get("extend_chunk_size", DEFAULT_EXTEND_CHUNK_SIZE)
+        chunks = [ids[i : i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+        for chunk_results in asyncio.as_completed(
+            self._limit_concurrency(self._extend_chunk(chunk, select_fields) for chunk in chunks)
+        ):
+            yield [
+                (row[id_field], self._extend_values(row, data_properties, properties)) for row in await chunk_results
+            ]
+
+    async def _extend_chunk(self, ids, select_fields):
         query_sql = """
             select {fields}
             from {table}
             where {where_clause}
         """.format(  # noqa: S608
             table=escape_sqlite(self.table),
-            where_clause=f"{escape_sqlite(id_field)} in ({','.join(['?'] * len(ids))})",
+            where_clause=f"{escape_sqlite(select_fields[0])} in ({','.join(['?'] * len(ids))})",
             fields=",".join([escape_sqlite(f) for f in select_fields]),
         )
-        query_results = await self.db.execute(query_sql, ids)
+        return await self._execute(query_sql, ids)
+
+    def _extend_values(self, row, data_properties, properties):
+        values = {}
+        for p in data_properties:
+            property_ = properties[p["id"]]
+            if property_["type"] == "INTEGER":
+                values[p["id"]] = [{"int": row[p["id"]]}]
+            elif property_["type"] == "FLOAT":
+                values[p["id"]] = [{"float": row[p["id"]]}]
+            else:
+                values[p["id"]] = [{"str": row[p["id"]]}]
+        return values
 
-        rows = {}
-        for row in query_results:
-            values = {}
-            for p in data_properties:
-                property_ = properties[p["id"]]
-                if property_["type"] == "INTEGER":
-                    values[p["id"]] = [{"int": row[p["id"]]}]
-                elif property_["type"] == "FLOAT":
-                    values[p["id"]] = [{"float": row[p["id"]]}]
-                else:
-                    values[p["id"]] = [{"str": row[p["id"]]}]
-
-            rows[row[id_field]] = values
+    async def _reconcile_queries(self, queries, chunk_size=None):
+        """
+        Yield the results for each query.
 
-        response = {
-            "meta": [{"id": p["id"], "name": properties[p["id"]]["name"]} for p in data_properties],
-            "rows": rows,
+        If `chunk_size` is given the unique queries are run in chunks of that
+        size, and the results for each chunk are yielded before the next one
+        is run. Otherwise all the queries are run together and the results
+        are yielded in the same order as the queries.
+        """
+        # identical queries (eg the same value in many rows of a column) are
+        # only run once, and the results shared between them
+        query_keys = {query_id: get_query_key(self.config, query) for query_id, query in queries.items()}
+        unique_queries = {}
+        for query_id, key in query_keys.items():
+            unique_queries.setdefault(key, query_id)
+
+        metrics = get_state(self.datasette).metrics
+        metrics.increment("reconcile_queries_total", len(queries))
+        metrics.increment("reconcile_queries_unique_total", len(unique_queries))
+        metrics.observe("reconcile_batch_size", len(queries), buckets=SIZE_BUCKETS)
+        # keep track of the columns used as property filters, for the index advisor.
+        # Only the table's own columns are counted, so clients can't add any number of labels
+        table_columns = None
+        for query in queries.values():
+            for property_id, _ in get_query_properties(query):
+                if table_columns is None:
+                    table_columns = {p["id"] async for p in self._get_properties()}
+                if property_id in table_columns:
+                    metrics.increment(
+                        "reconcile_property_filters_total",
+                        database=self.database,
+                        table=self.table,
+                        property=property_id,
+                    )
+
+        if not chunk_size:
+            results = await self._cached_queries({query_id: queries[query_id] for query_id in unique_queries.values()})
+            for query_id, key in query_keys.items():
+                yield query_id, results[unique_queries[key]]
+            return
+
+        duplicates = {}
+        for query_id, key in query_keys.items():
+            duplicates.setdefault(key, []).append(query_id)
+        unique_ids = list(unique_queries.values())
+        for i in range(0, len(unique_ids), chunk_size):
+            chunk = unique_ids[i : i + chunk_size]
+            results = await self._cached_queries({query_id: queries[query_id] for query_id in chunk})
+            for unique_id in chunk:
+                for query_id in duplicates[query_keys[unique_id]]:
+                    yield query_id, results[unique_id]
+
+    async def _cached_queries(self, queries):
+        # every query in a chunk waits for the whole chunk, so that is the time recorded for each of them
+        start = time.perf_counter()
+        results = await self._cached_queries_results(queries)
+        get_state(self.datasette).metrics.observe(
+            "reconcile_query_duration_seconds", time.perf_counter() - start, count=len(queries)
+        )
+        return results
+
+    async def _cached_queries_results(self, queries):
+        result_cache = get_result_cache(self.datasette) if self.config.get("result_cache") else None
+        if not result_cache:
+            return dict(await self._run_queries(queries))
+
+        data_version = await get_data_version(self.db)
+        cache_keys = {
+            query_id: get_result_cache_key(self.config, self.database, self.table, query)
+            for query_id, query in queries.items()
         }
+        found = await result_cache.get_many(list(cache_keys.values()), data_version)
 
-        return response
+        results = dict(
+            await self._run_queries(
+                {query_id: query for query_id, query in queries.items() if cache_keys[query_id] not in found}
+            )
+        )
+        if results:
+            await result_cache.set_many({cache_keys[query_id]: r for query_id, r in results.items()}, data_version)
+        return {query_id: found[key] if key in found else results[query_id] for query_id, key in cache_keys.items()}
+
+    async def _run_queries(self, queries):
+        if not queries:
+            return []
+
+        # look for exact matches first, and only search for other
+        # candidates if there aren't enough of them
+        exact_candidates = await self._exact_candidates(queries) if self.config.get("names_table") else {}
+        search_queries = {
+            query_id: query
+            for query_id, query in queries.items()
+            if len(exact_candidates.get(query_id, [])) < get_query_limit(self.config, query)
+        }
 
-    async def _reconcile_queries(self, queries):
-        select_fields = get_select_fields(self.config)
+        if self.config["execution_mode"] == "batch":
+            fetch_candidates = self._batch_candidates
+        elif self.config["execution_mode"] == "concurrent":
+            fetch_candidates = self._concurrent_candidates
+        else:
+            fetch_candidates = self._serial_candidates
+        search_candidates = {}
+        if search_queries:
+            search_candidates = {query_id: rows async for query_id, rows in fetch_candidates(search_queries)}
+
+        # queries not found as a substring in the trigram index may be a near
+        # miss, so search for rows sharing the rarest of their trigrams
+        for query_id, query in search_queries.items():
+            if (
+                not search_candidates.get(query_id)
+                and not exact_candidates.get(query_id)
+                and self.config.get("trigram_table")
+                and get_match_table(self.config, query) == self.config["trigram_table"]
+            ):
+                search_candidates[query_id] = await self._trigram_candidates(query)
+
+        id_field = self.config["id_field"]
+        metrics = get_state(self.datasette).metrics
+        candidates = []
+        for query_id in queries:
+            rows = list(exact_candidates.get(query_id, []))
+            seen = {row[id_field] for row in rows}
+            rows.extend(row for row in search_candidates.get(query_id, []) if row[id_field] not in seen)
+            candidates.append((query_id, rows))
+            metrics.observe("reconcile_candidates", len(rows), buckets=SIZE_BUCKETS)
+
+        # scoring is CPU bound, so it is done for the whole batch at once
+        # in a thread to avoid blocking the event loop
+        loop = asyncio.get_event_loop()
+        with self.timings.stage("scoring"):
+            return await loop.run_in_executor(None, self._score_candidates, queries, candidates)
+
+    def _score_candidates(self, queries, candidates):
+        names = []
+        query_names = []
+        for query_id, rows in candidates:
+            query_name = normalise_name(queries[query_id]["query"])
+            for row in rows:
+                names.append(normalise_name(row[self.config["name_field"]]))
+                query_names.append(query_name)
+        scores = iter(score_pairs(names, query_names))
+
+        results = []
+        for query_id, rows in candidates:
+            query = queries[query_id]
+            query_results = [self._get_query_result(row, query, next(scores)) for row in rows]
+            query_results = heapq.nlargest(get_query_limit(self.config, query), query_results, key=lambda x: x["score"])
+            results.append((query_id, query_results))
+        return results
+
+    async def _fetch_candidates(self, query):
+        query_sql, params = get_query_sql(self.config, self.table, query)
+        limit = get_query_limit(self.config, query)
+        if get_candidate_limit(self.config, query) <= limit:
+            return await self._execute(query_sql, params)
+
+        # when fetching a larger pool of candidates, stop reading rows once
+        # there are enough exact matches to fill the results
+        name_field = self.config["name_field"]
+        query_name = normalise_name(query["query"])
+        time_limit_ms = self.datasette.sql_time_limit_ms
+
+        def fetch(conn):
+            rows = []
+            exact_matches = 0
+            with sqlite_timelimit(conn, time_limit_ms):
+                for row in conn.execute(query_sql, params):
+                    rows.append(row)
+                    if normalise_name(row[name_field]) == query_name:
+                        exact_matches += 1
+                        if exact_matches >= limit:
+                            break
+            return rows
+
+        with trace("sql", database=self.database, sql=query_sql.strip(), params=params):
+            return await self._timed_sql(query_sql, params, self.db.execute_fn(fetch))
+
+    async def _trigram_candidates(self, query):
+        trigrams = get_trigrams(query["query"])
+        create_sql, vocab_sql, params = get_trigram_vocab_sql(self.config, trigrams)
+
+        def fetch_counts(conn):
+            conn.execute(create_sql)
+            return conn.execute(vocab_sql, params).fetchall()
+
+        with trace("sql", database=self.database, sql=vocab_sql, params=params):
+            counts = await self._timed_sql(vocab_sql, params, self.db.execute_fn(fetch_counts))
+        trigrams = get_selective_trigrams(counts)
+        if not trigrams:
+            return []
+        query_sql, params = get_query_sql(self.config, self.table, query, trigrams)
+        return await self._execute(query_sql, params)
+
+    async def _exact_candidates(self, queries):
+        """
+        Find rows whose normalised name is the same as the query, using the normalised names index.
+
+        Queries with property filters are left to the main search.
+        """
+        exact_queries = {
+            query_id: get_sql_normalised_name(query["query"])
+            for query_id, query in queries.items()
+            if not get_query_properties(query)
+        }
+        if not exact_queries:
+            return {}
+
+        limit = max(get_query_limit(self.config, queries[query_id]) for query_id in exact_queries)
+        query_sql, params = get_exact_match_sql(self.config, self.table, set(exact_queries.values()), limit)
+        rows_by_name = {}
+        for row in await self._execute(query_sql, params):
+            rows_by_name.setdefault(row[EXACT_MATCH_NAME], []).append(row)
+
+        type_field = self.config.get("type_field")
+        candidates = {}
+        for query_id, name in exact_queries.items():
+            rows = rows_by_name.get(name, [])
+            types = get_query_types(self.config, queries[query_id])
+            if types:
+                rows = [row for row in rows if row[type_field] in types]
+            candidates[query_id] = rows
+        return candidates
+
+    async def _serial_candidates(self, queries):
         for query_id, query in queries.items():
-            limit = min(
-                query.get("limit", self.config.get("max_limit", DEFAULT_LIMIT)),
-                self.config.get("max_limit", DEFAULT_LIMIT),
-            )
+            yield query_id, await self._fetch_candidates(query)
 
-            where_clauses = ["1"]
-            from_clause = escape_sqlite(self.table)
-            order_by = ""
-            params = {}
-            if self.config["fts_table"]:
-                # NB this will fail if the table name has non-alphanumeric
-                # characters in and sqlite3 version < 3.30.0
-                # see: https://www.sqlite.org/src/info/00e9a8f2730eb723
-                from_clause = """
-                {table}
-                inner join (
-                        SELECT "rowid", "rank"
-                        FROM {fts_table}
-                        WHERE {fts_table} MATCH :search_query
-                ) as "a" on {table}."rowid" = a."rowid"
-                """.format(  # noqa: S608
-                    table=escape_sqlite(self.table),
-                    fts_table=escape_sqlite(self.config["fts_table"]),
-                )
-                order_by = "order by a.rank"
-                params["search_query"] = escape_fts(query["query"])
-            else:
-                where_clauses.append(
-                    "{search_col} like :search_query".format(
-                        search_col=escape_sqlite(self.config["name_field"]),
-                    )
-                )
-                params["search_query"] = f"%{query['query']}%"
-
-            types = query.get("type", [])
-            if not isinstance(types, list) and types:
-                types = [types]
-            type_field = self.config.get("type_field")
-            if types and type_field:
-                type_values = {f"type_value{index}": t for index, t in enumerate(types)}
-                where_clauses.append(
-                    "{type_field} in ({type_values})".format(
-                        type_field=escape_sqlite(type_field),
-                        type_values=", ".join([f":{value}" for value in type_values.keys()]),
-                    )
-                )
-                params = {**params, **type_values}
-
-            if query.get("properties"):
-                for index, prop in enumerate(query["properties"]):
-                    if prop["v"]:
-                        property_id = prop["pid"]
-                        property_values = prop["v"]
-                        if not isinstance(property_values, list):
-                            property_values = [property_values]
-                        property_values = {f"property_value{index}_{i}": v for i, v in enumerate(property_values)}
-                        where_clauses.append(
-                            "{property_id} in ({property_values})".format(
-                                property_id=escape_sqlite(property_id),
-                                property_values=", ".join([f":{value}" for value in property_values.keys()]),
-                            )
-                        )
-                        params = {**params, **property_values}
-
-            query_sql = """
-                SELECT {select_fields}
-                FROM {from_clause}
-                WHERE {where_clause} {order_by}
-                LIMIT {limit}""".format(  # noqa: S608
-                select_fields=",".join([escape_sqlite(f) for f in select_fields]),
-                from_clause=from_clause,
-                where_clause=" and ".join(where_clauses),
-                order_by=order_by,
-                limit=limit,
-            )
-            query_results = [self._get_query_result(r, query) for r in await self.db.execute(query_sql, params)]
-            query_results = sorted(query_results, key=lambda x: -x["score"])
-            yield query_id, query_results
+    def _limit_concurrency(self, coroutines):
+        """
+        Wrap coroutines so only a limited number of them run at once.
 
-    def _get_query_result(self, row, query):
+        Each request can use up to `max_concurrency` of the read connections,
+        while the global semaphore stops large requests starving other requests.
+        """
+        request_semaphore = asyncio.Semaphore(
+            self.config.get("max_concurrency", get_default_concurrency(self.datasette))
+        )
+        global_semaphore = get_query_semaphore(self.datasette)
+
+        async def run(coroutine):
+            async with request_semaphore, global_semaphore:
+                return await coroutine
+
+        return [run(coroutine) for coroutine in coroutines]
+
+    async def _concurrent_candidates(self, queries):
+        results = await asyncio.gather(
+            *self._limit_concurrency(self._fetch_candidates(query) for query in queries.values())
+        )
+        for query_id, rows in zip(queries.keys(), results):
+            yield query_id, rows
+
+    async def _batch_candidates(self, queries):
+        # queries that filter on different properties need different SQL,
+        # so one statement is run for each distinct shape of query
+        shapes = {}
+        for query_id, query in queries.items():
+            shapes.setdefault(get_batch_shape(self.config, query), []).append((query_id, query))
+
+        candidates = {query_id: [] for query_id in queries}
+        for batch in shapes.values():
+            query_sql, params = get_batch_sql(self.config, self.table, batch)
+            for row in await self._execute(query_sql, params):
+                candidates[row[BATCH_QUERY_ID]].append(row)
+
+        for query_id, rows in candidates.items():
+            yield query_id, rows
+
+    def _get_query_result(self, row, query, score):
         row = dict(row)
 
         name = str(row.pop(self.config["name_field"]))
-        name_match = str(name).lower().strip()
-        query_match = str(query["query"]).lower().strip()
+        name_match = normalise_name(name)
+        query_match = normalise_name(query["query"])
 
         type_ = self.config.get("type_default", [DEFAULT_TYPE])
         type_field = self.config.get("type_field")
@@ -279,7 +836,7 @@ class ReconcileAPI:
             "id": id_value,
             "name": name,
             "type": type_,
-            "score": fuzz.ratio(name_match, query_match),
+            "score": score,
             "match": name_match == query_match,
         }
         if self.config["description_field"]:
@@ -287,12 +844,50 @@ class ReconcileAPI:
 
         return result
 
-    async def _service_manifest(self, request):
-        # @todo: if type_field is set then get a list of types to use in the "defaultTypes" item below.
+    def _get_scheme(self, request):
         # handle X-FORWARDED-PROTO in Datasette: https://github.com/simonw/datasette/issues/2215
         scheme = request.scheme
         if "x-forwarded-proto" in request.headers:
             scheme = request.headers.get("x-forwarded-proto")
+        return scheme
+
+    async def _manifest_response(self, request):
+        # the serialised manifest is cached for each combination of table
+        # schema, host and scheme, along with its ETag. If the types come
+        # from the table it also needs to change with the data.
+        cache = get_state(self.datasette).manifest_cache
+        cache_key = (
+            *await self._schema_key(),
+            self._get_scheme(request),
+            request.host,
+            json.dumps(self.config, sort_keys=True, default=repr),
+            json.dumps(await get_data_version(self.db)) if self.config.get("type_field") else None,
+        )
+        cached = cache.get(cache_key)
+        if cached is None:
+            body = dumps(await self._service_manifest(request))
+            cached = (body, get_etag(body))
+            cache.set(cache_key, cached)
+        return self._cacheable_response(request, *cached)
+
+    async def _get_default_types(self):
+        # any configured types are suggested to clients, followed by the most common types in the table
+        if not self.config.get("type_field"):
+            return self.config.get("type_default", [DEFAULT_TYPE])
+        configured = self.config.get("type_default", [])
+        configured_ids = {type_["id"] for type_ in configured}
+        type_index = await get_type_index(self.datasette, self.database, self.table, self.config, self._execute)
+        common = [type_ for type_ in type_index.most_common(MAX_DEFAULT_TYPES) if type_ not in configured_ids]
+        return [*configured, *self._named_types(common)][: max(MAX_DEFAULT_TYPES, len(configured))]
+
+    def _named_types(self, types):
+        # types found in the table take their names from `type_default`, as
+        # rows without a type are counted as the first default type
+        names = {type_["id"]: type_["name"] for type_ in self.config.get("type_default", [DEFAULT_TYPE])}
+        return [{"id": type_, "name": names.get(type_, type_)} for type_ in types]
+
+    async def _service_manifest(self, request):
+        scheme = self._get_scheme(request)
 
         base_url = f'{scheme}://{request.host}{self.datasette.setting("base_url")}'
         if not base_url.endswith("/"):
@@ -314,7 +909,7 @@ class ReconcileAPI:
             ),
             "identifierSpace": self.config.get("identifierSpace", DEFAULT_IDENTIFER_SPACE),
             "schemaSpace": self.config.get("schemaSpace", DEFAULT_SCHEMA_SPACE),
-            "defaultTypes": self.config.get("type_default", [DEFAULT_TYPE]),
+            "defaultTypes": await self._get_default_types(),
             "view": {"url": view_url},
             "extend": {
                 "propose_properties": (
@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import hmac
+import re
+import secrets
+import threading
+from datetime import datetime, timezone
+
+from datasette_reconcile.serialisation import dumps
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def anonymise_text(text, key):
+    """
+    Replace each word in some text with a keyed hash (HMAC) of the same length.
+
+    The same word (ignoring case) is always replaced with the same hash for
+    a given `key`, so repeated values and the length and number of words in
+    each query are kept, but the text itself is not. Without the key the
+    hashes can't be reversed by hashing a list of likely words.
+    """
+
+    def replace(match):
+        word = match.group(0)
+        digest = hmac.new(key, word.lower().encode("utf-8"), hashlib.sha256).hexdigest()
+        return (digest * (len(word) // len(digest) + 1))[: len(word)]
+
+    return WORD_PATTERN.sub(replace, str(text))
+
+
+def _anonymise_value(value, key):
+    if isinstance(value, list):
+        return [_anonymise_value(v, key) for v in value]
+    if isinstance(value, str):
+        return anonymise_text(value, key)
+    return value
+
+
+def anonymise_query(query, key):
+    """
+    Anonymise the query text and property values of a reconciliation query.
+
+    Types, property ids, numbers and limits are kept as they are.
+    """
+    query = dict(query)
+    if "query" in query:
+        query["query"] = anonymise_text(query["query"], key)
+    if isinstance(query.get("properties"), list):
+        query["properties"] = [
+            {**property_, "v": _anonymise_value(property_.get("v"), key)} for property_ in query["properties"]
+        ]
+    return query
+
+
+class RequestRecorder:
+    """
+    Records reconcile and extend requests to a JSON lines file, so they can be replayed later.
+
+    If `anonymise` is set the text of each query is replaced using
+    `anonymise_query`, with `anonymise_key` or else a random key for each
+    recorder. The ids in extend requests are always kept, as they are
+    needed to replay the request.
+    """
+
+    def __init__(self, path=None, *, anonymise=False, anonymise_key=None):
+        self.path = path
+        self.anonymise = anonymise
+        if isinstance(anonymise_key, str):
+            anonymise_key = anonymise_key.encode("utf-8")
+        self.anonymise_key = anonymise_key or secrets.token_bytes(32)
+        self._lock = threading.Lock()
+
+    def _write(self, line):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    async def record(self, database, table, payload, duration):
+        if not self.path:
+            return
+        if self.anonymise and "queries" in payload:
+            payload = {
+                **payload,
+                "queries": {
+                    query_id: anonymise_query(query, self.anonymise_key)
+                    for query_id, query in payload["queries"].items()
+                },
+            }
+        entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "database": database,
+            "table": table,
+            "endpoint": "reconcile" if "queries" in payload else "extend",
+            "payload": payload,
+            "duration_ms": round(duration * 1000, 3),
+        }
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, dumps(entry))
@@ -0,0 +1,139 @@
+import asyncio
+import math
+import time
+
+from datasette.utils import tilde_encode
+
+from datasette_reconcile.serialisation import dumps, loads
+
+MAX_DIFF_EXAMPLES = 10
+
+
+def load_recording(path):
+    """
+    Yield each entry from a JSON lines file written by the request recorder (or by a replay with `--output`).
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def get_request_path(entry):
+    return f"/{tilde_encode(entry['database'])}/{tilde_encode(entry['table'])}/-/reconcile"
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+async def replay(client, entries, concurrency=1, rate=None):
+    """
+    Send recorded requests to a Datasette instance, returning the response to each one and the total time taken.
+
+    Up to `concurrency` requests are sent at once. If `rate` is given the
+    requests are started at that many per second (or as soon as there is a
+    free slot, if the server can't keep up).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    async def send(index, entry):
+        if rate:
+            await asyncio.sleep(max(start + index / rate - time.perf_counter(), 0))
+        data = {key: dumps(value) for key, value in entry["payload"].items()}
+        async with semaphore:
+            request_start = time.perf_counter()
+            response = await client.post(get_request_path(entry), data=data)
+            latency = time.perf_counter() - request_start
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return {
+            "index": index,
+            "database": entry["database"],
+            "table": entry["table"],
+            "endpoint": entry["endpoint"],
+            "status": response.status_code,
+            "latency_ms": round(latency * 1000, 3),
+            "queries": len(entry["payload"].get("queries") or entry["payload"].get("extend", {}).get("ids", [])),
+            "response": body,
+        }
+
+    results = await asyncio.gather(*(send(index, entry) for index, entry in enumerate(entries)))
+    return results, time.perf_counter() - start
+
+
+def summarise(results, elapsed):
+    """
+    Throughput and latency for a replay.
+    """
+    latencies = [r["latency_ms"] for r in results]
+    summary = {
+        "requests": len(results),
+        "errors": sum(1 for r in results if r["status"] != 200),  # noqa: PLR2004
+        "queries": sum(r["queries"] for r in results),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(results) / elapsed, 2) if elapsed else None,
+        "queries_per_s": round(sum(r["queries"] for r in results) / elapsed, 2) if elapsed else None,
+    }
+    if latencies:
+        summary["mean_ms"] = round(sum(latencies) / len(latencies), 3)
+        for pct in (50, 95, 99):
+            summary[f"p{pct}_ms"] = _percentile(latencies, pct)
+    return summary
+
+
+def _result_ids(response, query_id):
+    result = (response or {}).get(query_id) or {}
+    return [r.get("id") for r in result.get("result", [])]
+
+
+def diff_results(old_results, new_results):
+    """
+    Compare the responses from two replays of the same recording, eg against two versions of the plugin.
+
+    Reconcile responses are compared on the ids of the results for each
+    query, in order, so changes to scores alone are not counted. Other
+    responses are compared as a whole.
+    """
+    old_by_index = {r["index"]: r for r in old_results}
+    diff = {
+        "requests": 0,
+        "changed_requests": 0,
+        "queries": 0,
+        "changed_queries": 0,
+        "changed_top_result": 0,
+        "examples": [],
+    }
+    for new in new_results:
+        old = old_by_index.get(new["index"])
+        if old is None:
+            continue
+        diff["requests"] += 1
+        changed = old["status"] != new["status"]
+        if new["endpoint"] == "reconcile" and isinstance(new["response"], dict):
+            for query_id in new["response"]:
+                if query_id == "_debug":
+                    continue
+                diff["queries"] += 1
+                old_ids = _result_ids(old["response"], query_id)
+                new_ids = _result_ids(new["response"], query_id)
+                if old_ids == new_ids:
+                    continue
+                changed = True
+                diff["changed_queries"] += 1
+                if old_ids[:1] != new_ids[:1]:
+                    diff["changed_top_result"] += 1
+                if len(diff["examples"]) < MAX_DIFF_EXAMPLES:
+                    diff["examples"].append(
+                        {"index": new["index"], "query_id": query_id, "old": old_ids, "new": new_ids}
+                    )
+        elif old["response"] != new["response"]:
+            changed = True
+            if len(diff["examples"]) < MAX_DIFF_EXAMPLES:
+                diff["examples"].append({"index": new["index"], "endpoint": new["endpoint"]})
+        diff["changed_requests"] += changed
+    return diff
@@ -0,0 +1,29 @@
+from fuzzywuzzy import fuzz
+
+try:
+    # rapidfuzz needs numpy to return the scores from cpdist
+    import numpy as np  # noqa: F401
+    from rapidfuzz import fuzz as rapidfuzz_fuzz
+    from rapidfuzz.process import cpdist
+except ImportError:  # no cov
+    cpdist = None
+
+
+def normalise_name(value):
+    return str(value).lower().strip()
+
+
+def score_pairs(names, queries):
+    """
+    Score each name against the query at the same position in `queries`.
+
+    Returns integer scores from 0 to 100, the same as `fuzz.ratio`. If
+    rapidfuzz is installed all the pairs are scored in a single vectorised
+    call, otherwise each pair is scored in turn.
+    """
+    if not names:
+        return []
+    if cpdist is not None:
+        scores = cpdist(names, queries, scorer=rapidfuzz_fuzz.ratio, workers=-1)
+        return [round(float(score)) for score in scores]
+    return [fuzz.ratio(name, query) for name, query in zip(names, queries)]
@@ -0,0 +1,31 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # no cov
+    orjson = None
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+NDJSON_CONTENT_TYPE = "application/x-ndjson; charset=utf-8"
+
+
+def loads(value):
+    """
+    Parse a JSON string, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def dumps(value):
+    """
+    Serialise a value as a compact JSON string, using orjson if it is installed.
+
+    Dictionaries can have non-string keys (such as integer ids in the extend
+    endpoint), and values that can't be serialised are replaced with their
+    `repr`, the same with either library.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=repr, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(value, default=repr, separators=(",", ":"))
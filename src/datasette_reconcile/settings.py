@@ -7,3 +7,43 @@ DEFAULT_IDENTIFER_SPACE = "http://rdf.freebase.com/ns/type.object.id"
 DEFAULT_SCHEMA_SPACE = "http://rdf.freebase.com/ns/type.object.id"
 SQLITE_VERSION_WARNING = (3, 30, 0)
 SUPPORTED_API_VERSIONS = ["0.1", "0.2"]
+CONFIG_CACHE_SIZE = 256
+EXECUTION_MODES = ["serial", "batch", "concurrent"]
+DEFAULT_EXECUTION_MODE = "serial"
+POSITIVE_INTEGER_SETTINGS = [
+    "max_concurrency",
+    "candidate_pool",
+    "extend_chunk_size",
+    "prefix_index_max_rows",
+    "max_batch_size",
+    "max_extend_ids",
+    "max_job_size",
+]
+TRIGRAM_INDEX_SUFFIX = "_reconcile_trigram"
+NAMES_INDEX_SUFFIX = "_reconcile_names"
+TRIGRAM_SQLITE_VERSION = (3, 34, 0)
+TRIGRAM_LENGTH = 3
+DEFAULT_RESULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_RESULT_CACHE_DISK_SIZE = 1024 * 1024 * 1024
+MANIFEST_CACHE_CONTROL = "public, max-age=60"
+PRIVATE_MANIFEST_CACHE_CONTROL = "private, max-age=60"
+DEFAULT_EXTEND_CHUNK_SIZE = 500
+STREAM_CHUNK_SIZE = 100
+RESPONSE_FORMATS = ["json", "ndjson"]
+DEFAULT_PREFIX_INDEX_MAX_ROWS = 1_000_000
+PREFIX_INDEX_CACHE_SIZE = 16
+PREFIX_INDEX_CACHE_ROWS = 4_000_000
+MAX_DEFAULT_TYPES = 10
+DEFAULT_SLOW_QUERY_LOG_SIZE = 100
+DEFAULT_JOB_CONCURRENCY = 1
+DEFAULT_JOB_RETENTION = 3600
+DEFAULT_JOB_PAGE_SIZE = 1000
+MAX_JOB_PAGE_SIZE = 10000
+DEFAULT_MAX_JOB_SIZE = 100_000
+DEFAULT_MAX_ACTIVE_JOBS = 10
+DEFAULT_MAX_KEPT_JOBS = 100
+DEFAULT_REQUEST_QUEUE_TIMEOUT = 10
+DEFAULT_RETRY_AFTER = 5
+MATERIALIZED_SQLITE_VERSION = (3, 35, 0)
+TRIGRAM_FALLBACK_MAX_ROWS = 20_000
+DEFAULT_BULK_SQL_TIME_LIMIT_MS = 60_000
@@ -0,0 +1,56 @@
+import asyncio
+import json
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+
+def get_params_shape(params):
+    """
+    Describe the parameters of a query without including their values.
+
+    Named parameters are given with their type (and the length of strings),
+    while positional parameters are summarised by their number and types.
+    """
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _describe_value(value) for key, value in params.items()}
+    return {"count": len(params), "types": sorted({type(value).__name__ for value in params})}
+
+
+def _describe_value(value):
+    if isinstance(value, str):
+        return f"str({len(value)})"
+    return type(value).__name__
+
+
+class SlowQueryLog:
+    """
+    The most recent slow queries, held in a ring buffer of a fixed size.
+
+    If `path` is given each entry is also appended to that file as a line
+    of JSON.
+    """
+
+    def __init__(self, maxlen, path=None):
+        self.entries = deque(maxlen=maxlen)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, line):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    async def add(self, entry):
+        entry = {"timestamp": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), **entry}
+        self.entries.append(entry)
+        if self.path:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._write, json.dumps(entry, default=repr))
+
+    def recent(self):
+        """
+        Return the entries in the buffer, newest first.
+        """
+        return list(reversed(self.entries))
@@ -0,0 +1,57 @@
+import weakref
+
+from datasette_reconcile.cache import LRUCache
+from datasette_reconcile.metrics import Metrics
+from datasette_reconcile.settings import CONFIG_CACHE_SIZE, PREFIX_INDEX_CACHE_ROWS, PREFIX_INDEX_CACHE_SIZE
+
+_STATE = weakref.WeakKeyDictionary()
+
+
+class ReconcileState:
+    """
+    In-process state shared by every request to one Datasette instance.
+    """
+
+    def __init__(self):
+        self.config_cache = LRUCache(maxsize=CONFIG_CACHE_SIZE)
+        self.properties_cache = LRUCache(maxsize=CONFIG_CACHE_SIZE)
+        self.manifest_cache = LRUCache(maxsize=CONFIG_CACHE_SIZE)
+        # prefix indexes are sized by their number of rows
+        self.prefix_indexes = LRUCache(maxsize=PREFIX_INDEX_CACHE_SIZE, maxbytes=PREFIX_INDEX_CACHE_ROWS)
+        self.type_indexes = LRUCache(maxsize=CONFIG_CACHE_SIZE)
+        self.prefix_index_locks = weakref.WeakValueDictionary()
+        self.query_semaphore = None
+        self.result_cache = None
+        self.slow_query_log = None
+        self.request_recorder = None
+        self.job_manager = None
+        self.admission_controller = None
+        self.data_version_connections = {}
+        self.metrics = Metrics()
+
+    def cache_stats(self):
+        """
+        Hit, miss and size counts for each of the in-process caches.
+        """
+        caches = {
+            "config": self.config_cache,
+            "properties": self.properties_cache,
+            "manifest": self.manifest_cache,
+            "prefix_index": self.prefix_indexes,
+            "type_index": self.type_indexes,
+        }
+        stats = {
+            name: {"hits": cache.hits, "misses": cache.misses, "evictions": cache.evictions, "entries": len(cache)}
+            for name, cache in caches.items()
+        }
+        if self.result_cache is not None:
+            stats["result"] = self.result_cache.stats()
+        return stats
+
+
+def get_state(datasette):
+    state = _STATE.get(datasette)
+    if state is None:
+        state = ReconcileState()
+        _STATE[datasette] = state
+    return state
@@ -0,0 +1,75 @@
+import time
+from contextlib import contextmanager
+
+
+class Timings:
+    """
+    Time spent in each stage of handling a request.
+
+    The totals are sent in a `Server-Timing` header. If `debug` is set the
+    SQL run for the request is also recorded, to be included in the
+    response. If `metrics` is given the duration of each stage is also
+    added to the `reconcile_stage_duration_seconds` histogram.
+    """
+
+    def __init__(self, *, debug=False, metrics=None):
+        self.debug = debug
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.queries = []
+
+    def add(self, name, duration):
+        total, count = self.stages.get(name, (0, 0))
+        self.stages[name] = (total + duration, count + 1)
+        if self.metrics is not None:
+            self.metrics.observe("reconcile_stage_duration_seconds", duration, stage=name)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add_query(self, sql, params, rows, duration):
+        self.add("sql", duration)
+        if self.debug:
+            self.queries.append(
+                {
+                    "sql": sql.strip(),
+                    "params": params,
+                    "rows": rows,
+                    "duration_ms": round(duration * 1000, 3),
+                }
+            )
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """
+        Return the value for a `Server-Timing` header, with durations in milliseconds.
+
+        Stages that ran more than once (such as SQL queries) are summed, with
+        the number of times given in the description.
+        """
+        metrics = []
+        for name, (duration, count) in self.stages.items():
+            metric = f"{name};dur={duration * 1000:.2f}"
+            if count > 1:
+                metric += f';desc="{count} calls"'
+            metrics.append(metric)
+        metrics.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def to_dict(self):
+        return {
+            "stages": {
+                name: {"duration_ms": round(duration * 1000, 3), "count": count}
+                for name, (duration, count) in self.stages.items()
+            },
+            "total_ms": round(self.total() * 1000, 3),
+            "queries": self.queries,
+        }
@@ -1,10 +1,39 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
 import sqlite3
 import warnings
+from pathlib import Path
 
 from datasette.utils import HASH_LENGTH
 from datasette.utils.asgi import Forbidden, NotFound
 
-from datasette_reconcile.settings import DEFAULT_TYPE, SQLITE_VERSION_WARNING
+from datasette_reconcile.admission import AdmissionController
+from datasette_reconcile.cache import ResultCache
+from datasette_reconcile.jobs import JobManager
+from datasette_reconcile.recorder import RequestRecorder
+from datasette_reconcile.settings import (
+    DEFAULT_EXECUTION_MODE,
+    DEFAULT_JOB_CONCURRENCY,
+    DEFAULT_JOB_RETENTION,
+    DEFAULT_MAX_ACTIVE_JOBS,
+    DEFAULT_MAX_KEPT_JOBS,
+    DEFAULT_REQUEST_QUEUE_TIMEOUT,
+    DEFAULT_RESULT_CACHE_DISK_SIZE,
+    DEFAULT_RESULT_CACHE_SIZE,
+    DEFAULT_RETRY_AFTER,
+    DEFAULT_SLOW_QUERY_LOG_SIZE,
+    DEFAULT_TYPE,
+    EXECUTION_MODES,
+    NAMES_INDEX_SUFFIX,
+    POSITIVE_INTEGER_SETTINGS,
+    SQLITE_VERSION_WARNING,
+    TRIGRAM_INDEX_SUFFIX,
+)
+from datasette_reconcile.slow_queries import SlowQueryLog
+from datasette_reconcile.state import get_state
 
 PERMISSION_TUPLE_SIZE = 2
 
@@ -91,6 +120,32 @@ async def check_config(config, db, table):
 
     if "fts_table" not in config:
         config["fts_table"] = await db.fts_table(table)
+    config["fts_version"] = await get_fts_version(db, config["fts_table"])
+
+    for key in POSITIVE_INTEGER_SETTINGS:
+        if key in config and (not isinstance(config[key], int) or config[key] < 1):
+            msg = f"{key} in reconciliation config must be a positive integer"
+            raise TypeError(msg)
+
+    if "slow_query_ms" in config and (
+        isinstance(config["slow_query_ms"], bool)
+        or not isinstance(config["slow_query_ms"], (int, float))
+        or config["slow_query_ms"] < 0
+    ):
+        msg = "slow_query_ms in reconciliation config must be a number of milliseconds"
+        raise TypeError(msg)
+
+    config["trigram_table"] = await _get_index_table(db, get_trigram_table(table), config.get("trigram_index"))
+    config["names_table"] = await _get_index_table(db, get_names_table(table), config.get("normalised_index"))
+
+    config["execution_mode"] = config.get("execution_mode", DEFAULT_EXECUTION_MODE)
+    if config["execution_mode"] not in EXECUTION_MODES:
+        msg = f"execution_mode must be one of: {', '.join(EXECUTION_MODES)}"
+        raise ReconcileError(msg)
+    if config["execution_mode"] == "batch" and not table_exists:
+        # batch queries join candidates on rowid, which views don't have
+        msg = "execution_mode batch can't be used with a view"
+        raise ReconcileError(msg)
 
     # let's show a warning if sqlite3 version is less than 3.30.0
     # full text search results will fail for < 3.30.0 if the table
@@ -110,6 +165,300 @@ async def check_config(config, db, table):
     return config
 
 
+async def get_fts_version(db, fts_table):
+    """
+    Return the full text search module (`fts3`, `fts4` or `fts5`) used by a table.
+    """
+    if not fts_table:
+        return None
+    sql = (await db.execute("SELECT sql FROM sqlite_master WHERE name = ?", [fts_table])).first()
+    if not sql or not sql[0]:
+        return None
+    for version in ("fts5", "fts4", "fts3"):
+        if f"using {version}" in sql[0].lower():
+            return version
+    return None
+
+
+async def _get_index_table(db, index_table, enabled):
+    if not enabled:
+        return None
+    if await db.table_exists(index_table):
+        return index_table
+    warnings.warn(
+        f"Index {index_table} not found, use `datasette reconcile-index` to create it",
+        stacklevel=3,
+    )
+    return None
+
+
+async def get_data_version(db):
+    """
+    Return a token that changes whenever the database changes.
+
+    For file databases this is the modification time of the database file
+    (and its write-ahead log, if present), so checking it does not need a
+    trip through the SQL thread pool. Named in-memory databases use
+    `PRAGMA data_version` on a connection kept for the purpose, which
+    changes whenever another connection commits a change. Each connection
+    to an unnamed in-memory database is a separate empty database, so
+    nothing in them can change.
+    """
+    if not db.is_mutable:
+        return "immutable"
+    if db.memory_name:
+        return ("data", get_data_version_connection(db).execute("PRAGMA data_version").fetchone()[0])
+    if db.is_memory or not db.path:
+        return "memory"
+    wal_path = Path(f"{db.path}-wal")
+    wal_mtime = wal_path.stat().st_mtime_ns if wal_path.exists() else None
+    return (db.mtime_ns, wal_mtime)
+
+
+def get_data_version_connection(db):
+    """
+    Return the connection used to check the data version of a named in-memory database.
+
+    `PRAGMA data_version` only changes with commits made by other
+    connections, so this connection is never used for anything else.
+    """
+    connections = get_state(db.ds).data_version_connections
+    conn = connections.get(db.name)
+    if conn is None:
+        conn = db.connect()
+        connections[db.name] = conn
+    return conn
+
+
+async def get_schema_version(db):
+    """
+    Return SQLite's schema version for the database, which changes whenever a table is altered.
+    """
+    return (await db.execute("PRAGMA schema_version")).single_value()
+
+
+def get_etag(body):
+    """
+    Return a strong ETag for a response body.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check the value of an `If-None-Match` request header against an ETag.
+
+    `If-None-Match` uses the weak comparison, so a `W/` prefix on the
+    client's copy of the ETag is ignored.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        opaque_tag = tag.strip()
+        if opaque_tag.startswith("W/"):
+            opaque_tag = opaque_tag[2:]
+        if opaque_tag == etag:
+            return True
+    return False
+
+
+async def get_cached_config(datasette, database, table):
+    """
+    Return the checked plugin configuration for a table.
+
+    Results of `check_config` are cached per database, table and raw plugin
+    configuration, and invalidated whenever the database changes.
+    """
+    db = datasette.get_database(database)
+    config = datasette.plugin_config("datasette-reconcile", database=database, table=table)
+    key = (
+        database,
+        table,
+        json.dumps(config, sort_keys=True, default=repr),
+        await get_data_version(db),
+    )
+    cache = get_state(datasette).config_cache
+    checked_config = cache.get(key)
+    if checked_config is None:
+        checked_config = await check_config(config, db, table)
+        cache.set(key, checked_config)
+    return dict(checked_config)
+
+
+def get_default_concurrency(datasette):
+    return max(datasette.setting("num_sql_threads"), 1)
+
+
+def get_query_semaphore(datasette):
+    """
+    Return the semaphore limiting how many reconcile queries run at once across all requests.
+
+    The limit is taken from `global_max_concurrency` in the root plugin
+    configuration, defaulting to the number of SQL threads Datasette uses.
+    """
+    state = get_state(datasette)
+    if state.query_semaphore is None:
+        config = datasette.plugin_config("datasette-reconcile") or {}
+        limit = config.get("global_max_concurrency", get_default_concurrency(datasette))
+        if not isinstance(limit, int) or limit < 1:
+            msg = "global_max_concurrency in reconciliation config must be a positive integer"
+            raise ReconcileError(msg)
+        state.query_semaphore = asyncio.Semaphore(limit)
+    return state.query_semaphore
+
+
+def get_result_cache(datasette):
+    """
+    Return the cache of reconciliation results shared by all tables.
+
+    The size of the memory cache (in bytes) and the path of the optional
+    cache database on disk are set with `result_cache_size` and
+    `result_cache_path` in the root plugin configuration. The cache on disk
+    is limited by `result_cache_disk_size` (in bytes) and optionally
+    `result_cache_max_age` (in seconds).
+    """
+    state = get_state(datasette)
+    if state.result_cache is None:
+        config = datasette.plugin_config("datasette-reconcile") or {}
+        size = config.get("result_cache_size", DEFAULT_RESULT_CACHE_SIZE)
+        disk_size = config.get("result_cache_disk_size", DEFAULT_RESULT_CACHE_DISK_SIZE)
+        for key, value in [("result_cache_size", size), ("result_cache_disk_size", disk_size)]:
+            if not isinstance(value, int) or value < 0:
+                msg = f"{key} in reconciliation config must be a positive integer"
+                raise ReconcileError(msg)
+        max_age = config.get("result_cache_max_age")
+        if max_age is not None and (not isinstance(max_age, (int, float)) or isinstance(max_age, bool) or max_age < 0):
+            msg = "result_cache_max_age in reconciliation config must be a non-negative number of seconds"
+            raise ReconcileError(msg)
+        state.result_cache = ResultCache(
+            size, config.get("result_cache_path"), disk_maxbytes=disk_size, max_age=max_age
+        )
+    return state.result_cache
+
+
+def get_slow_query_log(datasette):
+    """
+    Return the log of slow queries shared by all tables.
+
+    The number of queries kept in memory and the path of an optional file
+    to append them to are set with `slow_query_log_size` and
+    `slow_query_log_path` in the root plugin configuration.
+    """
+    state = get_state(datasette)
+    if state.slow_query_log is None:
+        config = datasette.plugin_config("datasette-reconcile") or {}
+        size = config.get("slow_query_log_size", DEFAULT_SLOW_QUERY_LOG_SIZE)
+        if not isinstance(size, int) or size < 1:
+            msg = "slow_query_log_size in reconciliation config must be a positive integer"
+            raise ReconcileError(msg)
+        state.slow_query_log = SlowQueryLog(size, config.get("slow_query_log_path"))
+    return state.slow_query_log
+
+
+def get_request_recorder(datasette):
+    """
+    Return the recorder for reconcile and extend requests.
+
+    Requests are only recorded if `record_path` is set in the root plugin
+    configuration, and the query text is anonymised if `record_anonymise`
+    is true. The key used to anonymise the text is `record_anonymise_key`,
+    or a random one if it isn't set.
+    """
+    state = get_state(datasette)
+    if state.request_recorder is None:
+        config = datasette.plugin_config("datasette-reconcile") or {}
+        key = config.get("record_anonymise_key")
+        if key is not None and (not isinstance(key, str) or not key):
+            msg = "record_anonymise_key in reconciliation config must be a non-empty string"
+            raise ReconcileError(msg)
+        state.request_recorder = RequestRecorder(
+            config.get("record_path"), anonymise=bool(config.get("record_anonymise")), anonymise_key=key
+        )
+    return state.request_recorder
+
+
+def get_job_manager(datasette):
+    """
+    Return the manager for background reconcile jobs shared by all tables.
+
+    The number of jobs run at once and the number of seconds finished jobs
+    are kept for are set with `job_concurrency` and `job_retention` in the
+    root plugin configuration. The number of jobs that can be queued or
+    running, and the number of finished jobs kept, are limited by
+    `max_active_jobs` and `max_kept_jobs`.
+    """
+    state = get_state(datasette)
+    if state.job_manager is None:
+        config = datasette.plugin_config("datasette-reconcile") or {}
+        concurrency = config.get("job_concurrency", DEFAULT_JOB_CONCURRENCY)
+        if not isinstance(concurrency, int) or concurrency < 1:
+            msg = "job_concurrency in reconciliation config must be a positive integer"
+            raise ReconcileError(msg)
+        retention = config.get("job_retention", DEFAULT_JOB_RETENTION)
+        if not isinstance(retention, (int, float)) or isinstance(retention, bool) or retention < 0:
+            msg = "job_retention in reconciliation config must be a non-negative number of seconds"
+            raise ReconcileError(msg)
+        limits = {
+            "max_active_jobs": config.get("max_active_jobs", DEFAULT_MAX_ACTIVE_JOBS),
+            "max_kept_jobs": config.get("max_kept_jobs", DEFAULT_MAX_KEPT_JOBS),
+        }
+        for key, value in limits.items():
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                msg = f"{key} in reconciliation config must be a positive integer"
+                raise ReconcileError(msg)
+        state.job_manager = JobManager(
+            concurrency,
+            retention,
+            state.metrics,
+            max_active=limits["max_active_jobs"],
+            max_kept=limits["max_kept_jobs"],
+            retry_after=config.get("retry_after", DEFAULT_RETRY_AFTER),
+        )
+    return state.job_manager
+
+
+def get_admission_controller(datasette):
+    """
+    Return the limits on concurrent reconcile requests shared by all tables.
+
+    These are set in the root plugin configuration with
+    `max_concurrent_requests` (across all clients),
+    `max_concurrent_requests_per_client`, `request_queue_timeout` (seconds
+    to wait for a free slot) and `retry_after` (seconds sent to clients
+    that are turned away). There are no limits unless they are set.
+    """
+    state = get_state(datasette)
+    if state.admission_controller is None:
+        config = datasette.plugin_config("datasette-reconcile") or {}
+        for key in ["max_concurrent_requests", "max_concurrent_requests_per_client", "retry_after"]:
+            if key in config and (not isinstance(config[key], int) or isinstance(config[key], bool) or config[key] < 1):
+                msg = f"{key} in reconciliation config must be a positive integer"
+                raise ReconcileError(msg)
+        queue_timeout = config.get("request_queue_timeout", DEFAULT_REQUEST_QUEUE_TIMEOUT)
+        if not isinstance(queue_timeout, (int, float)) or isinstance(queue_timeout, bool) or queue_timeout < 0:
+            msg = "request_queue_timeout in reconciliation config must be a non-negative number of seconds"
+            raise ReconcileError(msg)
+        state.admission_controller = AdmissionController(
+            config.get("max_concurrent_requests"),
+            config.get("max_concurrent_requests_per_client"),
+            queue_timeout,
+            config.get("retry_after", DEFAULT_RETRY_AFTER),
+        )
+    return state.admission_controller
+
+
+def get_trigram_table(table):
+    return f"{table}{TRIGRAM_INDEX_SUFFIX}"
+
+
+def get_names_table(table):
+    return f"{table}{NAMES_INDEX_SUFFIX}"
+
+
 def get_select_fields(config):
     select_fields = [config["id_field"], config["name_field"], *config.get("additional_fields", [])]
     if config.get("type_field"):
@@ -119,6 +468,31 @@ def get_select_fields(config):
     return select_fields
 
 
+def encode_cursor(values):
+    """
+    Turn the keyset of the last row on a page of results into an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor back into a keyset, or a number for the older offset cursors.
+
+    Raises `ValueError` if the cursor is not valid.
+    """
+    if cursor.isdigit():
+        return int(cursor)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(str(e)) from e
+    if not isinstance(values, list):
+        msg = "Cursor is not valid"
+        raise ValueError(msg)
+    return values
+
+
 def get_view_url(ds, database, table):
     id_str = "{{id}}"
     if hasattr(ds, "urls"):
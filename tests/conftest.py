@@ -44,6 +44,16 @@ def plugin_metadata(metadata=None):
     return to_return
 
 
+def plugin_datasette(db_path, table_config, root_config=None):
+    """
+    Return a Datasette instance for the test database, with the plugin configured for the dogs table and the root.
+    """
+    metadata = plugin_metadata(table_config)
+    if root_config is not None:
+        metadata["plugins"] = {"datasette-reconcile": root_config}
+    return Datasette([db_path], metadata=metadata)
+
+
 def get_schema(filename):
     schemas = {}
     for f in os.scandir(SCHEMA_DIR):
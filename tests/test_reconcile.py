@@ -2,9 +2,12 @@ import json
 
 import httpx
 import pytest
+import sqlite_utils
 from datasette.app import Datasette
 
-from tests.conftest import do_method, plugin_metadata
+from datasette_reconcile.state import get_state
+from datasette_reconcile.utils import ReconcileError, check_config
+from tests.conftest import create_db, do_method, plugin_datasette, plugin_metadata
 
 
 @pytest.mark.asyncio
@@ -17,6 +20,30 @@ async def test_plugin_is_installed():
         assert "datasette-reconcile" in installed_plugins
 
 
+@pytest.mark.asyncio
+async def test_response_manifest_type_field_and_default(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    sqlite_utils.Database(db_path)["dogs"].insert({"id": 6, "name": "Rex", "age": 2, "status": None})
+    config = {"name_field": "name", "type_field": "status", "type_default": [{"id": "dog", "name": "Dog"}]}
+    app = Datasette([db_path], metadata=plugin_metadata(config)).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert 200 == response.status_code
+        # the configured type keeps its name, and rows without a type are counted as it
+        assert response.json()["defaultTypes"] == [
+            {"id": "dog", "name": "Dog"},
+            {"id": "bad dog", "name": "bad dog"},
+            {"id": "good dog", "name": "good dog"},
+        ]
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile/suggest/type?prefix=do")
+        assert response.json()["result"] == [
+            {"id": "dog", "name": "Dog"},
+            {"id": "bad dog", "name": "bad dog"},
+            {"id": "good dog", "name": "good dog"},
+        ]
+
+
 @pytest.mark.asyncio
 async def test_response_not_configured(db_path):
     app = Datasette([db_path]).app()
@@ -279,6 +306,27 @@ async def test_response_extend(db_path, method):
         assert response.headers["Access-Control-Allow-Origin"] == "*"
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 2, 500])
+async def test_response_extend_chunks(db_path, chunk_size):
+    metadata = plugin_metadata({"name_field": "name", "extend_chunk_size": chunk_size, "max_concurrency": 2})
+    app = Datasette([db_path], metadata=metadata).app()
+    async with httpx.AsyncClient(app=app) as client:
+        # more ids than SQLite's default limit on variables
+        ids = [str(i) for i in range(1, 2001)] if chunk_size > 2 else ["1", "2", "3", "4", "5", "6"]
+        extend = {"extend": json.dumps({"ids": ids, "properties": [{"id": "age"}]})}
+        response = await client.post("http://localhost/test/dogs/-/reconcile", data=extend)
+        assert 200 == response.status_code
+        rows = response.json()["rows"]
+        assert {key: value["age"][0]["int"] for key, value in rows.items()} == {
+            "1": 5,
+            "2": 4,
+            "3": 3,
+            "4": 3,
+            "5": 5,
+        }
+
+
 @pytest.mark.asyncio
 async def test_response_suggest_entity(db_path):
     app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
@@ -503,3 +551,245 @@ async def test_response_queries_description_field(db_path, method):
         assert result["score"] == 100
         assert result["description"] == "bad dog"
         assert response.headers["Access-Control-Allow-Origin"] == "*"
+
+
+BATCH_QUERIES = {
+    "q0": {"query": "pancakes"},
+    "q1": {"query": "fido", "type": "bad dog"},
+    "q2": {"query": "pancakes", "properties": [{"pid": "age", "v": 5}]},
+    "q3": {"query": "abcdef"},
+    "q4": {"query": "cleo", "limit": 1},
+}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fts", [True, False])
+async def test_response_queries_batch_mode(db_path, db_path_fts, fts):
+    responses = {}
+    for execution_mode in ["serial", "batch", "concurrent"]:
+        app = Datasette(
+            [db_path_fts if fts else db_path],
+            metadata=plugin_metadata({"name_field": "name", "type_field": "status", "execution_mode": execution_mode}),
+        ).app()
+        async with httpx.AsyncClient(app=app) as client:
+            response = await client.post(
+                "http://localhost/test/dogs/-/reconcile",
+                data={"queries": json.dumps(BATCH_QUERIES)},
+            )
+            assert 200 == response.status_code
+            responses[execution_mode] = response.json()
+
+    data = responses["batch"]
+    assert list(data.keys()) == list(BATCH_QUERIES.keys())
+    assert {r["id"] for r in data["q0"]["result"]} == {"2", "5"}
+    assert [r["id"] for r in data["q1"]["result"]] == ["3"]
+    assert [r["id"] for r in data["q2"]["result"]] == ["5"]
+    assert data["q3"]["result"] == []
+    assert [r["id"] for r in data["q4"]["result"]] == ["1"]
+    assert data == responses["serial"]
+    assert responses["concurrent"] == responses["serial"]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_view(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    sqlite_utils.Database(db_path).create_view("dog_view", "SELECT id, name, status FROM dogs")
+    ds = Datasette([db_path])
+    responses = {}
+    for execution_mode in ["serial", "concurrent"]:
+        config = {"id_field": "id", "name_field": "name", "execution_mode": execution_mode}
+        metadata = {"databases": {"test": {"tables": {"dog_view": {"plugins": {"datasette-reconcile": config}}}}}}
+        app = Datasette([db_path], metadata=metadata).app()
+        async with httpx.AsyncClient(app=app) as client:
+            response = await client.post(
+                "http://localhost/test/dog_view/-/reconcile",
+                data={"queries": json.dumps({"q0": {"query": "fido"}, "q1": {"query": "pancakes"}})},
+            )
+            assert 200 == response.status_code
+            responses[execution_mode] = response.json()
+    assert [r["name"] for r in responses["serial"]["q0"]["result"]] == ["Fido"]
+    assert {r["id"] for r in responses["serial"]["q1"]["result"]} == {"2", "5"}
+    assert responses["concurrent"] == responses["serial"]
+
+    # views have no rowid for the batch query to join on
+    with pytest.raises(ReconcileError, match="can't be used with a view"):
+        await check_config(
+            {"id_field": "id", "name_field": "name", "execution_mode": "batch"}, ds.get_database("test"), "dog_view"
+        )
+
+
+@pytest.mark.asyncio
+async def test_response_queries_concurrent_mode_limits(db_path):
+    config = {"name_field": "name", "execution_mode": "concurrent", "max_concurrency": 2}
+    app = plugin_datasette(db_path, config, {"global_max_concurrency": 1}).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps(BATCH_QUERIES)},
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert list(data.keys()) == list(BATCH_QUERIES.keys())
+        assert [r["id"] for r in data["q1"]["result"]] == ["3"]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_deduplicated(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    queries = {
+        "q0": {"query": "fido"},
+        "q1": {"query": "fido"},
+        "q2": {"query": "fido", "limit": 1},
+        "q3": {"query": "pancakes"},
+        "q4": {"query": "fido"},
+    }
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps(queries)},
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert list(data.keys()) == list(queries.keys())
+        assert data["q0"] == data["q1"] == data["q2"] == data["q4"]
+        assert len(data["q3"]["result"]) == 2
+
+    metrics = get_state(ds).metrics
+    assert metrics.get("reconcile_queries_total") == 5
+    assert metrics.get("reconcile_queries_unique_total") == 3
+    assert metrics.dedup_ratio() == 0.4
+
+
+@pytest.mark.asyncio
+async def test_response_queries_deduplicated_exact_text(db_path):
+    # queries that only differ in case or whitespace are searched for separately,
+    # so the results don't depend on the order of the batch
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        queries = {"b": {"query": "Cleo "}, "a": {"query": "Cleo"}, "c": {"query": "CLEO"}}
+        response = await client.post("http://localhost/test/dogs/-/reconcile", data={"queries": json.dumps(queries)})
+        assert 200 == response.status_code
+        data = response.json()
+        for query_id, query in queries.items():
+            response = await client.post(
+                "http://localhost/test/dogs/-/reconcile", data={"queries": json.dumps({query_id: query})}
+            )
+            assert data[query_id] == response.json()[query_id]
+        assert [r["id"] for r in data["a"]["result"]] == ["1"]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_streaming(db_path):
+    queries = {**BATCH_QUERIES, "q5": {"query": "PANCAKES"}}
+    responses = {}
+    for streaming in [True, False]:
+        app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "streaming": streaming})).app()
+        async with httpx.AsyncClient(app=app) as client:
+            response = await client.post(
+                "http://localhost/test/dogs/-/reconcile",
+                data={"queries": json.dumps(queries)},
+            )
+            assert 200 == response.status_code
+            assert response.headers["content-type"] == "application/json; charset=utf-8"
+            assert response.headers["Access-Control-Allow-Origin"] == "*"
+            responses[streaming] = response.json()
+    assert responses[True] == responses[False]
+    assert responses[True]["q5"] == responses[True]["q0"]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_ndjson(db_path):
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps(BATCH_QUERIES), "format": "ndjson"},
+        )
+        assert 200 == response.status_code
+        assert response.headers["content-type"] == "application/x-ndjson; charset=utf-8"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["id"] for line in lines] == list(BATCH_QUERIES.keys())
+        assert [r["id"] for r in lines[1]["result"]] == ["3"]
+
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps(BATCH_QUERIES), "format": "xml"},
+        )
+        assert 400 == response.status_code
+
+
+@pytest.mark.asyncio
+async def test_response_extend_streaming(db_path):
+    metadata = plugin_metadata({"name_field": "name", "streaming": True, "extend_chunk_size": 2})
+    app = Datasette([db_path], metadata=metadata).app()
+    async with httpx.AsyncClient(app=app) as client:
+        extend = {"extend": json.dumps({"ids": ["1", "2", "3", "4", "9"], "properties": [{"id": "status"}]})}
+        response = await client.post("http://localhost/test/dogs/-/reconcile", data=extend)
+        assert 200 == response.status_code
+        data = response.json()
+        assert data["meta"] == [{"id": "status", "name": "status"}]
+        assert {key: value["status"][0]["str"] for key, value in data["rows"].items()} == {
+            "1": "good dog",
+            "2": "bad dog",
+            "3": "bad dog",
+            "4": "good dog",
+        }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("execution_mode", ["serial", "batch", "concurrent"])
+@pytest.mark.parametrize("candidate_pool, expected_name", [(None, "Pancakes"), (5, "Scratch")])
+async def test_response_queries_candidate_pool(db_path, execution_mode, candidate_pool, expected_name):
+    config = {"name_field": "name", "execution_mode": execution_mode}
+    if candidate_pool:
+        config["candidate_pool"] = candidate_pool
+    app = Datasette([db_path], metadata=plugin_metadata(config)).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps({"q0": {"query": "a", "limit": 1}, "q1": {"query": "pancakes", "limit": 1}})},
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert [r["name"] for r in data["q0"]["result"]] == [expected_name]
+        assert [r["id"] for r in data["q1"]["result"]] == ["2"]
+        assert data["q1"]["result"][0]["match"]
+
+
+@pytest.mark.asyncio
+async def test_response_server_timing(db_path):
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile?_debug=1",
+            data={"queries": json.dumps(BATCH_QUERIES)},
+        )
+        assert 200 == response.status_code
+        stages = [metric.split(";")[0] for metric in response.headers["Server-Timing"].split(", ")]
+        assert stages == ["config", "permissions", "sql", "scoring", "serialise", "total"]
+        assert "sql;dur=" in response.headers["Server-Timing"]
+        assert 'desc="5 calls"' in response.headers["Server-Timing"]
+        # only actors allowed to see the debug menu get the debug information
+        assert "_debug" not in response.json()
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert response.headers["Server-Timing"].startswith("config;dur=")
+
+
+@pytest.mark.asyncio
+async def test_response_debug(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    async with httpx.AsyncClient(app=ds.app(), cookies=cookies) as client:
+        response = await client.get(
+            "http://localhost/test/dogs/-/reconcile",
+            params={"queries": json.dumps({"q0": {"query": "fido"}, "q1": {"query": "pancakes"}}), "_debug": "1"},
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert [r["id"] for r in data["q0"]["result"]] == ["3"]
+        debug = data["_debug"]
+        assert set(debug["stages"]) == {"config", "permissions", "sql", "scoring"}
+        assert [q["rows"] for q in debug["queries"]] == [1, 2]
+        assert "like :search_query" in debug["queries"][0]["sql"]
+        assert debug["queries"][0]["params"] == {"search_query": "%fido%"}
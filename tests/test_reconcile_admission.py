@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from datasette_reconcile.admission import AdmissionController, AdmissionError
+from datasette_reconcile.state import get_state
+from datasette_reconcile.utils import ReconcileError, get_admission_controller
+from tests.conftest import plugin_datasette
+
+QUERIES = {"q0": {"query": "fido"}, "q1": {"query": "Pancakes"}, "q2": {"query": "scratch"}}
+
+
+@pytest.mark.asyncio
+async def test_admission_controller():
+    controller = AdmissionController(max_requests=2, max_requests_per_client=1, queue_timeout=0.05, retry_after=3)
+    release_a = await controller.acquire("a")
+
+    # each client can only have one request at once
+    with pytest.raises(AdmissionError) as e:
+        await controller.acquire("a")
+    assert e.value.status == 429
+    assert e.value.reason == "client_limit"
+    assert e.value.retry_after == 3
+
+    # the second slot is free, but then there is no room for a third client
+    release_b = await controller.acquire("b")
+    with pytest.raises(AdmissionError) as e:
+        await controller.acquire("c")
+    assert e.value.reason == "global_limit"
+    assert controller.clients == {"a": 1, "b": 1}
+
+    # a queued request gets the next free slot
+    queued = asyncio.create_task(controller.acquire("c"))
+    await asyncio.sleep(0)
+    release_a()
+    release_a()
+    release_c = await queued
+    assert controller.clients == {"b": 1, "c": 1}
+    release_b()
+    release_c()
+    assert not controller.clients
+
+
+@pytest.mark.asyncio
+async def test_admission_controller_cancelled():
+    controller = AdmissionController(max_requests=1, max_requests_per_client=1, queue_timeout=5)
+    release_a = await controller.acquire("a")
+    queued = asyncio.create_task(controller.acquire("b"))
+    await asyncio.sleep(0)
+    queued.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await queued
+    release_a()
+
+    # the cancelled request doesn't stop the client from making another
+    assert not controller.clients
+    release_b = await controller.acquire("b")
+    release_b()
+
+
+@pytest.mark.asyncio
+async def test_batch_size_limits(db_path):
+    ds = plugin_datasette(db_path, {"name_field": "name", "max_batch_size": 2, "max_extend_ids": 1}, {})
+    async with httpx.AsyncClient(app=ds.app(), base_url="http://localhost") as client:
+        response = await client.post("/test/dogs/-/reconcile", data={"queries": json.dumps(QUERIES)})
+        assert response.status_code == 413
+        assert response.json()["error"] == "Too many queries in one request (3, limit 2)"
+        assert "retry-after" not in response.headers
+        assert response.headers["access-control-allow-origin"] == "*"
+        assert response.headers["content-type"] == "application/json; charset=utf-8"
+
+        response = await client.post("/test/dogs/-/reconcile", data={"extend": json.dumps({"ids": ["1", "2"]})})
+        assert response.status_code == 413
+
+        # requests within the limits, and background jobs, are not affected
+        response = await client.post("/test/dogs/-/reconcile", data={"queries": json.dumps({"q0": QUERIES["q0"]})})
+        assert response.status_code == 200
+        response = await client.post("/test/dogs/-/reconcile/jobs", data={"queries": json.dumps(QUERIES)})
+        assert response.status_code == 202
+
+    metrics = get_state(ds).metrics
+    assert metrics.get("reconcile_rejected_requests_total", endpoint="reconcile", reason="max_batch_size") == 1
+    assert metrics.get("reconcile_rejected_requests_total", endpoint="reconcile", reason="max_extend_ids") == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("streaming", [False, True])
+async def test_concurrent_request_limit(db_path, streaming):
+    ds = plugin_datasette(
+        db_path,
+        {"name_field": "name", "streaming": streaming},
+        {"max_concurrent_requests": 1, "request_queue_timeout": 0, "retry_after": 7},
+    )
+    async with httpx.AsyncClient(app=ds.app(), base_url="http://localhost") as client:
+        # a slot is released once the response has been sent
+        for _ in range(2):
+            response = await client.post("/test/dogs/-/reconcile", data={"queries": json.dumps(QUERIES)})
+            assert response.status_code == 200
+        controller = get_admission_controller(ds)
+        assert not controller.clients
+
+        # with the only slot taken, another request is turned away
+        release = await controller.acquire("other")
+        response = await client.post("/test/dogs/-/reconcile", data={"queries": json.dumps(QUERIES)})
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "7"
+        assert response.headers["access-control-allow-origin"] == "*"
+        assert response.json()["status"] == 429
+        release()
+
+        # the manifest is never limited
+        response = await client.get("/test/dogs/-/reconcile")
+        assert response.status_code == 200
+
+    metrics = get_state(ds).metrics
+    assert metrics.get("reconcile_rejected_requests_total", endpoint="reconcile", reason="global_limit") == 1
+
+
+@pytest.mark.parametrize(
+    "root_config",
+    [{"max_concurrent_requests": 0}, {"max_concurrent_requests_per_client": "2"}, {"request_queue_timeout": -1}],
+)
+def test_admission_config_errors(db_path, root_config):
+    ds = plugin_datasette(db_path, {"name_field": "name"}, root_config)
+    with pytest.raises(ReconcileError):
+        get_admission_controller(ds)
@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+from benchmarks.data import TABLE, create_database, parse_size, sample_queries
+from benchmarks.run import ENDPOINTS, VARIANTS, compare, parse_server_timing, percentile, run_benchmarks
+
+
+@pytest.mark.parametrize("value, expected", [("10k", 10_000), ("1m", 1_000_000), ("1.5M", 1_500_000), ("250", 250)])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) is None
+
+
+def test_parse_server_timing():
+    header = 'config;dur=0.10, sql;dur=2.50;desc="3 calls", total;dur=4.00'
+    assert parse_server_timing(header) == {"config": 0.1, "sql": 2.5, "total": 4.0}
+
+
+def test_create_database(tmp_path):
+    path = create_database(tmp_path / "bench.db", 500, seed=1)
+    conn = sqlite3.connect(str(path))
+    assert conn.execute(f"SELECT count(*) FROM {TABLE}").fetchone()[0] == 500  # noqa: S608
+    # names are repeated, as in real data
+    assert conn.execute(f"SELECT count(DISTINCT name) FROM {TABLE}").fetchone()[0] < 500  # noqa: S608
+    conn.close()
+    # the same seed gives the same queries
+    assert sample_queries(path, 20, seed=1) == sample_queries(path, 20, seed=1)
+
+
+def test_run_benchmarks(tmp_path):
+    path = create_database(tmp_path / "bench.db", 500)
+    results = run_benchmarks({500: path}, list(VARIANTS), ENDPOINTS, requests=3, batch_size=2, warmup=1)
+    assert len(results["results"]) == len(VARIANTS) * len(ENDPOINTS)
+    for result in results["results"]:
+        assert result["errors"] == 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+        assert result["queries_per_s"] > 0
+    reconcile = next(r for r in results["results"] if r["endpoint"] == "reconcile")
+    assert reconcile["sql_ms_mean"] > 0
+
+    rows = compare(results, results)
+    assert len(rows) == len(results["results"])
+    assert all(row["p95_ms"] == 1 for row in rows)
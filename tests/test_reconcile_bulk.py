@@ -0,0 +1,128 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+from datasette.cli import cli
+
+from datasette_reconcile.bulk import get_datasette, get_query
+
+INPUT_CSV = """ref,dog,status,age
+a,fido,bad dog,3
+b,Pancakes,,5
+c,,good dog,
+d,FIDO,,
+e,scratch,good dog,3
+"""
+
+
+def test_get_query():
+    row = {"dog": " Fido ", "status": "bad dog", "age": "3"}
+    assert get_query(row, "dog") == {"query": "Fido"}
+    assert get_query(row, "dog", type_column="status", limit=2) == {"query": "Fido", "type": "bad dog", "limit": 2}
+    assert get_query({"dog": "Fido"}, "dog", type_column="status", type_="dog") == {"query": "Fido", "type": "dog"}
+    assert get_query(row, "dog", properties=[("age", "age"), ("name", "missing")]) == {
+        "query": "Fido",
+        "properties": [{"pid": "age", "v": "3"}],
+    }
+
+
+def test_get_datasette(db_path):
+    # offline runs aren't held to the server's default time limit
+    assert get_datasette(db_path).setting("sql_time_limit_ms") == 60_000
+    assert get_datasette(db_path, sql_time_limit_ms=5000).setting("sql_time_limit_ms") == 5000
+
+
+def run_reconcile(db_path, input_path, output_path, *args):
+    runner = CliRunner()
+    return runner.invoke(
+        cli,
+        [
+            "reconcile",
+            str(db_path),
+            "dogs",
+            str(input_path),
+            str(output_path),
+            "--column",
+            "dog",
+            "--name-field",
+            "name",
+            "--id-column",
+            "ref",
+            "--workers",
+            "2",
+            "--batch-size",
+            "2",
+            *args,
+        ],
+    )
+
+
+@pytest.mark.parametrize("input_name", ["input.csv", "input.jsonl"])
+def test_reconcile_bulk(db_path, tmp_path, input_name):
+    input_path = tmp_path / input_name
+    if input_name.endswith(".csv"):
+        input_path.write_text(INPUT_CSV)
+    else:
+        lines = INPUT_CSV.splitlines()
+        keys = lines[0].split(",")
+        input_path.write_text("\n".join(json.dumps(dict(zip(keys, line.split(",")))) for line in lines[1:]))
+    output_path = tmp_path / "output.jsonl"
+
+    result = run_reconcile(db_path, input_path, output_path)
+    assert result.exit_code == 0, result.output
+    rows = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert [row["row"] for row in rows] == [1, 2, 3, 4, 5]
+    assert [row["id"] for row in rows] == ["a", "b", "c", "d", "e"]
+    assert [[r["id"] for r in row["result"]] for row in rows] == [["3"], ["2", "5"], [], ["3"], ["4"]]
+    assert rows[0]["result"][0]["match"]
+    # the checkpoint is removed once the job has finished
+    assert not (tmp_path / "output.jsonl.checkpoint").exists()
+
+
+def test_reconcile_bulk_csv_output(db_path, tmp_path):
+    input_path = tmp_path / "input.csv"
+    input_path.write_text(INPUT_CSV)
+    output_path = tmp_path / "output.csv"
+
+    result = run_reconcile(
+        db_path, input_path, output_path, "--type-column", "status", "--property", "age", "--sql-time-limit-ms", "5000"
+    )
+    assert result.exit_code == 0, result.output
+    lines = output_path.read_text().splitlines()
+    assert lines[0] == "row,id,query,match_id,match_name,match_score,match"
+    assert lines[1] == "1,a,fido,3,Fido,100,True"
+    assert lines[2] == "2,b,Pancakes,5,Pancakes,100,True"
+    assert lines[3] == "3,c,,,,,"
+    assert len(lines) == 6
+
+
+def test_reconcile_bulk_resume(db_path, tmp_path):
+    input_path = tmp_path / "input.csv"
+    input_path.write_text(INPUT_CSV)
+    expected_path = tmp_path / "expected.jsonl"
+    assert run_reconcile(db_path, input_path, expected_path).exit_code == 0
+    expected = expected_path.read_text()
+
+    # an interrupted run, with a checkpoint after two rows and part of the third row written
+    output_path = tmp_path / "output.jsonl"
+    written = "".join(expected.splitlines(keepends=True)[:2])
+    output_path.write_text(written + '{"row":3,"id"')
+    checkpoint_path = tmp_path / "job.checkpoint"
+    checkpoint_path.write_text(json.dumps({"rows": 2, "offset": len(written.encode("utf-8"))}))
+
+    result = run_reconcile(db_path, input_path, output_path, "--resume", "--checkpoint", str(checkpoint_path))
+    assert result.exit_code == 0, result.output
+    assert "Resuming after row 2" in result.output
+    assert output_path.read_text() == expected
+    assert not checkpoint_path.exists()
+
+
+def test_reconcile_bulk_config_error(db_path, tmp_path):
+    input_path = tmp_path / "input.csv"
+    input_path.write_text(INPUT_CSV)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["reconcile", str(db_path), "dogs", str(input_path), str(tmp_path / "out.jsonl"), "--column", "dog"]
+    )
+    assert result.exit_code == 1
+    assert "name field" in result.output
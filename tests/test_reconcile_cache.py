@@ -0,0 +1,236 @@
+import json
+
+import httpx
+import pytest
+import sqlite_utils
+from datasette.app import Datasette
+from datasette.utils.asgi import Request
+
+from datasette_reconcile.cache import LRUCache, ResultCache
+from datasette_reconcile.reconcile import ReconcileAPI
+from datasette_reconcile.state import get_state
+from tests.conftest import create_db, plugin_metadata
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    info = cache.cache_info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.evictions == 1
+    assert info.currsize == 2
+
+
+def test_lru_cache_maxbytes():
+    cache = LRUCache(maxsize=None, maxbytes=10)
+    cache.set("a", 1, 4)
+    cache.set("b", 2, 4)
+    cache.set("a", 3, 4)
+    assert cache.currbytes == 8
+    cache.set("c", 4, 4)
+    assert "b" not in cache
+    assert cache.get("a") == 3
+    assert cache.currbytes == 8
+    assert cache.evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_result_cache(tmp_path):
+    cache_path = str(tmp_path / "cache.db")
+    cache = ResultCache(1024, cache_path)
+    await cache.set_many({"a": [{"id": "1"}], "b": []}, (1, None))
+    assert await cache.get_many(["a", "b", "c"], (1, None)) == {"a": [{"id": "1"}], "b": []}
+    assert await cache.get_many(["a"], (2, None)) == {}
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    # the old entry is removed from both memory and disk
+    assert stats["invalidations"] == 2
+
+    # a second process sharing the cache on disk
+    other_cache = ResultCache(1024, cache_path)
+    assert await other_cache.get_many(["a", "b"], (1, None)) == {"b": []}
+    assert other_cache.stats()["disk_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_result_cache_disk_pruning(tmp_path):
+    cache_path = str(tmp_path / "cache.db")
+    cache = ResultCache(1024, cache_path, disk_maxbytes=20)
+    await cache.set_many({"a": ["a" * 3]}, (1, None))
+    await cache.set_many({"b": ["b" * 3]}, (1, None))
+    # each result takes 7 bytes, so the oldest is removed to make room for "c"
+    await cache.set_many({"c": ["c" * 3]}, (1, None))
+    assert cache.stats()["disk_evictions"] == 1
+    other_cache = ResultCache(1024, cache_path)
+    assert set(await other_cache.get_many(["a", "b", "c"], (1, None))) == {"b", "c"}
+
+    # with a maximum age of zero, older results are removed as new ones are added
+    cache = ResultCache(1024, str(tmp_path / "aged.db"), max_age=0)
+    await cache.set_many({"a": []}, (1, None))
+    await cache.set_many({"b": []}, (1, None))
+    other_cache = ResultCache(1024, str(tmp_path / "aged.db"))
+    assert await other_cache.get_many(["a", "b"], (1, None)) == {"b": []}
+
+
+@pytest.mark.asyncio
+async def test_result_cache_exact_text(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "result_cache": True}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        for query in ["Cleo", "Cleo ", "CLEO"]:
+            response = await client.post(
+                "http://localhost/test/dogs/-/reconcile", data={"queries": json.dumps({"q0": {"query": query}})}
+            )
+            assert response.status_code == 200
+    # each spelling is searched for and cached separately
+    stats = get_state(ds).result_cache.stats()
+    assert stats["hits"] == 0
+    assert stats["misses"] == 3
+
+
+@pytest.mark.asyncio
+async def test_result_cache_reconcile(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "result_cache": True}))
+    queries = {"queries": json.dumps({"q0": {"query": "fido"}, "q1": {"query": "Pancakes "}})}
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        first = await client.post("http://localhost/test/dogs/-/reconcile", data=queries)
+        second = await client.post("http://localhost/test/dogs/-/reconcile", data=queries)
+        assert first.json() == second.json()
+        stats = get_state(ds).result_cache.stats()
+        assert stats["hits"] == 2
+        assert stats["misses"] == 2
+
+        sqlite_utils.Database(db_path)["dogs"].insert({"id": 6, "name": "Fido", "age": 1, "status": "good dog"})
+        third = await client.post("http://localhost/test/dogs/-/reconcile", data=queries)
+        assert len(third.json()["q0"]["result"]) == 2
+        assert get_state(ds).result_cache.stats()["invalidations"] == 2
+
+
+@pytest.mark.asyncio
+async def test_result_cache_memory_database():
+    ds = Datasette(metadata=plugin_metadata({"name_field": "name", "type_field": "status", "result_cache": True}))
+    db = ds.add_memory_database("test")
+    await db.execute_write("CREATE TABLE dogs (id INTEGER PRIMARY KEY, name TEXT, status TEXT)")
+    await db.execute_write("INSERT INTO dogs VALUES (1, 'Fido', 'good dog')")
+    queries = {"queries": json.dumps({"q0": {"query": "fido"}})}
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        first = await client.post("http://localhost/test/dogs/-/reconcile", data=queries)
+        assert len(first.json()["q0"]["result"]) == 1
+
+        # inserting rows invalidates the cached results and types
+        await db.execute_write("INSERT INTO dogs VALUES (2, 'Fido', 'bad dog')")
+        second = await client.post("http://localhost/test/dogs/-/reconcile", data=queries)
+        assert len(second.json()["q0"]["result"]) == 2
+        manifest = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert {t["id"] for t in manifest.json()["defaultTypes"]} == {"good dog", "bad dog"}
+    assert get_state(ds).result_cache.stats()["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_config_cache_hits(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        for _ in range(3):
+            response = await client.get("http://localhost/test/dogs/-/reconcile")
+            assert 200 == response.status_code
+    info = get_state(ds).config_cache.cache_info()
+    assert info.misses == 1
+    assert info.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_config_cache_invalidated_on_change(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert 200 == response.status_code
+
+        sqlite_utils.Database(db_path)["dogs"].enable_fts(["name"])
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert 200 == response.status_code
+    info = get_state(ds).config_cache.cache_info()
+    assert info.misses == 2
+    assert info.hits == 0
+
+
+@pytest.mark.asyncio
+async def test_manifest_etag(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert 200 == response.status_code
+        etag = response.headers["etag"]
+        assert response.headers["cache-control"] == "public, max-age=60"
+        assert response.json()["name"] == "test dogs reconciliation"
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile", headers={"If-None-Match": etag})
+        assert 304 == response.status_code
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile", headers={"If-None-Match": f"W/{etag}"})
+        assert 304 == response.status_code
+
+        response = await client.get("http://example.com/test/dogs/-/reconcile", headers={"If-None-Match": etag})
+        assert 200 == response.status_code
+        assert response.json()["view"]["url"].startswith("http://example.com/")
+
+        info = get_state(ds).manifest_cache.cache_info()
+        assert info.misses == 2
+        assert info.hits == 2
+
+        sqlite_utils.Database(db_path)["dogs"].add_column("colour", str)
+        response = await client.get("http://localhost/test/dogs/-/reconcile", headers={"If-None-Match": etag})
+        assert 200 == response.status_code
+        assert response.headers["etag"] != etag
+        assert "colour" in [p["name"] for p in response.json()["extend"]["property_settings"]]
+
+
+@pytest.mark.asyncio
+async def test_manifest_private_cache_control(db_path):
+    metadata = plugin_metadata({"name_field": "name"})
+    metadata["databases"]["test"]["tables"]["dogs"]["allow"] = {"id": "root"}
+    ds = Datasette([db_path], metadata=metadata)
+    cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+    async with httpx.AsyncClient(app=ds.app(), cookies=cookies) as client:
+        for path in ["/test/dogs/-/reconcile", "/test/dogs/-/reconcile/extend/propose"]:
+            response = await client.get(f"http://localhost{path}")
+            assert 200 == response.status_code
+            # a table that needs permission to view must not be stored by shared caches
+            assert response.headers["cache-control"].startswith("private")
+
+    api = ReconcileAPI({"name_field": "name"}, "test", "dogs", ds)
+    request = Request.fake("/test/dogs/-/reconcile")
+    assert api._cacheable_response(request, "{}", '"etag"').headers["Cache-Control"] == "public, max-age=60"
+    request.scope["actor"] = {"id": "root"}
+    assert api._cacheable_response(request, "{}", '"etag"').headers["Cache-Control"] == "private, max-age=60"
+
+
+@pytest.mark.asyncio
+async def test_properties_etag(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get("http://localhost/test/dogs/-/reconcile/extend/propose")
+        assert 200 == response.status_code
+        etag = response.headers["etag"]
+
+        response = await client.get(
+            "http://localhost/test/dogs/-/reconcile/extend/propose", headers={"If-None-Match": etag}
+        )
+        assert 304 == response.status_code
+
+        response = await client.get(
+            "http://localhost/test/dogs/-/reconcile/suggest/property?prefix=a", headers={"If-None-Match": etag}
+        )
+        assert 200 == response.status_code
+    assert get_state(ds).properties_cache.cache_info().misses == 1
@@ -296,3 +296,17 @@ async def test_plugin_configuration_no_description_field(ds):
         "dogs",
     )
     assert config["description_field"] is None
+
+
+@pytest.mark.asyncio
+async def test_plugin_configuration_execution_mode(ds):
+    config = await check_config({"name_field": "name"}, ds.get_database("test"), "dogs")
+    assert config["execution_mode"] == "serial"
+    with pytest.raises(ReconcileError, match="execution_mode must be one of"):
+        await check_config({"name_field": "name", "execution_mode": "BLAH"}, ds.get_database("test"), "dogs")
+
+
+@pytest.mark.asyncio
+async def test_plugin_configuration_max_concurrency(ds):
+    with pytest.raises(TypeError, match="max_concurrency in reconciliation config must be a positive integer"):
+        await check_config({"name_field": "name", "max_concurrency": 0}, ds.get_database("test"), "dogs")
@@ -0,0 +1,430 @@
+import asyncio
+import json
+import sqlite3
+import warnings
+
+import httpx
+import pytest
+import sqlite_utils
+from click.testing import CliRunner
+from datasette.app import Datasette
+from datasette.cli import cli
+
+from datasette_reconcile.indexes import (
+    advise_filter_indexes,
+    build_names_index,
+    build_trigram_index,
+    names_index_status,
+    trigram_index_status,
+)
+from datasette_reconcile.prefix_index import PrefixIndex, TypeIndex, get_prefix_index
+from datasette_reconcile.queries import get_selective_trigrams, get_trigram_query, get_trigrams
+from datasette_reconcile.state import get_state
+from datasette_reconcile.utils import encode_cursor
+from tests.conftest import create_db, plugin_metadata
+
+
+@pytest.fixture
+def trigram_db_path(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    conn = sqlite3.connect(db_path)
+    build_trigram_index(conn, "dogs", "name")
+    conn.close()
+    return db_path
+
+
+@pytest.fixture
+def names_db_path(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    conn = sqlite3.connect(db_path)
+    build_names_index(conn, "dogs", "name")
+    conn.close()
+    return db_path
+
+
+def test_get_trigram_query():
+    assert get_trigrams(" Fido ") == ["fid", "ido"]
+    assert get_trigram_query(get_trigrams(" Fido ")) == '"fid" OR "ido"'
+    assert get_trigram_query(get_trigrams('a"bc')) == '"a""b" OR """bc"'
+
+
+def test_get_selective_trigrams():
+    counts = [("fid", 40), ("ido", 5), ("do ", 500), ("o f", 10)]
+    assert get_selective_trigrams(counts, max_rows=100) == ["ido", "o f", "fid"]
+    assert get_selective_trigrams(counts, max_rows=12) == ["ido"]
+    assert get_selective_trigrams(counts, max_rows=4) == []
+
+
+def test_trigram_index_status(trigram_db_path):
+    conn = sqlite3.connect(trigram_db_path)
+    status = trigram_index_status(conn, "dogs", "name")
+    assert status["exists"]
+    assert not status["stale"]
+    assert status["rows"] == 5
+
+    conn.execute("insert into dogs (id, name, age, status) values (6, 'Biscuit', 2, 'good dog')")
+    conn.commit()
+    assert not trigram_index_status(conn, "dogs", "name")["stale"]
+
+    conn.execute("drop trigger dogs_reconcile_trigram_ai")
+    assert trigram_index_status(conn, "dogs", "name")["stale"]
+    assert trigram_index_status(conn, "dogs", "status")["stale"]
+
+
+def test_trigram_index_status_missing(db_path):
+    conn = sqlite3.connect(db_path)
+    status = trigram_index_status(conn, "dogs", "name")
+    assert not status["exists"]
+    assert status["stale"]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_trigram(trigram_db_path):
+    app = Datasette([trigram_db_path], metadata=plugin_metadata({"name_field": "name", "trigram_index": True})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps({"q0": {"query": "pancaks"}, "q1": {"query": "fi"}})},
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert {r["id"] for r in data["q0"]["result"]} == {"2", "5"}
+        assert data["q0"]["result"][0]["score"] == 93
+        assert [r["id"] for r in data["q1"]["result"]] == ["3"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("execution_mode", ["serial", "batch"])
+async def test_response_queries_trigram_substring(trigram_db_path, execution_mode):
+    metadata = plugin_metadata({"name_field": "name", "trigram_index": True, "execution_mode": execution_mode})
+    # the near miss search works with a read-only database
+    app = Datasette(immutables=[trigram_db_path], metadata=metadata).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps({"q0": {"query": "ancake"}, "q1": {"query": "scrach"}})},
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert {r["id"] for r in data["q0"]["result"]} == {"2", "5"}
+        assert [r["id"] for r in data["q1"]["result"]] == ["4"]
+
+
+@pytest.mark.asyncio
+async def test_response_suggest_entity_trigram(trigram_db_path):
+    app = Datasette([trigram_db_path], metadata=plugin_metadata({"name_field": "name", "trigram_index": True})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.get("http://localhost/test/dogs/-/reconcile/suggest/entity?prefix=scr")
+        assert 200 == response.status_code
+        data = response.json()
+        assert data["result"] == [{"id": 4, "name": "Scratch"}]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_trigram_missing(db_path):
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "trigram_index": True})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        with pytest.warns(UserWarning, match="Index dogs_reconcile_trigram not found"):
+            response = await client.post(
+                "http://localhost/test/dogs/-/reconcile",
+                data={"queries": json.dumps({"q0": {"query": "fido"}})},
+            )
+        assert 200 == response.status_code
+        assert [r["id"] for r in response.json()["q0"]["result"]] == ["3"]
+
+
+def test_names_index_status(names_db_path):
+    conn = sqlite3.connect(names_db_path)
+    status = names_index_status(conn, "dogs", "name")
+    assert status["exists"]
+    assert not status["stale"]
+    assert status["rows"] == 5
+    assert [row[0] for row in conn.execute("select name from dogs_reconcile_names where rowid = 2")] == ["pancakes"]
+
+    conn.execute("insert into dogs (id, name, age, status) values (6, ' Biscuit ', 2, 'good dog')")
+    conn.execute("update dogs set name = 'Cleopatra' where id = 1")
+    conn.commit()
+    assert not names_index_status(conn, "dogs", "name")["stale"]
+    names = dict(conn.execute("select rowid, name from dogs_reconcile_names where rowid in (1, 6)").fetchall())
+    assert names == {1: "cleopatra", 6: "biscuit"}
+
+    assert names_index_status(conn, "dogs", "status")["stale"]
+    conn.execute("drop trigger dogs_reconcile_names_ad")
+    assert names_index_status(conn, "dogs", "name")["stale"]
+
+
+@pytest.mark.asyncio
+async def test_response_queries_exact_match(names_db_path):
+    app = Datasette([names_db_path], metadata=plugin_metadata({"name_field": "name", "normalised_index": True})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={
+                "queries": json.dumps(
+                    {
+                        "q0": {"query": "PANCAKES "},
+                        "q1": {"query": "fido", "type": "dogs"},
+                        "q2": {"query": "scratch", "properties": [{"pid": "status", "v": "good dog"}]},
+                        "q3": {"query": "Cleopat"},
+                    }
+                )
+            },
+        )
+        assert 200 == response.status_code
+        data = response.json()
+        assert [r["id"] for r in data["q0"]["result"]] == ["2", "5"]
+        assert all(r["match"] for r in data["q0"]["result"])
+        assert [r["id"] for r in data["q1"]["result"]] == ["3"]
+        assert [r["id"] for r in data["q2"]["result"]] == ["4"]
+        assert data["q3"]["result"] == []
+
+
+def test_reconcile_index_command(tmp_path_factory):
+    db_path = str(create_db(tmp_path_factory, False))
+    runner = CliRunner()
+
+    result = runner.invoke(cli, ["reconcile-index", db_path, "dogs", "--name-field", "name", "--trigram", "--check"])
+    assert result.exit_code == 1
+    assert json.loads(result.output)["trigram"]["exists"] is False
+
+    result = runner.invoke(cli, ["reconcile-index", db_path, "dogs", "--name-field", "name", "--trigram"])
+    assert result.exit_code == 0
+    assert json.loads(result.output)["trigram"]["stale"] is False
+
+    result = runner.invoke(cli, ["reconcile-index", db_path, "dogs", "--name-field", "name", "--trigram", "--check"])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ["reconcile-index", db_path, "dogs", "--name-field", "name"])
+    assert result.exit_code == 2
+
+    result = runner.invoke(cli, ["reconcile-index", db_path, "dogs", "--name-field", "name", "--normalised"])
+    assert result.exit_code == 0
+    assert json.loads(result.output)["normalised"]["stale"] is False
+
+
+SUGGEST_NAMES = ["Bonnie", "Bobby", "bo", "Boris", "Bolt", "Bonzo", "Bo Peep", "Biscuit", "Rambo"]
+
+
+@pytest.fixture
+def suggest_db_path(tmp_path_factory, request):
+    db_path = create_db(tmp_path_factory, False)
+    db = sqlite_utils.Database(db_path)
+    db["dogs"].insert_all(
+        {"id": index, "name": name, "age": 1, "status": "good dog"} for index, name in enumerate(SUGGEST_NAMES, 6)
+    )
+    if request.param in ["fts4", "fts5"]:
+        db["dogs"].enable_fts(["name"], fts_version=request.param)
+    elif request.param == "trigram":
+        build_trigram_index(db.conn, "dogs", "name")
+    elif request.param == "normalised":
+        build_names_index(db.conn, "dogs", "name")
+    db.conn.close()
+    return db_path
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("suggest_db_path", ["none", "fts4", "fts5", "trigram", "normalised"], indirect=True)
+async def test_response_suggest_entity_pages(suggest_db_path):
+    config = {"name_field": "name", "trigram_index": True, "normalised_index": True}
+    app = Datasette([suggest_db_path], metadata=plugin_metadata(config)).app()
+    async with httpx.AsyncClient(app=app) as client:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            names = []
+            params = {"prefix": "bo"}
+            for _ in range(3):
+                response = await client.get("http://localhost/test/dogs/-/reconcile/suggest/entity", params=params)
+                assert 200 == response.status_code
+                data = response.json()
+                names.extend(r["name"] for r in data["result"])
+                if "cursor" not in data:
+                    break
+                params["cursor"] = data["cursor"]
+
+            # a numeric cursor is still treated as an offset
+            response = await client.get(
+                "http://localhost/test/dogs/-/reconcile/suggest/entity", params={"prefix": "bo", "cursor": "5"}
+            )
+            assert [r["name"] for r in response.json()["result"]] == names[5:]
+
+    assert len(names) == len(set(names))
+    assert set(names) == {"Bonnie", "Bobby", "bo", "Boris", "Bolt", "Bonzo", "Bo Peep"}
+
+
+@pytest.mark.asyncio
+async def test_response_suggest_entity_bad_cursor(db_path):
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
+    async with httpx.AsyncClient(app=app) as client:
+        for cursor in ["abc!", encode_cursor({"a": 1}), encode_cursor(["a", 1])]:
+            response = await client.get(
+                "http://localhost/test/dogs/-/reconcile/suggest/entity", params={"prefix": "f", "cursor": cursor}
+            )
+            assert 400 == response.status_code
+
+
+def test_prefix_index():
+    prefix_index = PrefixIndex([(1, 1, "Bobby"), (2, 2, " bo"), (3, 3, "Rambo"), (4, 4, "BOLT"), (5, 5, "Bobby")])
+    assert len(prefix_index) == 5
+    assert prefix_index.search("bo", 10) == [
+        (["bo", 2], 2, " bo"),
+        (["bobby", 1], 1, "Bobby"),
+        (["bobby", 5], 5, "Bobby"),
+        (["bolt", 4], 4, "BOLT"),
+    ]
+    assert [r[1] for r in prefix_index.search("bo", 2, after=["bobby", 1])] == [5, 4]
+    assert [r[1] for r in prefix_index.search("bo", 2, offset=3)] == [4]
+    assert prefix_index.search("x", 2) == []
+    with pytest.raises(ValueError, match="Cursor does not match"):
+        prefix_index.search("bo", 2, after=[1])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("suggest_db_path", ["normalised"], indirect=True)
+async def test_response_suggest_entity_prefix_index(suggest_db_path):
+    config = {"name_field": "name", "normalised_index": True}
+    ds_sql = Datasette([suggest_db_path], metadata=plugin_metadata(config))
+    ds_memory = Datasette([suggest_db_path], metadata=plugin_metadata({**config, "prefix_index": True}))
+    url = "http://localhost/test/dogs/-/reconcile/suggest/entity"
+    next_page = None
+    for params in [{"prefix": "bo"}, {"prefix": "BON"}, {"prefix": "x"}, {"prefix": "bo", "cursor": "2"}]:
+        async with httpx.AsyncClient(app=ds_sql.app()) as client:
+            expected = (await client.get(url, params=params)).json()
+        async with httpx.AsyncClient(app=ds_memory.app()) as client:
+            response = await client.get(url, params=params)
+            assert response.json() == expected
+            if next_page is None:
+                next_page = await client.get(url, params={**params, "cursor": expected["cursor"]})
+                assert [r["name"] for r in next_page.json()["result"]] == ["Bonzo", "Boris"]
+
+    # the index is rebuilt when the table changes
+    sqlite_utils.Database(suggest_db_path)["dogs"].insert({"id": 20, "name": "Bongo", "age": 1, "status": "good dog"})
+    async with httpx.AsyncClient(app=ds_memory.app()) as client:
+        response = await client.get(url, params={"prefix": "bong"})
+        assert [r["name"] for r in response.json()["result"]] == ["Bongo"]
+    assert len(get_state(ds_memory).prefix_indexes) == 1
+
+
+@pytest.mark.asyncio
+async def test_response_suggest_entity_prefix_index_too_big(db_path):
+    config = {"name_field": "name", "prefix_index": True, "prefix_index_max_rows": 4}
+    ds = Datasette([db_path], metadata=plugin_metadata(config))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get("http://localhost/test/dogs/-/reconcile/suggest/entity?prefix=f")
+        assert [r["name"] for r in response.json()["result"]] == ["Fido"]
+    assert get_state(ds).prefix_indexes.keys()
+    assert all(get_state(ds).prefix_indexes.get(key) is None for key in get_state(ds).prefix_indexes.keys())
+
+
+@pytest.mark.asyncio
+async def test_prefix_index_locks_and_budget(db_path):
+    ds = Datasette([db_path])
+    state = get_state(ds)
+    names = {"id_field": "id", "name_field": "name"}
+    statuses = {"id_field": "id", "name_field": "status"}
+
+    # building the index for one table doesn't wait for another table's index
+    lock = asyncio.Lock()
+    state.prefix_index_locks["test", "other", "id", "name"] = lock
+    async with lock:
+        prefix_index = await asyncio.wait_for(get_prefix_index(ds, "test", "dogs", names), 1)
+    assert len(prefix_index) == 5
+
+    # the indexes held share a budget of rows, dropping the least recently used
+    state.prefix_indexes.maxbytes = 8
+    await get_prefix_index(ds, "test", "dogs", statuses)
+    assert [key[:4] for key in state.prefix_indexes.keys()] == [("test", "dogs", "id", "status")]
+    assert state.prefix_indexes.currbytes == 5
+
+
+def test_type_index():
+    type_index = TypeIndex([("good dog", 2), ("bad dog", 3), ("Dog", 1), ("cat", 5), (4, 1)])
+    assert len(type_index) == 5
+    assert type_index.search("dog", 5) == ["Dog", "bad dog", "good dog"]
+    assert type_index.search("DOG", 2) == ["Dog", "bad dog"]
+    assert type_index.search("4", 5) == [4]
+    assert type_index.search("x", 5) == []
+    assert type_index.most_common(3) == ["cat", "bad dog", "good dog"]
+
+
+@pytest.mark.asyncio
+async def test_type_index_cached(tmp_path_factory):
+    db_path = create_db(tmp_path_factory, False)
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "type_field": "status"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        for prefix in ["good", "bad", "goo"]:
+            response = await client.get(
+                "http://localhost/test/dogs/-/reconcile/suggest/type", params={"prefix": prefix}
+            )
+            assert 200 == response.status_code
+        assert response.json()["result"] == [{"id": "good dog", "name": "good dog"}]
+        info = get_state(ds).type_indexes.cache_info()
+        assert info.misses == 1
+        assert info.hits == 2
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert response.json()["defaultTypes"] == [
+            {"id": "bad dog", "name": "bad dog"},
+            {"id": "good dog", "name": "good dog"},
+        ]
+
+        sqlite_utils.Database(db_path)["dogs"].insert({"id": 6, "name": "Tiddles", "age": 1, "status": None})
+        response = await client.get("http://localhost/test/dogs/-/reconcile/suggest/type", params={"prefix": "obj"})
+        assert response.json()["result"] == [{"id": "object", "name": "Object"}]
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert len(response.json()["defaultTypes"]) == 3
+
+
+def test_advise_filter_indexes(db_path):
+    conn = sqlite3.connect(db_path)
+    advice = advise_filter_indexes(conn, "dogs", {"id": ["id_field"], "status": ["type_field", "property"]})
+    assert [(item["column"], item["indexed"]) for item in advice] == [("id", True), ("status", False)]
+    assert advice[1]["used_as"] == ["property", "type_field"]
+    assert advice[1]["create_sql"] == "CREATE INDEX IF NOT EXISTS idx_dogs_status ON dogs (status);"
+    assert advice[0]["create_sql"] is None
+
+
+@pytest.mark.asyncio
+async def test_response_index_advice(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "type_field": "status"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"queries": json.dumps({"q0": {"query": "fido", "properties": [{"pid": "age", "v": 3}]}})},
+        )
+        assert 200 == response.status_code
+
+        response = await client.get("http://localhost/test/dogs/-/reconcile/advisor")
+        assert 200 == response.status_code
+        data = response.json()
+        assert data["table"] == "dogs"
+        assert {item["column"]: item["used_as"] for item in data["indexes"]} == {
+            "id": ["id_field"],
+            "status": ["type_field"],
+            "age": ["property"],
+        }
+        assert {item["column"]: item["indexed"] for item in data["indexes"]} == {
+            "id": True,
+            "status": False,
+            "age": False,
+        }
+
+
+def test_reconcile_advise_command(tmp_path_factory):
+    db_path = str(create_db(tmp_path_factory, False))
+    runner = CliRunner()
+
+    args = ["reconcile-advise", db_path, "dogs", "--id-field", "id", "--type-field", "status", "--property", "age"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert [item["indexed"] for item in json.loads(result.output)] == [True, False, False]
+
+    result = runner.invoke(cli, [*args, "--create"])
+    assert result.exit_code == 0
+    assert [item["indexed"] for item in json.loads(result.output)] == [True, True, True]
+
+    result = runner.invoke(cli, ["reconcile-advise", db_path, "dogs"])
+    assert result.exit_code == 2
+
+    result = runner.invoke(cli, ["reconcile-advise", db_path, "dogs", "--property", "colour"])
+    assert result.exit_code == 1
+    assert "no such column" in result.output
@@ -0,0 +1,175 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from datasette_reconcile.admission import AdmissionError
+from datasette_reconcile.jobs import JobManager
+from datasette_reconcile.metrics import Metrics
+from datasette_reconcile.state import get_state
+from datasette_reconcile.utils import get_job_manager
+from tests.conftest import plugin_datasette
+
+QUERY_NAMES = ["fido", "Pancakes", "FIDO", "scratch", "nobody"]
+
+
+async def wait_for_job(client, job_url):
+    for _ in range(100):
+        response = await client.get(job_url)
+        if response.json()["status"] in ("finished", "failed"):
+            return response.json()
+        await asyncio.sleep(0.01)
+    msg = "job did not finish"
+    raise AssertionError(msg)
+
+
+@pytest.mark.asyncio
+async def test_reconcile_job(db_path):
+    queries = {f"q{i}": {"query": QUERY_NAMES[i % len(QUERY_NAMES)]} for i in range(250)}
+    app = plugin_datasette(db_path, {"name_field": "name"}).app()
+    async with httpx.AsyncClient(app=app, base_url="http://localhost") as client:
+        response = await client.post("/test/dogs/-/reconcile/jobs", data={"queries": json.dumps(queries)})
+        assert response.status_code == 202
+        job = response.json()
+        assert job["status"] in ("queued", "running")
+        assert job["queries"] == 250
+        assert job["url"] == f"/test/dogs/-/reconcile/jobs/{job['id']}"
+        assert response.headers["Location"] == job["url"]
+
+        job = await wait_for_job(client, job["url"])
+        assert job["status"] == "finished"
+        assert job["completed"] == 250
+        assert job["expires"] == job["finished"] + 3600
+
+        # page through the results
+        results = {}
+        params = {"limit": 100}
+        while True:
+            response = await client.get(job["results_url"], params=params)
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page["results"]) <= 100
+            results.update(page["results"])
+            if "cursor" not in page:
+                break
+            params["cursor"] = page["cursor"]
+        assert set(results) == set(queries)
+
+        expected = (await client.post("/test/dogs/-/reconcile", data={"queries": json.dumps(queries)})).json()
+        assert results == expected
+
+
+@pytest.mark.asyncio
+async def test_reconcile_job_errors(db_path):
+    app = plugin_datasette(db_path, {"name_field": "name"}, {"job_retention": 0}).app()
+    async with httpx.AsyncClient(app=app, base_url="http://localhost") as client:
+        response = await client.post("/test/dogs/-/reconcile/jobs")
+        assert response.status_code == 400
+
+        response = await client.get("/test/dogs/-/reconcile/jobs/missing")
+        assert response.status_code == 404
+
+        response = await client.post(
+            "/test/dogs/-/reconcile/jobs", data={"queries": json.dumps({"q0": {"query": "fido"}})}
+        )
+        job_url = response.json()["url"]
+        response = await client.get(f"{job_url}/results", params={"limit": "x"})
+        assert response.status_code == 400
+
+        # with no retention the job is removed as soon as it has finished
+        for _ in range(100):
+            response = await client.get(job_url)
+            if response.status_code == 404:
+                break
+            await asyncio.sleep(0.01)
+        assert response.status_code == 404
+
+
+class FakeAPI:
+    database = "test"
+    table = "dogs"
+
+    def __init__(self, release, *, fail=False):
+        self.release = release
+        self.fail = fail
+
+    async def _reconcile_queries(self, queries, chunk_size=None):  # noqa: ARG002
+        await self.release.wait()
+        if self.fail:
+            msg = "no such table"
+            raise ValueError(msg)
+        for query_id in queries:
+            yield query_id, []
+
+
+@pytest.mark.asyncio
+async def test_job_manager():
+    metrics = Metrics()
+    manager = JobManager(concurrency=1, retention=60, metrics=metrics)
+    release = asyncio.Event()
+    first = manager.submit(FakeAPI(release), {"q0": {"query": "a"}})
+    second = manager.submit(FakeAPI(release, fail=True), {"q0": {"query": "b"}})
+    await asyncio.sleep(0)
+    # only one job runs at once
+    assert first.status == "running"
+    assert second.status == "queued"
+
+    release.set()
+    while second.finished is None:
+        await asyncio.sleep(0)
+    assert first.status == "finished"
+    assert first.results == [("q0", [])]
+    assert second.status == "failed"
+    assert second.error == "no such table"
+    assert manager.get(first.id, "test", "dogs") is first
+    assert manager.get(first.id, "test", "cats") is None
+    assert metrics.get("reconcile_jobs_total", status="submitted") == 2
+    assert metrics.get("reconcile_jobs_total", status="failed") == 1
+
+
+@pytest.mark.asyncio
+async def test_job_manager_limits():
+    manager = JobManager(concurrency=1, retention=60, max_active=2, max_kept=1, retry_after=3)
+    release = asyncio.Event()
+    jobs = [manager.submit(FakeAPI(release), {"q0": {"query": "a"}}) for _ in range(2)]
+
+    # no more jobs can be queued until one has finished
+    with pytest.raises(AdmissionError) as e:
+        manager.submit(FakeAPI(release), {"q0": {"query": "a"}})
+    assert e.value.status == 429
+    assert e.value.reason == "max_active_jobs"
+    assert e.value.retry_after == 3
+
+    release.set()
+    while jobs[1].finished is None:
+        await asyncio.sleep(0)
+    third = manager.submit(FakeAPI(release), {"q0": {"query": "a"}})
+    # only the most recently finished job is kept
+    assert manager.get(jobs[0].id, "test", "dogs") is None
+    assert manager.get(jobs[1].id, "test", "dogs") is jobs[1]
+    assert manager.get(third.id, "test", "dogs") is third
+
+
+@pytest.mark.asyncio
+async def test_reconcile_job_limits(db_path):
+    ds = plugin_datasette(db_path, {"name_field": "name", "max_job_size": 2}, {"max_active_jobs": 1, "retry_after": 7})
+    async with httpx.AsyncClient(app=ds.app(), base_url="http://localhost") as client:
+        queries = {f"q{i}": {"query": "fido"} for i in range(3)}
+        response = await client.post("/test/dogs/-/reconcile/jobs", data={"queries": json.dumps(queries)})
+        assert response.status_code == 413
+        assert response.json()["error"] == "Too many queries in one request (3, limit 2)"
+
+        # a queued or running job stops another from being submitted
+        release = asyncio.Event()
+        get_job_manager(ds).submit(FakeAPI(release), {"q0": {"query": "a"}})
+        response = await client.post(
+            "/test/dogs/-/reconcile/jobs", data={"queries": json.dumps({"q0": {"query": "a"}})}
+        )
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "7"
+        release.set()
+
+    metrics = get_state(ds).metrics
+    assert metrics.get("reconcile_rejected_requests_total", endpoint="submit_job", reason="max_job_size") == 1
+    assert metrics.get("reconcile_rejected_requests_total", endpoint="submit_job", reason="max_active_jobs") == 1
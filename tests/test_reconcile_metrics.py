@@ -0,0 +1,84 @@
+import json
+
+import httpx
+import pytest
+from datasette.app import Datasette
+
+from datasette_reconcile.metrics import SIZE_BUCKETS, Histogram, Metrics, render_prometheus
+from datasette_reconcile.state import get_state
+from tests.conftest import plugin_metadata
+
+
+def test_histogram():
+    histogram = Histogram((1, 5, 10))
+    for value in [0.5, 1, 3, 20]:
+        histogram.observe(value)
+    histogram.observe(7, count=2)
+    assert list(histogram.cumulative()) == [(1, 2), (5, 3), (10, 5), (float("inf"), 6)]
+    assert histogram.count == 6
+    assert histogram.sum == 38.5
+
+
+def test_render_prometheus():
+    metrics = Metrics()
+    metrics.increment("reconcile_requests_total", 2, endpoint="reconcile", table='say "hi"')
+    metrics.observe("reconcile_batch_size", 3, buckets=SIZE_BUCKETS)
+    text = render_prometheus(metrics, {"config": {"hits": 3, "misses": 1, "evictions": 0, "entries": 1}})
+    lines = text.splitlines()
+    assert "# TYPE reconcile_requests_total counter" in lines
+    assert 'reconcile_requests_total{endpoint="reconcile",table="say \\"hi\\""} 2' in lines
+    assert "# TYPE reconcile_batch_size histogram" in lines
+    assert 'reconcile_batch_size_bucket{le="2"} 0' in lines
+    assert 'reconcile_batch_size_bucket{le="5"} 1' in lines
+    assert 'reconcile_batch_size_bucket{le="+Inf"} 1' in lines
+    assert "reconcile_batch_size_sum 3" in lines
+    assert "reconcile_batch_size_count 1" in lines
+    assert 'reconcile_cache_hit_ratio{cache="config"} 0.75' in lines
+    assert text.endswith("\n")
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name", "result_cache": True}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        queries = {"q0": {"query": "fido"}, "q1": {"query": "fido"}, "q2": {"query": "pancakes"}}
+        response = await client.post("http://localhost/test/dogs/-/reconcile", data={"queries": json.dumps(queries)})
+        assert 200 == response.status_code
+        response = await client.post(
+            "http://localhost/test/dogs/-/reconcile",
+            data={"extend": json.dumps({"ids": ["1", "2"], "properties": [{"id": "status"}]})},
+        )
+        assert 200 == response.status_code
+
+        response = await client.get("http://localhost/-/reconcile/metrics")
+        assert 200 == response.status_code
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        lines = response.text.splitlines()
+
+    assert 'reconcile_requests_total{database="test",endpoint="reconcile",table="dogs"} 2' in lines
+    assert 'reconcile_request_duration_seconds_count{endpoint="reconcile"} 2' in lines
+    assert "reconcile_batch_size_sum 3" in lines
+    assert "reconcile_query_duration_seconds_count 2" in lines
+    assert "reconcile_candidates_count 2" in lines
+    assert "reconcile_extend_ids_sum 2" in lines
+    assert 'reconcile_stage_duration_seconds_count{stage="scoring"} 1' in lines
+    assert 'reconcile_stage_duration_seconds_count{stage="sql"} 3' in lines
+    assert 'reconcile_cache_misses_total{cache="result"} 2' in lines
+
+    # the metrics are updated by each request
+    metrics = get_state(ds).metrics
+    assert metrics.get("reconcile_requests_total", endpoint="reconcile", database="test", table="dogs") == 2
+    assert metrics.histogram("reconcile_extend_ids").count == 1
+
+
+@pytest.mark.asyncio
+async def test_property_filter_metrics(db_path):
+    ds = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"}))
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        for pid in ["age", "age", "status", "made up 1", "made up 2"]:
+            query = {"query": "fido", "properties": [{"pid": pid, "v": 3}]}
+            await client.post("http://localhost/test/dogs/-/reconcile", data={"queries": json.dumps({"q0": query})})
+
+    # only the table's columns are counted, however many other property ids are sent
+    counts = get_state(ds).metrics.labels("reconcile_property_filters_total")
+    assert sorted((labels["property"], value) for labels, value in counts) == [("age", 2), ("status", 1)]
@@ -0,0 +1,151 @@
+import functools
+import json
+
+import httpx
+import pytest
+from click.testing import CliRunner
+from datasette.app import Datasette
+from datasette.cli import cli
+
+from datasette_reconcile.recorder import RequestRecorder, anonymise_query, anonymise_text
+from datasette_reconcile.replay import diff_results, load_recording, replay, summarise
+from tests.conftest import plugin_datasette, plugin_metadata
+
+QUERIES = {
+    "q0": {"query": "fido"},
+    "q1": {"query": "Pancakes", "properties": [{"pid": "status", "v": "bad dog"}]},
+    "q2": {"query": "FIDO"},
+}
+EXTEND = {"ids": ["1", "2"], "properties": [{"id": "status"}]}
+
+
+def test_anonymise_text():
+    text = anonymise_text("Fido's friend fido", b"secret")
+    # punctuation and spaces are kept, and the same word gets the same hash
+    assert len(text) == len("Fido's friend fido")
+    assert text[4] == "'"
+    assert text[6] == text[13] == " "
+    assert text[:4] == text[-4:]
+    assert "fido" not in text.lower()
+    # the hash depends on the key, so it can't be found by hashing likely words
+    assert anonymise_text("fido", b"secret") == text[:4]
+    assert anonymise_text("fido", b"other") != text[:4]
+
+
+def test_anonymise_query():
+    query = anonymise_query(
+        {
+            "query": "Pancakes",
+            "type": "dog",
+            "limit": 2,
+            "properties": [{"pid": "age", "v": 5}, {"pid": "name", "v": ["Cleo"]}],
+        },
+        b"secret",
+    )
+    assert query["query"] != "Pancakes"
+    assert len(query["query"]) == len("Pancakes")
+    assert query["type"] == "dog"
+    assert query["limit"] == 2
+    assert query["properties"][0] == {"pid": "age", "v": 5}
+    assert query["properties"][1]["v"] == [anonymise_text("Cleo", b"secret")]
+
+
+def test_recorder_anonymise_key():
+    assert RequestRecorder(anonymise=True, anonymise_key="secret").anonymise_key == b"secret"
+    # without a key each recorder gets its own random one
+    assert RequestRecorder(anonymise=True).anonymise_key != RequestRecorder(anonymise=True).anonymise_key
+
+
+def get_datasette(db_path, record_path, *, anonymise=False):
+    root_config = {"record_path": str(record_path), "record_anonymise": anonymise, "record_anonymise_key": "secret"}
+    return plugin_datasette(db_path, {"name_field": "name"}, root_config)
+
+
+async def record_requests(ds):
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.post("http://localhost/test/dogs/-/reconcile", data={"queries": json.dumps(QUERIES)})
+        assert 200 == response.status_code
+        response = await client.post("http://localhost/test/dogs/-/reconcile", data={"extend": json.dumps(EXTEND)})
+        assert 200 == response.status_code
+        # the manifest is not recorded
+        response = await client.get("http://localhost/test/dogs/-/reconcile")
+        assert 200 == response.status_code
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("anonymise", [False, True])
+async def test_record_requests(db_path, tmp_path, anonymise):
+    record_path = tmp_path / "recording.jsonl"
+    await record_requests(get_datasette(db_path, record_path, anonymise=anonymise))
+
+    entries = list(load_recording(record_path))
+    assert [entry["endpoint"] for entry in entries] == ["reconcile", "extend"]
+    assert all(entry["database"] == "test" and entry["table"] == "dogs" for entry in entries)
+    assert all(entry["duration_ms"] >= 0 for entry in entries)
+    assert entries[1]["payload"] == {"extend": EXTEND}
+    if anonymise:
+        queries = entries[0]["payload"]["queries"]
+        assert queries["q0"]["query"] == queries["q2"]["query"] == anonymise_text("fido", b"secret")
+        assert queries["q1"]["properties"][0]["pid"] == "status"
+    else:
+        assert entries[0]["payload"] == {"queries": QUERIES}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency, rate", [(1, None), (2, 100)])
+async def test_replay(db_path, tmp_path, concurrency, rate):
+    record_path = tmp_path / "recording.jsonl"
+    ds = get_datasette(db_path, record_path)
+    await record_requests(ds)
+    entries = list(load_recording(record_path))
+
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
+    async with httpx.AsyncClient(app=app, base_url="http://localhost") as client:
+        results, elapsed = await replay(client, entries, concurrency, rate)
+
+    assert [r["status"] for r in results] == [200, 200]
+    assert [r["queries"] for r in results] == [3, 2]
+    assert [r["id"] for r in results[0]["response"]["q0"]["result"]] == ["3"]
+
+    summary = summarise(results, elapsed)
+    assert summary["requests"] == 2
+    assert summary["errors"] == 0
+    assert summary["queries"] == 5
+    assert summary["p50_ms"] <= summary["p99_ms"]
+
+    assert diff_results(results, results)["changed_requests"] == 0
+    changed = json.loads(json.dumps(results))
+    changed[0]["response"]["q0"]["result"] = []
+    changed[1]["response"]["rows"]["1"]["status"] = [{"str": "bad dog"}]
+    diff = diff_results(results, changed)
+    assert diff["requests"] == 2
+    assert diff["changed_requests"] == 2
+    assert diff["queries"] == 3
+    assert diff["changed_queries"] == 1
+    assert diff["changed_top_result"] == 1
+    assert diff["examples"][0] == {"index": 0, "query_id": "q0", "old": ["3"], "new": []}
+
+
+def test_replay_cli(db_path, tmp_path, monkeypatch):
+    record_path = tmp_path / "recording.jsonl"
+    record_path.write_text(
+        json.dumps({"database": "test", "table": "dogs", "endpoint": "reconcile", "payload": {"queries": QUERIES}})
+        + "\n"
+    )
+    app = Datasette([db_path], metadata=plugin_metadata({"name_field": "name"})).app()
+    monkeypatch.setattr(
+        httpx, "AsyncClient", functools.partial(httpx.AsyncClient, transport=httpx.ASGITransport(app=app))
+    )
+
+    runner = CliRunner()
+    output_path = tmp_path / "responses.jsonl"
+    result = runner.invoke(cli, ["reconcile-replay", str(record_path), "--output", str(output_path)])
+    assert result.exit_code == 0, result.output
+    report = json.loads(result.output)
+    assert report["summary"]["requests"] == 1
+    assert report["summary"]["queries"] == 3
+    assert len(output_path.read_text().splitlines()) == 1
+
+    result = runner.invoke(cli, ["reconcile-replay", str(record_path), "--compare", str(output_path)])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)["diff"]["changed_queries"] == 0
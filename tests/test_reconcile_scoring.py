@@ -0,0 +1,22 @@
+from fuzzywuzzy import fuzz
+
+from datasette_reconcile import scoring
+from datasette_reconcile.scoring import normalise_name, score_pairs
+
+NAMES = ["fido", "pancakes", "cleo", "", "scratch"]
+QUERIES = ["fido", "pancake", "clio", "", "x"]
+
+
+def test_normalise_name():
+    assert normalise_name("  Fido ") == "fido"
+    assert normalise_name(5) == "5"
+
+
+def test_score_pairs():
+    assert score_pairs(NAMES, QUERIES) == [fuzz.ratio(n, q) for n, q in zip(NAMES, QUERIES)]
+    assert score_pairs([], []) == []
+
+
+def test_score_pairs_without_rapidfuzz(monkeypatch):
+    monkeypatch.setattr(scoring, "cpdist", None)
+    assert score_pairs(NAMES, QUERIES) == [fuzz.ratio(n, q) for n, q in zip(NAMES, QUERIES)]
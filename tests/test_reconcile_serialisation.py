@@ -0,0 +1,28 @@
+import pytest
+
+from datasette_reconcile import serialisation
+from datasette_reconcile.serialisation import dumps, loads
+
+VALUE = {"q0": {"result": [{"id": "1", "name": "Fido", "score": 100, "match": True, "type": None}]}, 2: [1.5]}
+
+
+@pytest.fixture(params=[True, False], ids=["orjson", "stdlib"])
+def backend(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(serialisation, "orjson", None)
+
+
+@pytest.mark.usefixtures("backend")
+def test_dumps():
+    assert dumps(VALUE) == (
+        '{"q0":{"result":[{"id":"1","name":"Fido","score":100,"match":true,"type":null}]},"2":[1.5]}'
+    )
+    assert dumps(b"abc") == dumps("b'abc'")
+
+
+@pytest.mark.usefixtures("backend")
+def test_loads():
+    assert loads('{"queries": {"q0": {"query": "fido"}}}') == {"queries": {"q0": {"query": "fido"}}}
+    assert loads(b"[1, 2]") == [1, 2]
+    with pytest.raises(ValueError):
+        loads("{")
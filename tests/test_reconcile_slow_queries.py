@@ -0,0 +1,81 @@
+import json
+
+import httpx
+import pytest
+
+from datasette_reconcile.slow_queries import SlowQueryLog, get_params_shape
+from datasette_reconcile.state import get_state
+from datasette_reconcile.utils import check_config
+from tests.conftest import plugin_datasette
+
+
+def test_params_shape():
+    assert get_params_shape(None) is None
+    assert get_params_shape({"search_query": "%fido%", "limit": 5}) == {"search_query": "str(6)", "limit": "int"}
+    assert get_params_shape(["1", "2", 3]) == {"count": 3, "types": ["int", "str"]}
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log(tmp_path):
+    path = tmp_path / "slow.log"
+    log = SlowQueryLog(2, str(path))
+    for i in range(3):
+        await log.add({"sql": f"select {i}"})
+    assert [entry["sql"] for entry in log.recent()] == ["select 2", "select 1"]
+    # the file keeps every entry
+    assert [json.loads(line)["sql"] for line in path.read_text().splitlines()] == ["select 0", "select 1", "select 2"]
+
+
+@pytest.mark.asyncio
+async def test_slow_query_config(ds):
+    with pytest.raises(TypeError, match="slow_query_ms in reconciliation config must be a number"):
+        await check_config({"name_field": "name", "slow_query_ms": "fast"}, ds.get_database("test"), "dogs")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("slow_query_ms, expected_count", [(None, 0), (0, 3), (60_000, 0)])
+async def test_slow_queries_endpoint(db_path, tmp_path, slow_query_ms, expected_count):
+    config = {"name_field": "name", "type_field": "status"}
+    if slow_query_ms is not None:
+        config["slow_query_ms"] = slow_query_ms
+    ds = plugin_datasette(db_path, config, {"slow_query_log_path": str(tmp_path / "slow.log")})
+    async with httpx.AsyncClient(app=ds.app()) as client:
+        response = await client.get(
+            "http://localhost/test/dogs/-/reconcile",
+            params={"queries": json.dumps({"q0": {"query": "fido"}})},
+        )
+        assert 200 == response.status_code
+        response = await client.get(
+            "http://localhost/test/dogs/-/reconcile",
+            params={"extend": json.dumps({"ids": ["1", "2"], "properties": [{"id": "status"}]})},
+        )
+        assert 200 == response.status_code
+        response = await client.get("http://localhost/test/dogs/-/reconcile/suggest/type", params={"prefix": "g"})
+        assert 200 == response.status_code
+
+        # the log is only shown to actors who can see the debug menu
+        response = await client.get("http://localhost/-/reconcile/slow-queries")
+        assert 403 == response.status_code
+
+        cookies = {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+        response = await client.get("http://localhost/-/reconcile/slow-queries", cookies=cookies)
+        assert 200 == response.status_code
+        slow_queries = response.json()["slow_queries"]
+
+    assert len(slow_queries) == expected_count
+    assert get_state(ds).metrics.get("reconcile_slow_queries_total", database="test", table="dogs") == expected_count
+    if not expected_count:
+        return
+
+    # newest first: suggest/type, extend, then reconcile
+    assert [entry["params"] for entry in slow_queries] == [
+        {"default_type": "str(6)"},
+        {"count": 2, "types": ["str"]},
+        {"search_query": "str(6)"},
+    ]
+    assert "like :search_query" in slow_queries[2]["sql"]
+    assert slow_queries[2]["rows"] == 1
+    assert slow_queries[2]["database"] == "test"
+    assert slow_queries[2]["query_plan"]
+    assert all(entry["duration_ms"] >= 0 for entry in slow_queries)
+    assert len((tmp_path / "slow.log").read_text().splitlines()) == expected_count